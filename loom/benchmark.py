@@ -28,18 +28,19 @@
 import os
 import shutil
 import glob
+import time
 import parsable
 from distributions.io.stream import (
     open_compressed,
     json_load,
-    protobuf_stream_load,
 )
-from loom.util import chdir, mkdir_p, rm_rf
+from loom.util import chdir, mkdir_p, rm_rf, csv_reader
 import loom.store
 import loom.config
 import loom.runner
 import loom.generate
 import loom.format
+import loom.cFormat
 import loom.datasets
 import loom.schema_pb2
 import loom.query
@@ -264,10 +265,11 @@ def infer(
     groups = results['samples'][0]['groups']
     assert os.listdir(groups), 'no groups were written'
     group_counts = []
-    for f in os.listdir(groups):
-        group_count = 0
-        for _ in protobuf_stream_load(os.path.join(groups, f)):
-            group_count += 1
+    for f in sorted(os.listdir(groups)):
+        if f.endswith('.index'):
+            continue
+        group_count = loom.cFormat.protobuf_stream_count(
+            os.path.join(groups, f))
         group_counts.append(group_count)
     print 'group_counts: {}'.format(' '.join(map(str, group_counts)))
 
@@ -404,6 +406,57 @@ def related(
         preql.relate(features, sample_count=sample_count)
 
 
+@parsable.command
+def predict(
+        name=None,
+        count=10,
+        debug=False,
+        profile='time'):
+    '''
+    Run predict query, timing bulk encoded sampling against
+    encoding, sampling and decoding one row at a time.
+    '''
+    loom.store.require(name, [
+        'ingest.rows_csv',
+        'ingest.encoding',
+        'samples.0.config',
+        'samples.0.model',
+        'samples.0.groups',
+    ])
+    inputs, results = get_paths(name, 'predict')
+    loom.config.config_dump({}, inputs['query']['config'])
+    root = inputs['root']
+    encoding = inputs['ingest']['encoding']
+    rows_csv = inputs['ingest']['rows_csv']
+    filename = os.path.join(rows_csv, sorted(os.listdir(rows_csv))[0])
+    with csv_reader(filename) as reader:
+        header = reader.next()
+        rows = list(reader)
+
+    print 'starting server'
+    with loom.preql.get_server(root, encoding, debug, profile) as preql:
+        server = preql._query_server
+        print 'predicting {} rows'.format(len(rows))
+
+        start = time.time()
+        for row in rows:
+            conditioning_row = preql.encode_row(row, header)
+            to_sample = [value is None for value in conditioning_row]
+            for sample in server.sample(to_sample, conditioning_row, count):
+                preql.decode_row(sample, header)
+        row_time = time.time() - start
+
+        start = time.time()
+        conditioning_rows = preql.encode_rows(rows, header)
+        samples = server.batch_sample_encoded(conditioning_rows, count)
+        preql.decode_rows(samples, header)
+        bulk_time = time.time() - start
+
+    print 'row at a time: {:0.3f} sec'.format(row_time)
+    print 'bulk encoded: {:0.3f} sec'.format(bulk_time)
+    print 'speedup: {:0.1f}x'.format(row_time / max(bulk_time, 1e-6))
+
+
 @parsable.command
 def test(name=None, debug=True, profile=None):
     '''
@@ -28,7 +28,8 @@
 import os
 from libcpp cimport bool
 from libcpp.vector cimport vector
-from libc.stdint cimport uint32_t, uint64_t
+from libcpp.string cimport string
+from libc.stdint cimport uint8_t, uint32_t, uint64_t
 
 
 cdef extern from "loom/schema.pb.h":
@@ -65,6 +66,14 @@ cdef extern from "loom/schema.pb.h":
         float reals (int index) nogil except +
         void add_reals (float value) nogil except +
 
+    cppclass Diff_cc "protobuf::loom::ProductValue::Diff":
+        Diff_cc "Diff" () nogil except +
+        void Clear () nogil except +
+        Value_cc * pos "mutable_pos" () nogil except +
+        Value_cc * neg "mutable_neg" () nogil except +
+        bool ParseFromString (string data) nogil except +
+        string SerializeAsString () nogil except +
+
     cppclass Row_cc "protobuf::loom::Row":
         Row_cc "Row" () nogil except +
         void Clear () nogil except +
@@ -84,11 +93,45 @@ cdef extern from "loom/schema.pb.h":
         uint32_t groupids (int index) nogil except +
         void add_groupids (uint32_t value) nogil except +
 
+    cppclass SampleRequest_cc "protobuf::loom::Query::Sample::Request":
+        Diff_cc * data "mutable_data" () nogil except +
+        Observed_cc * to_sample "mutable_to_sample" () nogil except +
+        void set_sample_count (uint32_t value) nogil except +
+
+    cppclass SampleResponse_cc "protobuf::loom::Query::Sample::Response":
+        int samples_size () nogil except +
+        Diff_cc * samples "mutable_samples" (int index) nogil except +
+
+    cppclass BatchSampleRequest_cc \
+            "protobuf::loom::Query::BatchSample::Request":
+        SampleRequest_cc * add_entries () nogil except +
+
+    cppclass BatchSampleResponse_cc \
+            "protobuf::loom::Query::BatchSample::Response":
+        int entries_size () nogil except +
+        SampleResponse_cc * entries "mutable_entries" (int index) \
+            nogil except +
+
     cppclass Request_cc "protobuf::loom::Query::Request":
         Request_cc "Request" () nogil except +
+        void Clear () nogil except +
+        string id () nogil except +
+        void set_id (string value) nogil except +
+        BatchSampleRequest_cc * batch_sample "mutable_batch_sample" () \
+            nogil except +
+        bool ParseFromString (string data) nogil except +
+        string SerializeAsString () nogil except +
 
     cppclass Response_cc "protobuf::loom::Query::Response":
         Response_cc "Response" () nogil except +
+        void Clear () nogil except +
+        string id () nogil except +
+        int error_size () nogil except +
+        string error (int index) nogil except +
+        BatchSampleResponse_cc * batch_sample "mutable_batch_sample" () \
+            nogil except +
+        bool ParseFromString (string data) nogil except +
+        string SerializeAsString () nogil except +
 
 
 cdef dict SPARSITY_ERRORS = {
@@ -100,6 +143,14 @@ cdef dict SPARSITY_ERRORS = {
 
 
 cdef extern from "loom/protobuf_stream.hpp" namespace "loom::protobuf":
+    cppclass StreamStats "loom::protobuf::InFile::StreamStats":
+        bool is_file
+        uint64_t message_count
+        uint32_t max_message_size
+
+    StreamStats stream_stats "loom::protobuf::InFile::stream_stats" (
+        char * filename) nogil except +
+
     cppclass InFile:
         InFile (int fid) nogil except +
         InFile (char * filename) nogil except +
@@ -266,6 +317,105 @@ cdef class Assignment:
         return {'rowid': self.ptr.rowid(), 'groupids': groupids}
 
 
+cdef int check_block(
+        uint8_t[:, :] observed,
+        uint8_t[:, :] booleans,
+        uint32_t[:, :] counts,
+        float[:, :] reals) except -1:
+    cdef int row_count = observed.shape[0]
+    feature_count = booleans.shape[1] + counts.shape[1] + reals.shape[1]
+    assert observed.shape[1] == feature_count, 'bad feature count'
+    assert booleans.shape[0] == row_count, 'bad booleans row count'
+    assert counts.shape[0] == row_count, 'bad counts row count'
+    assert reals.shape[0] == row_count, 'bad reals row count'
+    return 0
+
+
+cdef void diff_dump(
+        Diff_cc * diff,
+        int i,
+        uint8_t[:, :] observed,
+        uint8_t[:, :] booleans,
+        uint32_t[:, :] counts,
+        float[:, :] reals):
+    cdef int boolean_count = booleans.shape[1]
+    cdef int count_count = counts.shape[1]
+    cdef int real_count = reals.shape[1]
+    cdef int count_begin = boolean_count
+    cdef int real_begin = boolean_count + count_count
+    cdef int feature_count = real_begin + real_count
+    cdef Value_cc * pos = diff.pos()
+    cdef int f
+    cdef bool any_observed = False
+    diff.neg().observed().set_sparsity(SPARSITY_NONE)
+    for f in xrange(feature_count):
+        if observed[i, f]:
+            any_observed = True
+            break
+    if not any_observed:
+        pos.observed().set_sparsity(SPARSITY_NONE)
+        return
+    pos.observed().set_sparsity(SPARSITY_DENSE)
+    for f in xrange(feature_count):
+        pos.observed().add_dense(observed[i, f] != 0)
+    for f in xrange(boolean_count):
+        if observed[i, f]:
+            pos.add_booleans(booleans[i, f] != 0)
+    for f in xrange(count_count):
+        if observed[i, count_begin + f]:
+            pos.add_counts(counts[i, f])
+    for f in xrange(real_count):
+        if observed[i, real_begin + f]:
+            pos.add_reals(reals[i, f])
+
+
+cdef int diff_load(
+        Diff_cc * diff,
+        int i,
+        uint8_t[:, :] observed,
+        uint8_t[:, :] booleans,
+        uint32_t[:, :] counts,
+        float[:, :] reals) except -1:
+    cdef int boolean_count = booleans.shape[1]
+    cdef int count_count = counts.shape[1]
+    cdef int real_count = reals.shape[1]
+    cdef int count_begin = boolean_count
+    cdef int real_begin = boolean_count + count_count
+    cdef int feature_count = real_begin + real_count
+    cdef Value_cc * pos = diff.pos()
+    cdef Sparsity sparsity = pos.observed().sparsity()
+    cdef int f, b, c, r
+    cdef bool is_observed
+    assert diff.neg().observed().sparsity() == SPARSITY_NONE,\
+        SPARSITY_ERRORS[diff.neg().observed().sparsity()]
+    if sparsity == SPARSITY_NONE:
+        return 0
+    elif sparsity == SPARSITY_DENSE:
+        assert pos.observed().dense_size() == feature_count,\
+            'bad feature count'
+    elif sparsity != SPARSITY_ALL:
+        raise ValueError(SPARSITY_ERRORS[sparsity])
+    b = c = r = 0
+    for f in xrange(feature_count):
+        if sparsity == SPARSITY_ALL:
+            is_observed = True
+        else:
+            is_observed = pos.observed().dense(f)
+        if not is_observed:
+            continue
+        observed[i, f] = 1
+        if f < count_begin:
+            booleans[i, f] = pos.booleans(b)
+            b += 1
+        elif f < real_begin:
+            counts[i, f - count_begin] = pos.counts(c)
+            c += 1
+        else:
+            reals[i, f - real_begin] = pos.reals(r)
+            r += 1
+    return 0
+
+
 cdef class Request:
     cdef Request_cc * ptr
 
@@ -275,6 +425,53 @@ cdef class Request:
     def __dealloc__(self):
         del self.ptr
 
+    def Clear(self):
+        self.ptr.Clear()
+
+    property id:
+        def __set__(self, string id_):
+            self.ptr.set_id(id_)
+
+        def __get__(self):
+            return self.ptr.id()
+
+    def ParseFromString(self, string data):
+        if not self.ptr.ParseFromString(data):
+            raise ValueError('invalid Query.Request')
+
+    def SerializeToString(self):
+        return self.ptr.SerializeAsString()
+
+    def add_batch_sample_entries(
+            self,
+            int begin,
+            int end,
+            uint32_t sample_count,
+            uint8_t[:, :] observed,
+            uint8_t[:, :] booleans,
+            uint32_t[:, :] counts,
+            float[:, :] reals):
+        '''
+        Add a batch_sample entry for each row in [begin, end) of a
+        column-oriented block of data, sampling its unobserved features.
+        See loom.query.EncodedRows.
+        '''
+        check_block(observed, booleans, counts, reals)
+        assert 0 <= begin <= end <= observed.shape[0], 'bad row range'
+        cdef int feature_count = observed.shape[1]
+        cdef BatchSampleRequest_cc * batch_sample = self.ptr.batch_sample()
+        cdef SampleRequest_cc * entry
+        cdef Observed_cc * to_sample
+        cdef int i, f
+        for i in xrange(begin, end):
+            entry = batch_sample.add_entries()
+            diff_dump(entry.data(), i, observed, booleans, counts, reals)
+            to_sample = entry.to_sample()
+            to_sample.set_sparsity(SPARSITY_DENSE)
+            for f in xrange(feature_count):
+                to_sample.add_dense(observed[i, f] == 0)
+            entry.set_sample_count(sample_count)
+
 
 cdef class Response:
     cdef Response_cc * ptr
@@ -285,6 +482,108 @@ cdef class Response:
     def __dealloc__(self):
         del self.ptr
 
+    def Clear(self):
+        self.ptr.Clear()
+
+    property id:
+        def __get__(self):
+            return self.ptr.id()
+
+    property error:
+        def __get__(self):
+            return [self.ptr.error(i) for i in xrange(self.ptr.error_size())]
+
+    def ParseFromString(self, string data):
+        if not self.ptr.ParseFromString(data):
+            raise ValueError('invalid Query.Response')
+
+    def SerializeToString(self):
+        return self.ptr.SerializeAsString()
+
+    def batch_sample_load(
+            self,
+            int begin,
+            uint32_t sample_count,
+            uint8_t[:, :] observed,
+            uint8_t[:, :] booleans,
+            uint32_t[:, :] counts,
+            float[:, :] reals):
+        '''
+        Parse batch_sample samples into consecutive rows of a preallocated,
+        zero-filled, column-oriented block of data, starting at row begin.
+        Each entry must have sample_count samples.
+        Returns the row after the last row written.
+        '''
+        check_block(observed, booleans, counts, reals)
+        cdef BatchSampleResponse_cc * batch_sample = self.ptr.batch_sample()
+        cdef SampleResponse_cc * entry
+        cdef int entry_count = batch_sample.entries_size()
+        cdef int i, s
+        assert 0 <= begin, 'bad row range'
+        assert begin + entry_count * sample_count <= observed.shape[0],\
+            'too many samples'
+        for i in xrange(entry_count):
+            entry = batch_sample.entries(i)
+            assert entry.samples_size() == sample_count, 'bad sample count'
+            for s in xrange(sample_count):
+                diff_load(
+                    entry.samples(s),
+                    begin,
+                    observed,
+                    booleans,
+                    counts,
+                    reals)
+                begin += 1
+        return begin
+
+
+def diffs_dump(
+        uint8_t[:, :] observed,
+        uint8_t[:, :] booleans,
+        uint32_t[:, :] counts,
+        float[:, :] reals):
+    '''
+    Serialize each row of a column-oriented block of data as a
+    ProductValue.Diff string. See loom.query.EncodedRows.
+    '''
+    check_block(observed, booleans, counts, reals)
+    cdef int row_count = observed.shape[0]
+    cdef list result = []
+    cdef Diff_cc * diff = new Diff_cc()
+    cdef int i
+    try:
+        for i in xrange(row_count):
+            diff.Clear()
+            diff_dump(diff, i, observed, booleans, counts, reals)
+            result.append(diff.SerializeAsString())
+    finally:
+        del diff
+    return result
+
+
+def diffs_load(
+        diffs,
+        uint8_t[:, :] observed,
+        uint8_t[:, :] booleans,
+        uint32_t[:, :] counts,
+        float[:, :] reals):
+    '''
+    Parse a list of ProductValue.Diff strings into a preallocated,
+    zero-filled, column-oriented block of data. See diffs_dump.
+    '''
+    check_block(observed, booleans, counts, reals)
+    cdef int row_count = observed.shape[0]
+    assert len(diffs) == row_count, 'bad row count'
+    cdef Diff_cc * diff = new Diff_cc()
+    cdef int i
+    try:
+        for i in xrange(row_count):
+            if not diff.ParseFromString(diffs[i]):
+                raise ValueError('invalid diff at row {}'.format(i))
+            diff_load(diff, i, observed, booleans, counts, reals)
+    finally:
+        del diff
+
 
 def make_dir_for(filename):
     dirname = os.path.dirname(filename)
@@ -292,6 +591,13 @@ def make_dir_for(filename):
         os.makedirs(dirname)
 
 
+def protobuf_stream_count(char * filename):
+    '''
+    Count messages in a protobuf stream, using its .index sidecar if present.
+    '''
+    return stream_stats(filename).message_count
+
+
 def row_stream_dump(stream, char * filename):
     make_dir_for(filename)
     cdef OutFile * f = new OutFile(filename)
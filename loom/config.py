@@ -34,6 +34,7 @@ import loom.documented
 DEFAULTS = {
     'seed': 0,
     'target_mem_bytes': 4e9,
+    'row_cache_mem_bytes': 0,
     'schedule': {
         'extra_passes': 500.0,
         'small_data_size': 4e3,
@@ -70,6 +71,12 @@ DEFAULTS = {
     },
     'query': {
         'parallel': True,
+        'threads': 1,
+        'search_candidate_factor': 10,
+        'score_derivative_chunk_size': 4096,
+        'load_threads': 4,
+        'fork_pool_size': 2,
+        'exact_entropy_max_support': 256,
     },
 }
 
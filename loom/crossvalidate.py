@@ -36,6 +36,7 @@ from distributions.io.stream import (
 )
 from loom.util import LOG
 import loom.store
+import loom.cFormat
 import loom.config
 import loom.runner
 import loom.generate
@@ -128,7 +129,7 @@ def crossvalidate(
     ])
     inputs = loom.store.get_paths(name)
 
-    row_count = sum(1 for _ in protobuf_stream_load(inputs['ingest']['diffs']))
+    row_count = loom.cFormat.protobuf_stream_count(inputs['ingest']['diffs'])
     assert row_count > 1, 'too few rows to crossvalidate: {}'.format(row_count)
     train_count = max(1, min(row_count - 1, int(round(portion * row_count))))
     test_count = row_count - train_count
@@ -31,13 +31,13 @@ from itertools import cycle
 from itertools import izip
 from contextlib2 import ExitStack
 from collections import defaultdict
+import numpy
 import parsable
 from distributions.dbg.models import dpd
 from distributions.fileutil import tempdir
 from distributions.io.stream import json_dump
 from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
-from distributions.io.stream import protobuf_stream_load
 from loom.util import csv_reader
 from loom.util import csv_writer
 from loom.util import LoomError
@@ -209,6 +209,44 @@ def load_decoder(encoder):
     return decode
 
 
+BATCH_DTYPES = {
+    'booleans': numpy.uint8,
+    'counts': numpy.uint32,
+    'reals': numpy.float32,
+}
+
+
+def load_batch_encoder(encoder):
+    '''
+    Like load_encoder, but map an array of strings to an array of values,
+    encoding each distinct string only once.
+    '''
+    encode = load_encoder(encoder)
+    dtype = BATCH_DTYPES[loom.schema.MODEL_TO_DATATYPE[encoder['model']]]
+
+    def batch_encode(values):
+        uniques, inverse = numpy.unique(values, return_inverse=True)
+        codes = numpy.array(map(encode, uniques.tolist()), dtype=dtype)
+        return codes[inverse]
+
+    return batch_encode
+
+
+def load_batch_decoder(encoder):
+    '''
+    Like load_decoder, but map an array of values to an object array of
+    strings, decoding each distinct value only once.
+    '''
+    decode = load_decoder(encoder)
+
+    def batch_decode(values):
+        uniques, inverse = numpy.unique(values, return_inverse=True)
+        strings = numpy.array(map(decode, uniques.tolist()), dtype=object)
+        return strings[inverse]
+
+    return batch_decode
+
+
 def _make_encoder_builders_file((schema_in, rows_in)):
     assert os.path.isfile(rows_in)
     schema = json_load(schema_in)
@@ -503,7 +541,7 @@ def export_rows(encoding_in, rows_in, rows_csv_out, chunk_size=1000000):
     if os.path.exists(rows_csv_out):
         shutil.rmtree(rows_csv_out)
     os.makedirs(rows_csv_out)
-    row_count = sum(1 for _ in protobuf_stream_load(rows_in))
+    row_count = loom.cFormat.protobuf_stream_count(rows_in)
     rows = loom.cFormat.row_stream_load(rows_in)
     chunk_count = (row_count + chunk_size - 1) / chunk_size
     chunks = sorted(
@@ -28,6 +28,8 @@
 from copy import copy
 import csv
 import math
+import os
+import struct
 from contextlib import contextmanager
 from itertools import izip
 from collections import Counter
@@ -35,15 +37,29 @@ from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
 from StringIO import StringIO
 import numpy
+import pandas
 from sklearn.cluster import SpectralClustering
+from loom.format import load_batch_decoder
+from loom.format import load_batch_encoder
 from loom.format import load_decoder
 from loom.format import load_encoder
+from loom.schema_pb2 import CrossCat
+from loom.util import THREADS
+from loom.util import iter_chunks
+import loom.schema
 import loom.store
 import loom.query
 import loom.group
 
 SAMPLE_COUNT = 1000
 
+# rows per block in bulk encoding and decoding
+ENCODE_CHUNK_SIZE = 10000
+
+# a related file starts with the model fingerprint and feature count,
+# followed by float32 [means, variances] of pairwise mutual information
+RELATED_HEADER = struct.Struct('<40sQ')
+
 
 class CsvWriter(object):
     def __init__(self, outfile, returns=None):
@@ -85,6 +101,11 @@ class PreQL(object):
         input = StringIO(input_df.to_csv())  # input_df is a pandas.DataFrame
         output_df = pandas.read_csv(StringIO(output))
 
+    Most outputs are also available without csv formatting, via
+    relate_frame, refine_frame, support_frame, group_frame and search_frame,
+    which return pandas dataframes, and similar_array, which returns a
+    numpy array.
+
     Usage in scripts:
 
         with loom.preql.get_server('/absolute/path/to/dataset') as preql:
@@ -150,7 +171,15 @@ class PreQL(object):
             e['name']: load_encoder(e)
             for e in self._encoders
         }
+        self._batch_encoders = map(load_batch_encoder, self._encoders)
+        self._batch_decoders = map(load_batch_decoder, self._encoders)
+        self._datatype_counts = Counter(
+            loom.schema.MODEL_TO_DATATYPE[e['model']]
+            for e in self._encoders)
         self._rowid_map = None
+        self._kind_comembership = None
+        self._related = None
+        self._related_loaded = False
         self._debug = debug
 
     @property
@@ -162,6 +191,34 @@ class PreQL(object):
         convert = lambda string: string if string else None
         return {name: convert for name in self._feature_names}
 
+    @property
+    def kind_comembership(self):
+        '''
+        A matrix whose [i, j] entry is the fraction of samples in which
+        features i and j belong to the same kind.
+        '''
+        if self._kind_comembership is None:
+            root = self._query_server.root
+            self._kind_comembership = load_kind_comembership(root)
+        return self._kind_comembership
+
+    @property
+    def related(self):
+        '''
+        The materialized (means, variances) matrices of unconditional
+        mutual information between features, or None if missing or stale.
+        See materialize_related.
+        '''
+        if not self._related_loaded:
+            self._related = load_related(self._query_server.root)
+            self._related_loaded = True
+        return self._related
+
+    def _share_kind(self, feature_set1, feature_set2):
+        comembership = self.kind_comembership
+        return comembership[
+            numpy.ix_(sorted(feature_set1), sorted(feature_set2))].any()
+
     @property
     def rowid_map(self):
         if self._rowid_map is None:
@@ -263,6 +320,95 @@ class PreQL(object):
         row = self._transform.backward_row(features, header, row)
         return row
 
+    def encode_rows(self, rows, header=None):
+        '''
+        Encode a block of rows at once, like encode_row.
+
+        Inputs:
+            rows - a pandas.DataFrame, read with dtype=str or with
+                converters=preql.converters, or a 2d array of strings
+                with None or '' for missing values
+            header - column names, defaulting to the DataFrame's columns
+                or to feature_names
+
+        Outputs:
+            A column-oriented loom.query.EncodedRows block
+        '''
+        features = self._feature_names
+        if isinstance(rows, pandas.DataFrame):
+            if header is None:
+                header = list(rows.columns)
+            rows = rows.values
+        if header is None:
+            header = features
+        rows = numpy.array(rows, dtype=object)
+        if rows.ndim != 2 or rows.shape[1] != len(header):
+            raise ValueError('invalid rows (bad shape): {}'.format(rows.shape))
+        rows[pandas.isnull(rows)] = None
+        rows[rows == ''] = None
+        if self._transform.transforms:
+            rows = numpy.array([
+                self._transform.forward_row(header, features, row)
+                for row in rows.tolist()
+            ], dtype=object).reshape((len(rows), len(features)))
+            header = features
+        name_to_col = {name: col for col, name in enumerate(header)}
+
+        counts = self._datatype_counts
+        result = loom.query.EncodedRows.empty(
+            len(rows),
+            counts['booleans'],
+            counts['counts'],
+            counts['reals'])
+        blocks = [result.booleans, result.counts, result.reals]
+        begins = numpy.cumsum([0] + [b.shape[1] for b in blocks])
+        for pos, name in enumerate(features):
+            col = name_to_col.get(name)
+            if col is None:
+                continue
+            values = rows[:, col]
+            observed = ~pandas.isnull(values)
+            try:
+                encoded = self._batch_encoders[pos](values[observed])
+            except Exception:
+                raise ValueError('bad value in column {}'.format(name))
+            block = numpy.searchsorted(begins, pos, side='right') - 1
+            blocks[block][observed, pos - begins[block]] = encoded
+            result.observed[observed, pos] = 1
+        return result
+
+    def decode_rows(self, encoded_rows, header=None):
+        '''
+        Decode an EncodedRows block at once, like decode_row,
+        into a pandas.DataFrame of strings with None for missing values.
+        '''
+        features = self._feature_names
+        if header is None:
+            header = features
+        row_count = encoded_rows.row_count
+        rows = numpy.empty((row_count, len(features)), dtype=object)
+        blocks = encoded_rows[1:]
+        begins = numpy.cumsum([0] + [b.shape[1] for b in blocks])
+        for pos, name in enumerate(features):
+            observed = encoded_rows.observed[:, pos].astype(numpy.bool_)
+            block = numpy.searchsorted(begins, pos, side='right') - 1
+            values = blocks[block][observed, pos - begins[block]]
+            rows[observed, pos] = self._batch_decoders[pos](values)
+        if self._transform.transforms:
+            rows = [
+                self._transform.backward_row(features, header, row)
+                for row in rows.tolist()
+            ]
+        else:
+            name_to_pos = self._name_to_pos
+            columns = [
+                rows[:, name_to_pos[name]] if name in name_to_pos
+                else numpy.empty(row_count, dtype=object)
+                for name in header
+            ]
+            rows = numpy.column_stack(columns) if columns else rows[:, :0]
+        return pandas.DataFrame(rows, columns=header)
+
     def _normalized_mutual_information(
             self,
             feature_set1,
@@ -321,21 +467,16 @@ class PreQL(object):
         if id_offset and header[0] in self._feature_names:
             raise ValueError('id field conflict: {}'.format(header[0]))
         writer.writerow(header)
-        for row in reader:
-            if id_offset:
-                row_id = row[0]
-            conditioning_row = self.encode_row(row, header)
-            to_sample = [value is None for value in conditioning_row]
-            samples = self._query_server.sample(
-                to_sample,
-                conditioning_row,
+        for rows in iter_chunks(reader, ENCODE_CHUNK_SIZE):
+            rows = numpy.array(rows, dtype=object)
+            conditioning_rows = self.encode_rows(rows, header)
+            samples = self._query_server.batch_sample_encoded(
+                conditioning_rows,
                 count)
-            for sample in samples:
-                print sample
-                sample = self.decode_row(sample, header)
-                if id_offset:
-                    sample[0] = row_id
-                writer.writerow(sample)
+            samples = self.decode_rows(samples, header).values
+            if id_offset:
+                samples[:, 0] = numpy.repeat(rows[:, 0], count)
+            writer.writerows(samples.tolist())
 
     def relate(self, columns, result_out=None, sample_count=SAMPLE_COUNT):
         '''
@@ -369,17 +510,40 @@ class PreQL(object):
             feature1,0.0,0.5
             feature2,0.5,1.0
         '''
+        frame = self.relate_frame(columns, sample_count)
+        with csv_output(result_out) as writer:
+            write_frame(frame, writer)
+            return writer.result()
+
+    def relate_frame(self, columns, sample_count=SAMPLE_COUNT):
+        '''
+        Like relate, but return a pandas.DataFrame of relatedness
+        indexed by target and query labels, skipping csv formatting.
+        '''
+        if self.related is not None:
+            return self._relate_materialized(columns)
         target_feature_sets = [self.encode_set([f]) for f in columns]
         query_feature_sets = [self.encode_set([f]) for f in columns]
         conditioning_row = self.encode_row(None)
-        with csv_output(result_out) as writer:
-            self._relate(
-                target_feature_sets,
-                query_feature_sets,
-                conditioning_row,
-                writer,
-                sample_count)
-            return writer.result()
+        return self._relate(
+            target_feature_sets,
+            query_feature_sets,
+            conditioning_row,
+            sample_count)
+
+    def _relate_materialized(self, columns):
+        means, variances = self.related
+        for column in columns:
+            if column not in self._feature_set:
+                raise ValueError('invalid feature: {}'.format(column))
+        positions = [self._name_to_pos[column] for column in columns]
+        result = numpy.ones((len(columns), len(columns)))
+        for i, pos_i in enumerate(positions):
+            for j, pos_j in enumerate(positions):
+                if pos_i != pos_j:
+                    result[i, j] = normalize_mutual_information(
+                        float(means[pos_i, pos_j]))
+        return pandas.DataFrame(result, index=columns, columns=columns)
 
     def refine(
             self,
@@ -425,6 +589,25 @@ class PreQL(object):
             f0,1.,0.9,0.5
             f2,0.8,1.,0.8
         '''
+        frame = self.refine_frame(
+            target_feature_sets,
+            query_feature_sets,
+            conditioning_row,
+            sample_count)
+        with csv_output(result_out) as writer:
+            write_frame(frame, writer)
+            return writer.result()
+
+    def refine_frame(
+            self,
+            target_feature_sets=None,
+            query_feature_sets=None,
+            conditioning_row=None,
+            sample_count=SAMPLE_COUNT):
+        '''
+        Like refine, but return a pandas.DataFrame of relatedness
+        indexed by target and query labels, skipping csv formatting.
+        '''
         conditioning_row = self.encode_row(conditioning_row)
         fc_zip = zip(self._feature_names, conditioning_row)
         if target_feature_sets is None:
@@ -446,14 +629,11 @@ class PreQL(object):
                     conditioning_row))
         self._validate_feature_sets(target_feature_sets)
         self._validate_feature_sets(query_feature_sets)
-        with csv_output(result_out) as writer:
-            self._relate(
-                target_feature_sets,
-                query_feature_sets,
-                conditioning_row,
-                writer,
-                sample_count)
-            return writer.result()
+        return self._relate(
+            target_feature_sets,
+            query_feature_sets,
+            conditioning_row,
+            sample_count)
 
     def support(
             self,
@@ -505,6 +685,25 @@ class PreQL(object):
             f0,1.,0.9,0.5
             f3,0.8,0.8,1.0
         '''
+        frame = self.support_frame(
+            target_feature_sets,
+            observed_feature_sets,
+            conditioning_row,
+            sample_count)
+        with csv_output(result_out) as writer:
+            write_frame(frame, writer)
+            return writer.result()
+
+    def support_frame(
+            self,
+            target_feature_sets=None,
+            observed_feature_sets=None,
+            conditioning_row=None,
+            sample_count=SAMPLE_COUNT):
+        '''
+        Like support, but return a pandas.DataFrame of relatedness
+        indexed by target and observed labels, skipping csv formatting.
+        '''
         conditioning_row = self.encode_row(conditioning_row)
         if all(c is None for c in conditioning_row):
             raise ValueError(
@@ -529,21 +728,17 @@ class PreQL(object):
                 'features {} must not be None in conditioning row {}'.format(
                     mismatches,
                     conditioning_row))
-        with csv_output(result_out) as writer:
-            self._relate(
-                target_feature_sets,
-                observed_feature_sets,
-                conditioning_row,
-                writer,
-                sample_count)
-            return writer.result()
+        return self._relate(
+            target_feature_sets,
+            observed_feature_sets,
+            conditioning_row,
+            sample_count)
 
     def _relate(
             self,
             target_feature_sets,
             query_feature_sets,
             conditioning_row,
-            writer,
             sample_count):
         '''
         Compute all pairwise related scores between target_set
@@ -565,36 +760,61 @@ class PreQL(object):
         query_sets = map(self._cols_to_mask, query_feature_sets)
         target_labels = map(min, target_feature_sets)
         query_labels = map(min, query_feature_sets)
-        entropys = self._query_server.entropy(
-            row_sets=target_sets,
-            col_sets=query_sets,
-            conditioning_row=conditioning_row,
-            sample_count=sample_count)
-        writer.writerow([None] + query_labels)
-        for target_label, target_set in izip(target_labels, target_sets):
-            result_row = [target_label]
+
+        # Each related pair needs H(t), H(q) and H(t | q) given the
+        # conditioning row with t and q forgotten. Mutual information is
+        # symmetric, so (t, q) and (q, t) share terms. Features that never
+        # share a kind are independent in every sample, so score 0 and are
+        # never sampled. Pairs are grouped by conditioning row and split into
+        # connected blocks, and each block is one entropy query; support
+        # forgets each pair in turn, so there every pair is a block. Queries
+        # are sent as batch_entropy requests of many blocks each.
+        groups = {}
+        for target_set in target_sets:
             for query_set in query_sets:
                 if target_set == query_set:
-                    normalized_mi = 1.0
-                else:
-                    forgetful_conditioning_row = copy(conditioning_row)
-                    for feature_index in target_set | query_set:
-                        forgetful_conditioning_row[feature_index] = None
-                    if forgetful_conditioning_row != conditioning_row:
-                        normalized_mi = self._normalized_mutual_information(
-                            target_set,
-                            query_set,
-                            entropys=None,
-                            conditioning_row=forgetful_conditioning_row,
-                            sample_count=sample_count)
-                    else:
-                        normalized_mi = self._normalized_mutual_information(
-                            target_set,
-                            query_set,
-                            entropys=entropys,
-                            sample_count=sample_count)
-                result_row.append(normalized_mi)
-            writer.writerow(result_row)
+                    continue
+                if not self._share_kind(target_set, query_set):
+                    continue
+                forgetful_conditioning_row = copy(conditioning_row)
+                for feature_index in target_set | query_set:
+                    forgetful_conditioning_row[feature_index] = None
+                key = tuple(forgetful_conditioning_row)
+                pair = frozenset([target_set, query_set])
+                groups.setdefault(key, set()).add(pair)
+        queries = []
+        block_pairs = []
+        for forgetful_conditioning_row, pairs in groups.iteritems():
+            edges = map(tuple, pairs)
+            for block in connected_blocks(edges):
+                block_targets, block_queries, block_edges = block
+                queries.append((
+                    block_targets,
+                    block_queries,
+                    list(forgetful_conditioning_row)))
+                block_pairs.append(map(frozenset, block_edges))
+        results = self._query_server.entropy_many(queries, sample_count)
+        entropys = {}
+        for pairs, result in izip(block_pairs, results):
+            for pair in pairs:
+                entropys[pair] = result
+
+        result = numpy.zeros((len(target_sets), len(query_sets)))
+        for i, target_set in enumerate(target_sets):
+            for j, query_set in enumerate(query_sets):
+                pair = frozenset([target_set, query_set])
+                if target_set == query_set:
+                    result[i, j] = 1.0
+                elif pair in entropys:
+                    result[i, j] = self._normalized_mutual_information(
+                        target_set,
+                        query_set,
+                        entropys=entropys[pair],
+                        sample_count=sample_count)
+        return pandas.DataFrame(
+            result,
+            index=target_labels,
+            columns=query_labels)
 
     def group(self, column, result_out=None):
         '''
@@ -623,19 +843,28 @@ class PreQL(object):
             4,1,0.1
             0,2,0.4
         '''
+        frame = self.group_frame(column)
         with csv_output(result_out) as writer:
-            self._group(column, writer)
+            write_frame(frame, writer, index=False)
             return writer.result()
 
-    def _group(self, column, writer):
+    def group_frame(self, column):
+        '''
+        Like group, but return a pandas.DataFrame with columns
+        [row_id, group_id, confidence], skipping csv formatting.
+        '''
         root = self._query_server.root
         feature_pos = self._name_to_pos[column]
         result = loom.group.group(root, feature_pos)
         rowid_map = self.rowid_map
-        writer.writerow(loom.group.Row._fields)
-        for row in result:
-            external_id = rowid_map[row.row_id]
-            writer.writerow((external_id, row.group_id, row.confidence))
+        frame = pandas.DataFrame(
+            {
+                'row_id': [rowid_map[row.row_id] for row in result],
+                'group_id': numpy.array([row.group_id for row in result]),
+                'confidence': numpy.array([row.confidence for row in result]),
+            },
+            columns=loom.group.Row._fields)
+        return frame
 
     def similar(self, rows, rows2=None, row_limit=None, result_out=None):
         '''
@@ -650,16 +879,24 @@ class PreQL(object):
             entries ij giving the similarity score between row i
             and row j.
         '''
+        result = self.similar_array(rows, rows2, row_limit)
+        with csv_output(result_out) as writer:
+            writer.writerows(result.tolist())
+            return writer.result()
+
+    def similar_array(self, rows, rows2=None, row_limit=None):
+        '''
+        Like similar, but return a numpy array of similarity scores,
+        skipping csv formatting.
+        '''
         rows = map(self.encode_row, rows)
         if rows2 is not None:
             rows2 = map(self.encode_row, rows2)
         else:
             rows2 = rows
-        with csv_output(result_out) as writer:
-            self._similar(rows, rows2, row_limit, writer)
-            return writer.result()
+        return self._similar(rows, rows2, row_limit)
 
-    def _similar(self, update_rows, score_rows, row_limit, writer):
+    def _similar(self, update_rows, score_rows, row_limit):
         score_ids = set()
         update_row_results = []
         for update_row in update_rows:
@@ -670,8 +907,11 @@ class PreQL(object):
             results_dict = dict(results)
             update_row_results.append(results_dict)
             score_ids = score_ids.union(set(results_dict.keys()))
-        for results in update_row_results:
-            writer.writerow([results[_id] for _id in score_ids])
+        score_ids = list(score_ids)
+        result = numpy.zeros((len(update_row_results), len(score_ids)))
+        for i, results in enumerate(update_row_results):
+            result[i] = [results[_id] for _id in score_ids]
+        return result
 
     def search(self, row, row_limit=None, result_out=None):
         '''
@@ -684,21 +924,30 @@ class PreQL(object):
             A csv file with with columns row_id, score, showing the
             top 1000 most search rows in the dataset, sorted by score
         '''
-        row = self.encode_row(row)
+        frame = self.search_frame(row, row_limit)
         with csv_output(result_out) as writer:
-            self._search(row, row_limit, writer)
+            write_frame(frame, writer, index=False)
             return writer.result()
 
-    def _search(self, row, row_limit, writer):
+    def search_frame(self, row, row_limit=None):
+        '''
+        Like search, but return a pandas.DataFrame with columns
+        [row_id, score], skipping csv formatting.
+        '''
+        row = self.encode_row(row)
         results = self._query_server.score_derivative(
             row,
             score_rows=None,
             row_limit=row_limit)
         # FIXME map through erf
-        writer.writerow(('row_id', 'score'))
-        for row_id, score in results:
-            external_id = self.rowid_map[row_id]
-            writer.writerow((external_id, score))
+        rowid_map = self.rowid_map
+        frame = pandas.DataFrame(
+            {
+                'row_id': [rowid_map[row_id] for row_id, _ in results],
+                'score': numpy.array([score for _, score in results]),
+            },
+            columns=['row_id', 'score'])
+        return frame
 
     def cluster(
             self,
@@ -711,11 +960,7 @@ class PreQL(object):
                 [None for _ in self.feature_names],
                 sample_count=SAMPLE_COUNT)
         row_limit = len(seed_rows) ** 2 + 1
-        similar_string = StringIO(self.similar(seed_rows, row_limit=row_limit))
-        similar = numpy.genfromtxt(
-            similar_string,
-            delimiter=',',
-            skip_header=0)
+        similar = self.similar_array(seed_rows, row_limit=row_limit)
         similar = similar.clip(0., 5.)
         similar = numpy.exp(similar)
         clustering = SpectralClustering(
@@ -728,14 +973,10 @@ class PreQL(object):
         else:
             row_labels = []
             for row in rows_to_cluster:
-                similar_scores = self.similar(
+                similar_scores = self.similar_array(
                     [row],
                     seed_rows,
-                    row_limit=row_limit)
-                similar_scores = numpy.genfromtxt(
-                    StringIO(similar_scores),
-                    delimiter=',',
-                    skip_header=0)
+                    row_limit=row_limit)[0]
                 assert len(similar_scores) == len(labels)
                 label_scores = zip(similar_scores, labels)
                 top = sorted(label_scores, reverse=True)[:nearest_neighbors]
@@ -745,6 +986,141 @@ class PreQL(object):
             return zip(row_labels, rows_to_cluster)
 
 
+def write_frame(frame, writer, index=True):
+    '''
+    Write a pandas.DataFrame as csv rows, including a header and,
+    if index, a first column of row labels.
+    '''
+    if index:
+        writer.writerow([None] + list(frame.columns))
+        for label, row in izip(frame.index, frame.values.tolist()):
+            writer.writerow([label] + row)
+    else:
+        writer.writerow(list(frame.columns))
+        writer.writerows(frame.values.tolist())
+
+
+def load_kind_comembership(root):
+    '''
+    Return a matrix whose [i, j] entry is the fraction of samples of the
+    dataset at root in which features i and j belong to the same kind.
+    '''
+    paths = loom.store.get_paths(root, sample_count=None)
+    comembership = None
+    for sample in paths['samples']:
+        cross_cat = CrossCat()
+        with open_compressed(sample['model'], 'rb') as f:
+            cross_cat.ParseFromString(f.read())
+        if comembership is None:
+            feature_count = sum(len(k.featureids) for k in cross_cat.kinds)
+            comembership = numpy.zeros((feature_count, feature_count))
+        for kind in cross_cat.kinds:
+            featureids = numpy.array(kind.featureids, dtype=numpy.int64)
+            comembership[numpy.ix_(featureids, featureids)] += 1
+    return comembership / len(paths['samples'])
+
+
+def materialize_related(
+        root,
+        sample_count=SAMPLE_COUNT,
+        worker_count=THREADS,
+        debug=False):
+    '''
+    Estimate unconditional mutual information between all pairs of
+    features, in parallel over a pool of query servers, and save means
+    and variances to query/related.bin, tagged with the model fingerprint.
+    Features that never share a kind have zero mutual information.
+    '''
+    comembership = load_kind_comembership(root)
+    feature_count = len(comembership)
+    feature_sets = [frozenset([f]) for f in xrange(feature_count)]
+    means = numpy.zeros((feature_count, feature_count), dtype=numpy.float32)
+    variances = numpy.zeros_like(means)
+    with loom.query.QueryServerPool(root, worker_count, debug=debug) as pool:
+        futures = []
+        for i in xrange(feature_count):
+            col_sets = [
+                feature_sets[j]
+                for j in xrange(i + 1, feature_count)
+                if comembership[i, j]
+            ]
+            if col_sets:
+                future = pool.entropy(
+                    [feature_sets[i]],
+                    col_sets,
+                    sample_count=sample_count)
+                futures.append((i, col_sets, future))
+        for i, col_sets, future in futures:
+            entropys = future.result()
+            for col_set in col_sets:
+                j, = col_set
+                estimate = loom.query.get_mutual_information(
+                    feature_sets[i],
+                    col_set,
+                    entropys)
+                means[i, j] = means[j, i] = estimate.mean
+                variances[i, j] = variances[j, i] = estimate.variance
+    fingerprint = loom.store.get_fingerprint(root)
+    filename = loom.store.get_paths(root)['query']['related']
+    dump_related(fingerprint, means, variances, filename)
+
+
+def dump_related(fingerprint, means, variances, filename):
+    temp = filename + '.temp'
+    with open(temp, 'wb') as f:
+        f.write(RELATED_HEADER.pack(fingerprint, len(means)))
+        numpy.array([means, variances], dtype=numpy.float32).tofile(f)
+    os.rename(temp, filename)
+
+
+def load_related(root):
+    '''
+    Memory-map the (means, variances) matrices written by
+    materialize_related, or return None if they are missing or were
+    computed from different model files.
+    '''
+    filename = loom.store.get_paths(root)['query']['related']
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        header = f.read(RELATED_HEADER.size)
+    fingerprint, feature_count = RELATED_HEADER.unpack(header)
+    if fingerprint != loom.store.get_fingerprint(root):
+        return None
+    related = numpy.memmap(
+        filename,
+        dtype=numpy.float32,
+        mode='r',
+        offset=RELATED_HEADER.size,
+        shape=(2, feature_count, feature_count))
+    return related[0], related[1]
+
+
+def connected_blocks(edges):
+    '''
+    Partition a list of (target, query) edges into connected blocks,
+    returning a (targets, queries, edges) triple for each block, such that
+    each of the block's edges lies in the product of its targets and queries.
+    '''
+    parents = {}
+
+    def find(node):
+        while parents.setdefault(node, node) != node:
+            node = parents[node]
+        return node
+
+    for target, query in edges:
+        parents[find(target)] = find(query)
+
+    blocks = {}
+    for target, query in edges:
+        block = blocks.setdefault(find(target), (set(), set(), []))
+        block[0].add(target)
+        block[1].add(query)
+        block[2].append((target, query))
+    return [(list(t), list(q), e) for t, q, e in blocks.itervalues()]
+
+
 def normalize_mutual_information(mutual_info):
     '''
     Recall that mutual information
@@ -801,6 +1177,22 @@ def normalize_mutual_information(mutual_info):
     return r
 
 
-def get_server(root, encoding=None, debug=False, profile=None, config=None):
-    query_server = loom.query.get_server(root, config, debug, profile)
+def get_server(
+        root,
+        encoding=None,
+        debug=False,
+        profile=None,
+        config=None,
+        fork_server=None,
+        cache=None):
+    '''
+    Start a PreQL session, either on a new query server or, if a
+    loom.query.ForkServer is given, on a forked child of that server.
+    Pass a loom.query.QueryCache as cache to reuse entropy results.
+    '''
+    if fork_server is None:
+        query_server = loom.query.get_server(root, config, debug, profile)
+    else:
+        query_server = fork_server.connect()
+    query_server.cache = cache
     return PreQL(query_server, encoding)
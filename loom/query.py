@@ -25,17 +25,39 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+import time
+import threading
 import uuid
 from itertools import chain
+from itertools import imap
+from itertools import izip
+from collections import deque
 from collections import namedtuple
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 import numpy
+from distributions.io.stream import open_compressed
 from distributions.io.stream import protobuf_stream_read
 from distributions.io.stream import protobuf_stream_write
+from loom.schema_pb2 import Config
+from loom.schema_pb2 import CrossCat
 from loom.schema_pb2 import ProductValue
 from loom.schema_pb2 import Row
 from loom.schema_pb2 import Query
+from loom.util import iter_chunks
+from loom.util import mkdir_p
+from loom.util import pickle_dump
+from loom.util import pickle_load
 import loom.cFormat
 import loom.runner
+import loom.store
 
 DEFAULTS = {
     'sample_sample_count': 10,
@@ -43,16 +65,30 @@ DEFAULTS = {
     'mutual_information_sample_count': 1000,
     'similar_row_limit': 1000,
     'tile_size': 500,
+    'batch_score_chunk_size': 1000,
+    'batch_sample_chunk_size': 100,
+    'batch_entropy_chunk_size': 1000,
+    'cache_max_entries': 1000,
+    'cache_max_disk_entries': 100000,
 }
 BUFFER_SIZE = 10
 
-Estimate = namedtuple('Estimate', ['mean', 'variance'], verbose=False)
+
+class Estimate(namedtuple('Estimate', ['mean', 'variance', 'sample_count'])):
+    '''
+    A Monte Carlo estimate: mean, variance of the mean, and, if known,
+    the number of samples it is based on.
+    '''
+    __slots__ = ()
+
+    def __new__(cls, mean, variance, sample_count=None):
+        return super(Estimate, cls).__new__(cls, mean, variance, sample_count)
 
 
 def get_estimate(samples):
     mean = numpy.mean(samples)
     variance = numpy.var(samples) / len(samples)
-    return Estimate(mean, variance)
+    return Estimate(mean, variance, len(samples))
 
 
 NONE = ProductValue.Observed.NONE
@@ -109,6 +145,68 @@ def load_data_rows(filename):
         ]
 
 
+class EncodedRows(namedtuple(
+        'EncodedRows',
+        ['observed', 'booleans', 'counts', 'reals'])):
+    '''
+    A column-oriented block of encoded data rows: a uint8 observed mask
+    over all features, and uint8 booleans, uint32 counts and float32 reals
+    over features of each type, in feature order. Values of unobserved
+    features are ignored.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def empty(cls, row_count, boolean_count, count_count, real_count):
+        feature_count = boolean_count + count_count + real_count
+        return cls(
+            numpy.zeros((row_count, feature_count), dtype=numpy.uint8),
+            numpy.zeros((row_count, boolean_count), dtype=numpy.uint8),
+            numpy.zeros((row_count, count_count), dtype=numpy.uint32),
+            numpy.zeros((row_count, real_count), dtype=numpy.float32))
+
+    @property
+    def row_count(self):
+        return self.observed.shape[0]
+
+    def empty_like(self, row_count):
+        return self.empty(
+            row_count,
+            self.booleans.shape[1],
+            self.counts.shape[1],
+            self.reals.shape[1])
+
+    def repeat(self, count):
+        return EncodedRows(*(numpy.repeat(b, count, axis=0) for b in self))
+
+    def update(self, other):
+        '''
+        Overwrite values in self with the observed values of other.
+        '''
+        begin = 0
+        for block, other_block in izip(self[1:], other[1:]):
+            end = begin + block.shape[1]
+            mask = other.observed[:, begin:end].astype(numpy.bool_)
+            block[mask] = other_block[mask]
+            begin = end
+        self.observed[:] |= other.observed
+
+
+def encoded_rows_to_protobuf(encoded_rows):
+    '''
+    Serialize each row of an EncodedRows block as a ProductValue.Diff string.
+    '''
+    return loom.cFormat.diffs_dump(*encoded_rows)
+
+
+def protobuf_to_encoded_rows(diffs, encoded_rows):
+    '''
+    Parse ProductValue.Diff strings into an empty EncodedRows block.
+    '''
+    loom.cFormat.diffs_load(diffs, *encoded_rows)
+    return encoded_rows
+
+
 def feature_set_to_protobuf(feature_set, messages):
     message = messages.add()
     message.sparsity = SPARSE
@@ -116,9 +214,159 @@ def feature_set_to_protobuf(feature_set, messages):
         message.sparse.append(i)
 
 
+def get_mutual_information(feature_set1, feature_set2, entropys):
+    feature_union = frozenset.union(feature_set1, feature_set2)
+    estimates = [
+        entropys[feature_set1],
+        entropys[feature_set2],
+        entropys[feature_union],
+    ]
+    mi = estimates[0].mean + estimates[1].mean - estimates[2].mean
+    variance = sum(e.variance for e in estimates)
+    # exact estimates report sample_count 0; the mutual information is
+    # exact only if every term is, otherwise it has the fewest samples
+    sample_counts = [e.sample_count for e in estimates]
+    if None in sample_counts:
+        sample_count = None
+    else:
+        sampled = [count for count in sample_counts if count]
+        sample_count = min(sampled) if sampled else 0
+    return Estimate(mi, variance, sample_count)
+
+
+class QueryCache(object):
+    '''
+    An LRU cache of query results, bounded by max_entries, with hit and
+    miss counters. If dirname is given, results are also pickled there,
+    so they survive restarts; the directory is bounded by max_disk_entries,
+    evicting the least recently used files by mtime. Callers must include
+    a model fingerprint in their keys, see loom.store.get_fingerprint;
+    given that fingerprint, files of other fingerprints are deleted.
+    '''
+    def __init__(
+            self,
+            max_entries=None,
+            dirname=None,
+            max_disk_entries=None,
+            fingerprint=None):
+        if max_entries is None:
+            max_entries = DEFAULTS['cache_max_entries']
+        if max_disk_entries is None:
+            max_disk_entries = DEFAULTS['cache_max_disk_entries']
+        assert max_entries > 0, max_entries
+        assert max_disk_entries > 0, max_disk_entries
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.dirname = dirname
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._disk_count = 0
+        if dirname is not None:
+            mkdir_p(dirname)
+            for filename in self._list_disk():
+                basename = os.path.basename(filename)
+                if fingerprint and not basename.startswith(fingerprint):
+                    os.remove(filename)
+                else:
+                    self._disk_count += 1
+            self._evict_disk()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _filename(self, key, suffix=''):
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        if self.fingerprint:
+            digest = '{}.{}'.format(self.fingerprint, digest)
+        basename = '{}{}.pickle.gz'.format(digest, suffix)
+        return os.path.join(self.dirname, basename)
+
+    def _list_disk(self):
+        return [
+            os.path.join(self.dirname, basename)
+            for basename in os.listdir(self.dirname)
+            if basename.endswith('.pickle.gz')
+        ]
+
+    def _evict_disk(self):
+        '''
+        Remove the least recently used files, leaving some headroom so
+        that the directory is not listed on every put.
+        '''
+        if self._disk_count <= self.max_disk_entries:
+            return
+        filenames = []
+        for filename in self._list_disk():
+            try:
+                filenames.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass  # removed concurrently
+        filenames.sort()
+        keep_count = max(1, self.max_disk_entries * 9 / 10)
+        for _, filename in filenames[:max(0, len(filenames) - keep_count)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self._disk_count = min(len(filenames), keep_count)
+
+    def get(self, key):
+        value = self._entries.pop(key, None)
+        if value is None and self.dirname is not None:
+            filename = self._filename(key)
+            if os.path.exists(filename):
+                value = pickle_load(filename)
+                os.utime(filename, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._insert(key, value)
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._insert(key, value)
+        if self.dirname is not None:
+            filename = self._filename(key)
+            if not os.path.exists(filename):
+                self._disk_count += 1
+            temp = self._filename(key, '.{}.temp'.format(uuid.uuid4()))
+            pickle_dump(value, temp)
+            os.rename(temp, filename)
+            self._evict_disk()
+
+    def _insert(self, key, value):
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def get_cache(root, max_entries=None, disk=False, max_disk_entries=None):
+    '''
+    Make a QueryCache, optionally backed by the dataset's query/cache/,
+    from which results of older models are removed.
+    '''
+    dirname = None
+    fingerprint = None
+    if disk:
+        dirname = loom.store.get_paths(root)['query']['cache']
+        fingerprint = loom.store.get_fingerprint(root)
+    return QueryCache(max_entries, dirname, max_disk_entries, fingerprint)
+
+
 class QueryServer(object):
-    def __init__(self, protobuf_server):
+    def __init__(self, protobuf_server, cache=None):
         self.protobuf_server = protobuf_server
+        self.cache = cache
+        self._fingerprint = None
 
     @property
     def root(self):
@@ -133,28 +381,60 @@ class QueryServer(object):
     def __exit__(self, *unused):
         self.close()
 
-    def request(self):
-        request = Query.Request()
+    def request(self, message_type=Query.Request):
+        request = message_type()
         request.id = str(uuid.uuid4())
         return request
 
-    def sample(self, to_sample, conditioning_row=None, sample_count=None):
+    def _receive(self, request_id, message_type=Query.Response):
+        response = self.protobuf_server.receive(request_id, message_type)
+        if response.error:
+            raise Exception('\n'.join(response.error))
+        return response
+
+    def _call(self, request):
+        self.protobuf_server.send(request)
+        return self._receive(request.id)
+
+    def call_many(
+            self,
+            requests,
+            buffer_size=BUFFER_SIZE,
+            message_type=Query.Response):
+        '''
+        Pipeline requests, keeping up to buffer_size requests in flight.
+        Responses may arrive out of order; they are matched by id and
+        yielded in the order of requests, parsed as message_type.
+        '''
+        pending = deque()
+        for request in requests:
+            self.protobuf_server.send(request)
+            pending.append(request.id)
+            if len(pending) > buffer_size:
+                yield self._receive(pending.popleft(), message_type)
+        while pending:
+            yield self._receive(pending.popleft(), message_type)
+
+    def _fill_sample_request(
+            self,
+            message,
+            to_sample,
+            conditioning_row=None,
+            sample_count=None):
         if sample_count is None:
             sample_count = DEFAULTS['sample_sample_count']
         if conditioning_row is None:
             conditioning_row = [None for _ in to_sample]
         assert len(to_sample) == len(conditioning_row)
-        request = self.request()
-        data_row_to_protobuf(conditioning_row, request.sample.data)
-        request.sample.to_sample.sparsity = DENSE
-        request.sample.to_sample.dense[:] = to_sample
-        request.sample.sample_count = sample_count
-        self.protobuf_server.send(request)
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
+        data_row_to_protobuf(conditioning_row, message.data)
+        message.to_sample.sparsity = DENSE
+        message.to_sample.dense[:] = to_sample
+        message.sample_count = sample_count
+        return conditioning_row
+
+    def _parse_samples(self, to_sample, conditioning_row, message):
         samples = []
-        for sample in response.sample.samples:
+        for sample in message.samples:
             data_out = protobuf_to_data_row(sample)
             for i, val in enumerate(data_out):
                 if val is None:
@@ -163,42 +443,139 @@ class QueryServer(object):
             samples.append(data_out)
         return samples
 
-    def _send_score(self, row):
+    def sample(self, to_sample, conditioning_row=None, sample_count=None):
         request = self.request()
-        data_row_to_protobuf(row, request.score.data)
-        self.protobuf_server.send(request)
+        conditioning_row = self._fill_sample_request(
+            request.sample,
+            to_sample,
+            conditioning_row,
+            sample_count)
+        response = self._call(request)
+        return self._parse_samples(
+            to_sample,
+            conditioning_row,
+            response.sample)
 
-    def _receive_score(self):
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
-        return response.score.score
+    def batch_sample(self, entries, buffer_size=BUFFER_SIZE, chunk_size=None):
+        '''
+        Sample from a stream of entries (to_sample, conditioning_row,
+        sample_count), sending chunks of chunk_size entries per request
+        and keeping up to buffer_size requests in flight.
+        Yields one list of samples per entry.
+        '''
+        if chunk_size is None:
+            chunk_size = DEFAULTS['batch_sample_chunk_size']
+        pending = deque()
+
+        def requests():
+            for chunk in iter_chunks(entries, chunk_size):
+                request = self.request()
+                conditioned = []
+                for to_sample, conditioning_row, sample_count in chunk:
+                    conditioning_row = self._fill_sample_request(
+                        request.batch_sample.entries.add(),
+                        to_sample,
+                        conditioning_row,
+                        sample_count)
+                    conditioned.append((to_sample, conditioning_row))
+                pending.append(conditioned)
+                yield request
+
+        for response in self.call_many(requests(), buffer_size):
+            conditioned = pending.popleft()
+            messages = response.batch_sample.entries
+            assert len(messages) == len(conditioned), messages
+            for (to_sample, conditioning_row), message in izip(
+                    conditioned,
+                    messages):
+                yield self._parse_samples(to_sample, conditioning_row, message)
+
+    def batch_sample_encoded(
+            self,
+            conditioning_rows,
+            sample_count,
+            buffer_size=BUFFER_SIZE,
+            chunk_size=None):
+        '''
+        Like batch_sample, but for an EncodedRows block of conditioning
+        rows, sampling all of their unobserved features. Requests are
+        serialized from and responses are parsed into column-oriented blocks
+        in C++, without building python protobuf messages.
+        Returns an EncodedRows block with sample_count consecutive samples
+        per conditioning row, including the conditioning values.
+        '''
+        if chunk_size is None:
+            chunk_size = DEFAULTS['batch_sample_chunk_size']
+        row_count = conditioning_rows.row_count
+
+        def requests():
+            for begin in xrange(0, row_count, chunk_size):
+                end = min(row_count, begin + chunk_size)
+                request = self.request(loom.cFormat.Request)
+                request.add_batch_sample_entries(
+                    begin,
+                    end,
+                    sample_count,
+                    *conditioning_rows)
+                yield request
+
+        result = conditioning_rows.empty_like(row_count * sample_count)
+        responses = self.call_many(
+            requests(),
+            buffer_size,
+            loom.cFormat.Response)
+        end = 0
+        for response in responses:
+            end = response.batch_sample_load(end, sample_count, *result)
+        assert end == result.row_count, (end, result.row_count)
+        result.update(conditioning_rows.repeat(sample_count))
+        return result
+
+    def _score_request(self, row):
+        request = self.request()
+        data_row_to_protobuf(row, request.score.data)
+        return request
 
     def score(self, row):
-        self._send_score(row)
-        return self._receive_score()
+        response = self._call(self._score_request(row))
+        return response.score.score
 
-    def batch_score(self, rows, buffer_size=BUFFER_SIZE):
-        buffered = 0
+    def _batch_score_request(self, rows):
+        request = self.request()
         for row in rows:
-            self._send_score(row)
-            if buffered < buffer_size:
-                buffered += 1
-            else:
-                yield self._receive_score()
-        for _ in xrange(buffered):
-            yield self._receive_score()
+            data_row_to_protobuf(row, request.batch_score.data.add())
+        return request
 
-    def _entropy(
+    def batch_score(self, rows, buffer_size=BUFFER_SIZE, chunk_size=None):
+        '''
+        Score a stream of rows, sending chunks of chunk_size rows per request
+        and keeping up to buffer_size requests in flight.
+        '''
+        if chunk_size is None:
+            chunk_size = DEFAULTS['batch_score_chunk_size']
+        chunks = iter_chunks(rows, chunk_size)
+        requests = imap(self._batch_score_request, chunks)
+        for response in self.call_many(requests, buffer_size):
+            for score in response.batch_score.scores:
+                yield score
+
+    def _entropy_request(
             self,
             row_sets,
             col_sets,
             conditioning_row=None,
-            sample_count=None):
+            sample_count=None,
+            tile_size=None,
+            target_stderr=None,
+            time_budget=None,
+            max_sample_count=None):
         row_sets = list(set(map(frozenset, row_sets)) | set([frozenset()]))
         col_sets = list(set(map(frozenset, col_sets)) | set([frozenset()]))
         if sample_count is None:
             sample_count = DEFAULTS['entropy_sample_count']
+        if tile_size is None:
+            tile_size = DEFAULTS['tile_size']
+        assert tile_size > 0, tile_size
         request = self.request()
         if conditioning_row is None:
             none_to_protobuf(request.entropy.conditional)
@@ -209,19 +586,80 @@ class QueryServer(object):
         for feature_set in col_sets:
             feature_set_to_protobuf(feature_set, request.entropy.col_sets)
         request.entropy.sample_count = sample_count
-        self.protobuf_server.send(request)
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
-        means = response.entropy.means
-        variances = response.entropy.variances
+        request.entropy.tile_size = tile_size
+        if target_stderr is not None:
+            request.entropy.target_stderr = target_stderr
+        if time_budget is not None:
+            request.entropy.time_budget = time_budget
+        if max_sample_count is not None:
+            request.entropy.max_sample_count = max_sample_count
+        return request, row_sets, col_sets
+
+    def _entropy(
+            self,
+            row_sets,
+            col_sets,
+            conditioning_row=None,
+            sample_count=None,
+            tile_size=None,
+            **kwargs):
+        request, row_sets, col_sets = self._entropy_request(
+            row_sets,
+            col_sets,
+            conditioning_row,
+            sample_count,
+            tile_size,
+            **kwargs)
+        if self.cache is None:
+            response = self._call(request)
+            return self._parse_entropy(row_sets, col_sets, response)
+        key = self._cache_key('entropy', request.entropy)
+        result = self.cache.get(key)
+        if result is None:
+            response = self._call(request)
+            result = self._parse_entropy(row_sets, col_sets, response)
+            self.cache.put(key, result)
+        return result
+
+    @staticmethod
+    def _canonical_string(message):
+        '''
+        Requests are canonical up to the order of feature sets,
+        which we sort here.
+        '''
+        message = message.__class__.FromString(message.SerializeToString())
+        for field in ['row_sets', 'col_sets']:
+            if message.DESCRIPTOR.fields_by_name.get(field):
+                feature_sets = getattr(message, field)
+                strings = sorted(f.SerializeToString() for f in feature_sets)
+                del feature_sets[:]
+                for string in strings:
+                    feature_sets.add().ParseFromString(string)
+        return message.SerializeToString()
+
+    def _cache_key(self, name, message):
+        if self._fingerprint is None:
+            assert self.root is not None, 'caching requires a root'
+            self._fingerprint = loom.store.get_fingerprint(self.root)
+        return (self._fingerprint, name, self._canonical_string(message))
+
+    def _parse_entropy(self, row_sets, col_sets, response):
+        return self._parse_entropy_message(
+            row_sets,
+            col_sets,
+            response.entropy)
+
+    def _parse_entropy_message(self, row_sets, col_sets, message):
+        means = message.means
+        variances = message.variances
+        sample_counts = message.sample_counts
         size = len(row_sets) * len(col_sets)
         assert len(means) == size, means
         assert len(variances) == size, variances
-        means = iter(means)
-        variances = iter(variances)
+        assert len(sample_counts) == size, sample_counts
+        estimates = imap(Estimate, means, variances, sample_counts)
         return {
-            row_set | col_set: Estimate(means.next(), variances.next())
+            row_set | col_set: estimates.next()
             for row_set in row_sets
             for col_set in col_sets
         }
@@ -232,23 +670,91 @@ class QueryServer(object):
             col_sets,
             conditioning_row=None,
             sample_count=None,
-            tile_size=None):
-        if tile_size is None:
-            tile_size = DEFAULTS['tile_size']
-        min_size = max(1, min(tile_size, len(row_sets), len(col_sets)))
-        tile_size = tile_size * tile_size / min_size
-        assert tile_size > 0, tile_size
-        result = {}
-        for i in xrange(0, len(row_sets), tile_size):
-            row_tile = row_sets[i: i + tile_size]
-            for j in xrange(0, len(col_sets), tile_size):
-                col_tile = col_sets[j: j + tile_size]
-                result.update(self._entropy(
-                    row_tile,
-                    col_tile,
-                    conditioning_row,
-                    sample_count))
-        return result
+            tile_size=None,
+            target_stderr=None,
+            time_budget=None,
+            max_sample_count=None):
+        '''
+        Estimate entropies of all unions of a row_set and a col_set.
+        The server scores at most tile_size^2 unions at a time, to bound
+        memory, but draws one set of samples shared by all of them.
+
+        By default sample_count samples are drawn. Given a target_stderr
+        or a time_budget in seconds, the server instead draws rounds of
+        sample_count samples, resampling only unions whose standard error
+        exceeds target_stderr, until all meet it, the time budget is
+        spent, or max_sample_count samples are drawn. Each Estimate
+        reports its sample_count.
+        '''
+        return self._entropy(
+            row_sets,
+            col_sets,
+            conditioning_row,
+            sample_count,
+            tile_size,
+            target_stderr=target_stderr,
+            time_budget=time_budget,
+            max_sample_count=max_sample_count)
+
+    def entropy_many(
+            self,
+            queries,
+            sample_count=None,
+            tile_size=None,
+            buffer_size=BUFFER_SIZE,
+            chunk_size=None):
+        '''
+        Evaluate a list of (row_sets, col_sets, conditioning_row) entropy
+        queries, sending the uncached ones as pipelined batch_entropy
+        requests of up to chunk_size queries each, which may differ in
+        their conditioning rows. Identical queries, up to the order of
+        feature sets, are sent once and share their result. Returns a list
+        of results as from entropy().
+        '''
+        if chunk_size is None:
+            chunk_size = DEFAULTS['batch_entropy_chunk_size']
+        results = [None] * len(queries)
+        pending = {}
+        for i, (row_sets, col_sets, conditioning_row) in enumerate(queries):
+            request, row_sets, col_sets = self._entropy_request(
+                row_sets,
+                col_sets,
+                conditioning_row,
+                sample_count,
+                tile_size)
+            canonical = self._canonical_string(request.entropy)
+            if canonical in pending:
+                pending[canonical][0].append(i)
+                continue
+            key = None
+            if self.cache is not None:
+                key = self._cache_key('entropy', request.entropy)
+                results[i] = self.cache.get(key)
+            if results[i] is None:
+                pending[canonical] = ([i], key, row_sets, col_sets, request)
+        chunks = list(iter_chunks(pending.values(), chunk_size))
+
+        def requests():
+            for chunk in chunks:
+                request = self.request()
+                for _, _, _, _, entry in chunk:
+                    request.batch_entropy.entries.add().MergeFrom(
+                        entry.entropy)
+                yield request
+
+        responses = self.call_many(requests(), buffer_size)
+        for chunk, response in izip(chunks, responses):
+            entries = response.batch_entropy.entries
+            assert len(entries) == len(chunk), response
+            for (indices, key, row_sets, col_sets, _), entry in izip(
+                    chunk,
+                    entries):
+                result = self._parse_entropy_message(row_sets, col_sets, entry)
+                for i in indices:
+                    results[i] = result
+                if key is not None:
+                    self.cache.put(key, result)
+        return results
 
     def mutual_information(
             self,
@@ -256,10 +762,14 @@ class QueryServer(object):
             feature_set2,
             entropys=None,
             conditioning_row=None,
-            sample_count=None):
+            sample_count=None,
+            target_stderr=None,
+            time_budget=None,
+            max_sample_count=None):
         '''
         Estimate the mutual information between feature_set1
-        and feature_set2 conditioned on conditioning_row
+        and feature_set2 conditioned on conditioning_row.
+        See entropy() for target_stderr, time_budget and max_sample_count.
         '''
         if not isinstance(feature_set1, frozenset):
             feature_set1 = frozenset(feature_set1)
@@ -268,27 +778,43 @@ class QueryServer(object):
 
         if sample_count is None:
             sample_count = DEFAULTS['mutual_information_sample_count']
-        feature_union = frozenset.union(feature_set1, feature_set2)
 
         if entropys is None:
             entropys = self.entropy(
                 [feature_set1],
                 [feature_set2],
                 conditioning_row,
-                sample_count)
-        mi = entropys[feature_set1].mean \
-            + entropys[feature_set2].mean \
-            - entropys[feature_union].mean
-        variance = entropys[feature_set1].variance \
-            + entropys[feature_set2].variance \
-            + entropys[feature_union].variance
-        return Estimate(mi, variance)
+                sample_count,
+                target_stderr=target_stderr,
+                time_budget=time_budget,
+                max_sample_count=max_sample_count)
+        return get_mutual_information(feature_set1, feature_set2, entropys)
 
     def score_derivative(
             self,
             update_row,
             score_rows=None,
-            row_limit=None):
+            row_limit=None,
+            exact=False):
+        '''
+        Find rows whose score changes most when update_row is added.
+        Unless exact or score_rows is given, the server restricts the search
+        to candidate rows that share groups with update_row.
+        '''
+        request = self._score_derivative_request(
+            update_row,
+            score_rows,
+            row_limit,
+            exact)
+        response = self._call(request)
+        return self._parse_score_derivative(response)
+
+    def _score_derivative_request(
+            self,
+            update_row,
+            score_rows=None,
+            row_limit=None,
+            exact=False):
         row = Row()
         request = self.request()
         if row_limit is None:
@@ -302,20 +828,515 @@ class QueryServer(object):
                 added_diff.MergeFrom(row.diff)
 
         request.score_derivative.row_limit = row_limit
+        request.score_derivative.exact = exact
         data_row_to_protobuf(
             update_row,
             row.diff)
         request.score_derivative.update_data.MergeFrom(row.diff)
+        return request
 
-        self.protobuf_server.send(request)
-        response = self.protobuf_server.receive()
-        if response.error:
-            raise Exception('\n'.join(response.error))
+    def _parse_score_derivative(self, response):
         ids = response.score_derivative.ids
         score_diffs = response.score_derivative.score_diffs
         return zip(ids, score_diffs)
 
 
+def gather_futures(futures, combine):
+    '''
+    Return a future for combine(results) once all futures are done.
+    '''
+    futures = list(futures)
+    result = Future()
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def done(unused):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            result.set_result(combine([f.result() for f in futures]))
+        except Exception as e:
+            result.set_exception(e)
+
+    if futures:
+        for future in futures:
+            future.add_done_callback(done)
+    else:
+        result.set_result(combine([]))
+    return result
+
+
+class AsyncQueryServer(object):
+    '''
+    A non-blocking query client. Each method sends its request immediately
+    and returns a concurrent.futures.Future; a reader thread resolves
+    futures as responses arrive, matched by Query.Response.id, so many
+    requests can be in flight at once.
+
+    Under asyncio, await asyncio.wrap_future(future).
+
+    Usage:
+
+        with loom.query.get_async_server(root) as server:
+            futures = [server.score(row) for row in rows]
+            scores = [future.result() for future in futures]
+    '''
+    def __init__(self, protobuf_server):
+        self.protobuf_server = protobuf_server
+        self._server = QueryServer(protobuf_server)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = threading.Condition(self._lock)
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_responses)
+        self._reader.daemon = True
+        self._reader.start()
+
+    @property
+    def root(self):
+        return self.protobuf_server.root
+
+    @property
+    def queue_depth(self):
+        '''
+        The number of requests awaiting responses.
+        '''
+        with self._lock:
+            return len(self._futures)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._pending.notify()
+        self._reader.join()
+        self.protobuf_server.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+    def _read_responses(self):
+        # only read while responses are owed, so we never block on EOF
+        while True:
+            with self._lock:
+                while not self._futures and not self._closed:
+                    self._pending.wait()
+                if not self._futures:
+                    return
+            try:
+                response = self.protobuf_server.receive()
+            except Exception as e:
+                with self._lock:
+                    futures = self._futures.values()
+                    self._futures.clear()
+                for future, _ in futures:
+                    future.set_exception(e)
+                return
+            with self._lock:
+                future, parse = self._futures.pop(response.id, (None, None))
+            if future is None:
+                continue
+            if response.error:
+                future.set_exception(Exception('\n'.join(response.error)))
+                continue
+            try:
+                future.set_result(parse(response))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _submit(self, request, parse):
+        future = Future()
+        with self._lock:
+            assert not self._closed, 'server is closed'
+            self._futures[request.id] = (future, parse)
+            self._pending.notify()
+        with self._send_lock:
+            self.protobuf_server.send(request)
+        return future
+
+    def sample(self, to_sample, conditioning_row=None, sample_count=None):
+        request = self._server.request()
+        conditioning_row = self._server._fill_sample_request(
+            request.sample,
+            to_sample,
+            conditioning_row,
+            sample_count)
+        return self._submit(request, lambda response: (
+            self._server._parse_samples(
+                to_sample,
+                conditioning_row,
+                response.sample)))
+
+    def score(self, row):
+        request = self._server._score_request(row)
+        return self._submit(request, lambda response: response.score.score)
+
+    def batch_score(self, rows):
+        request = self._server._batch_score_request(rows)
+        return self._submit(request, lambda response: (
+            list(response.batch_score.scores)))
+
+    def entropy(
+            self,
+            row_sets,
+            col_sets,
+            conditioning_row=None,
+            sample_count=None,
+            tile_size=None,
+            target_stderr=None,
+            time_budget=None,
+            max_sample_count=None):
+        request, row_sets, col_sets = self._server._entropy_request(
+            row_sets,
+            col_sets,
+            conditioning_row,
+            sample_count,
+            tile_size,
+            target_stderr=target_stderr,
+            time_budget=time_budget,
+            max_sample_count=max_sample_count)
+        parse = partial(self._server._parse_entropy, row_sets, col_sets)
+        return self._submit(request, parse)
+
+    def mutual_information(
+            self,
+            feature_set1,
+            feature_set2,
+            conditioning_row=None,
+            sample_count=None,
+            target_stderr=None,
+            time_budget=None,
+            max_sample_count=None):
+        feature_set1 = frozenset(feature_set1)
+        feature_set2 = frozenset(feature_set2)
+        if sample_count is None:
+            sample_count = DEFAULTS['mutual_information_sample_count']
+        future = self.entropy(
+            [feature_set1],
+            [feature_set2],
+            conditioning_row,
+            sample_count,
+            target_stderr=target_stderr,
+            time_budget=time_budget,
+            max_sample_count=max_sample_count)
+        return gather_futures([future], lambda results: (
+            get_mutual_information(feature_set1, feature_set2, results[0])))
+
+    def score_derivative(
+            self,
+            update_row,
+            score_rows=None,
+            row_limit=None,
+            exact=False):
+        request = self._server._score_derivative_request(
+            update_row,
+            score_rows,
+            row_limit,
+            exact)
+        return self._submit(request, self._server._parse_score_derivative)
+
+
+def merge_scores(scores, weights):
+    '''
+    Merge per-shard scores, each the log mean probability over a shard's
+    samples, into the log mean probability over all samples.
+    '''
+    weights = numpy.array(weights, dtype=numpy.float64)
+    scores = numpy.array(scores, dtype=numpy.float64)
+    shift = scores.max()
+    total = numpy.dot(weights, numpy.exp(scores - shift))
+    return float(shift + numpy.log(total / weights.sum()))
+
+
+class QueryServerPool(object):
+    '''
+    A pool of worker_count loom_query processes, each wrapped in an
+    AsyncQueryServer. Methods return futures, as in AsyncQueryServer.
+
+    By default every worker loads all samples, and each call goes to the
+    worker with the fewest requests in flight. With shard=True, samples are
+    instead split among workers, so each loads only its share: scores are
+    merged by sample-weighted log-sum-exp, sample counts are allocated to
+    shards in proportion to their samples times the probability of the
+    conditioning row, and entropy is estimated by sampling and scoring
+    across shards.
+
+    Usage:
+
+        with loom.query.QueryServerPool(root, 4) as pool:
+            futures = [pool.score(row) for row in rows]
+            scores = [future.result() for future in futures]
+    '''
+    def __init__(
+            self,
+            root,
+            worker_count,
+            config=None,
+            shard=False,
+            debug=False,
+            profile=None):
+        assert worker_count > 0, worker_count
+        self.root = root
+        self.shard = shard
+        if config is None:
+            config = loom.store.get_paths(root)['query']['config']
+        paths = loom.store.get_paths(root, sample_count=None)
+        sample_count = len(paths['samples'])
+        self._tempdir = tempfile.mkdtemp()
+        message = Config()
+        with open_compressed(config, 'rb') as f:
+            message.ParseFromString(f.read())
+        seed = message.seed
+        self._rng = numpy.random.RandomState(seed)
+        cross_cat = CrossCat()
+        with open_compressed(paths['samples'][0]['model'], 'rb') as f:
+            cross_cat.ParseFromString(f.read())
+        self.feature_count = sum(len(k.featureids) for k in cross_cat.kinds)
+        self._executor = ThreadPoolExecutor(max_workers=worker_count)
+        self.workers = []
+        self.weights = []
+        try:
+            for i in xrange(worker_count):
+                worker_root = root
+                if shard:
+                    seeds = range(i, sample_count, worker_count)
+                    assert seeds, 'more shards than samples'
+                    worker_root = os.path.join(
+                        self._tempdir,
+                        'shard.{}'.format(i))
+                    loom.store.link_shard(paths['root'], worker_root, seeds)
+                    self.weights.append(len(seeds))
+                else:
+                    self.weights.append(sample_count)
+                # workers get distinct seeds so their samples are independent
+                worker_config = os.path.join(
+                    self._tempdir,
+                    'config.{}.pb.gz'.format(i))
+                message.seed = seed + i
+                with open_compressed(worker_config, 'wb') as f:
+                    f.write(message.SerializeToString())
+                protobuf_server = ProtobufServer(
+                    worker_root,
+                    worker_config,
+                    debug,
+                    profile)
+                self.workers.append(AsyncQueryServer(protobuf_server))
+        except:
+            self.close()
+            raise
+
+    def queue_depths(self):
+        '''
+        The number of requests in flight at each worker.
+        '''
+        return [worker.queue_depth for worker in self.workers]
+
+    def close(self):
+        self._executor.shutdown()
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+        shutil.rmtree(self._tempdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+    def _least_loaded(self):
+        depths = self.queue_depths()
+        return self.workers[depths.index(min(depths))]
+
+    def score(self, row):
+        if not self.shard:
+            return self._least_loaded().score(row)
+        futures = [worker.score(row) for worker in self.workers]
+        return gather_futures(futures, lambda scores: (
+            merge_scores(scores, self.weights)))
+
+    def batch_score(self, rows):
+        if not self.shard:
+            return self._least_loaded().batch_score(rows)
+        rows = list(rows)
+        futures = [worker.batch_score(rows) for worker in self.workers]
+        return gather_futures(futures, lambda results: [
+            merge_scores(scores, self.weights)
+            for scores in izip(*results)
+        ])
+
+    def sample(self, to_sample, conditioning_row=None, sample_count=None):
+        if not self.shard:
+            return self._least_loaded().sample(
+                to_sample,
+                conditioning_row,
+                sample_count)
+        return self._executor.submit(
+            self._sharded_sample,
+            to_sample,
+            conditioning_row,
+            sample_count)
+
+    def _sharded_sample(self, to_sample, conditioning_row, sample_count):
+        # The posterior over shards given the condition is proportional to
+        # each shard's samples times its probability of the condition.
+        if sample_count is None:
+            sample_count = DEFAULTS['sample_sample_count']
+        log_probs = numpy.log(numpy.array(self.weights, dtype=numpy.float64))
+        if conditioning_row is not None:
+            futures = [
+                worker.score(conditioning_row)
+                for worker in self.workers
+            ]
+            log_probs += [future.result() for future in futures]
+        probs = numpy.exp(log_probs - log_probs.max())
+        probs /= probs.sum()
+        counts = self._rng.multinomial(sample_count, probs)
+        futures = [
+            worker.sample(to_sample, conditioning_row, int(count))
+            for worker, count in izip(self.workers, counts)
+            if count
+        ]
+        return list(chain.from_iterable(f.result() for f in futures))
+
+    def entropy(
+            self,
+            row_sets,
+            col_sets,
+            conditioning_row=None,
+            sample_count=None,
+            tile_size=None,
+            target_stderr=None,
+            time_budget=None,
+            max_sample_count=None):
+        if not self.shard:
+            return self._least_loaded().entropy(
+                row_sets,
+                col_sets,
+                conditioning_row,
+                sample_count,
+                tile_size,
+                target_stderr=target_stderr,
+                time_budget=time_budget,
+                max_sample_count=max_sample_count)
+
+        adaptive = [target_stderr, time_budget, max_sample_count]
+        if any(arg is not None for arg in adaptive):
+            raise ValueError(
+                'target_stderr, time_budget and max_sample_count '
+                'are not supported by a sharded QueryServerPool')
+        return self._executor.submit(
+            self._sharded_entropy,
+            row_sets,
+            col_sets,
+            conditioning_row,
+            sample_count,
+            tile_size)
+
+    def _sharded_entropy(
+            self,
+            row_sets,
+            col_sets,
+            conditioning_row,
+            sample_count,
+            tile_size):
+        # As in the server: sample all features at once, then score each
+        # sample restricted to each feature set, relative to the condition,
+        # at most tile_size^2 feature sets at a time. Each feature set costs
+        # sample_count full rows in client memory, so tiles are further
+        # bounded to about batch_score_chunk_size rows.
+        if sample_count is None:
+            sample_count = DEFAULTS['entropy_sample_count']
+        if tile_size is None:
+            tile_size = DEFAULTS['tile_size']
+        assert tile_size > 0, tile_size
+        row_sets = list(set(map(frozenset, row_sets)) | set([frozenset()]))
+        col_sets = list(set(map(frozenset, col_sets)) | set([frozenset()]))
+        tasks = list(set(r | c for r in row_sets for c in col_sets))
+        if conditioning_row is None:
+            conditioning_row = [None] * self.feature_count
+        to_sample = [False] * self.feature_count
+        for task in tasks:
+            for f in task:
+                to_sample[f] = True
+        base = self.score(conditioning_row)
+        samples = self._sharded_sample(
+            to_sample,
+            conditioning_row,
+            sample_count)
+        scores = numpy.zeros((sample_count, len(tasks)))
+        tile_task_count = max(1, min(
+            tile_size * tile_size,
+            DEFAULTS['batch_score_chunk_size'] // sample_count))
+        for begin in xrange(0, len(tasks), tile_task_count):
+            tile = tasks[begin: begin + tile_task_count]
+            rows = [
+                [
+                    value if f in task else conditioning_row[f]
+                    for f, value in enumerate(sample)
+                ]
+                for sample in samples
+                for task in tile
+            ]
+            tile_scores = numpy.array(self.batch_score(rows).result())
+            scores[:, begin: begin + len(tile)] = \
+                tile_scores.reshape((sample_count, len(tile)))
+        scores = base.result() - scores
+        if sample_count > 1:
+            variances = scores.var(axis=0, ddof=1) / sample_count
+        else:
+            variances = numpy.inf * numpy.ones(len(tasks))
+        return {
+            task: Estimate(
+                float(scores[:, t].mean()),
+                float(variances[t]),
+                sample_count)
+            for t, task in enumerate(tasks)
+        }
+
+    def mutual_information(
+            self,
+            feature_set1,
+            feature_set2,
+            conditioning_row=None,
+            sample_count=None,
+            target_stderr=None,
+            time_budget=None,
+            max_sample_count=None):
+        feature_set1 = frozenset(feature_set1)
+        feature_set2 = frozenset(feature_set2)
+        if sample_count is None:
+            sample_count = DEFAULTS['mutual_information_sample_count']
+        future = self.entropy(
+            [feature_set1],
+            [feature_set2],
+            conditioning_row,
+            sample_count,
+            target_stderr=target_stderr,
+            time_budget=time_budget,
+            max_sample_count=max_sample_count)
+        return gather_futures([future], lambda results: (
+            get_mutual_information(feature_set1, feature_set2, results[0])))
+
+    def score_derivative(
+            self,
+            update_row,
+            score_rows=None,
+            row_limit=None,
+            exact=False):
+        assert not self.shard, 'score_derivative needs all samples'
+        return self._least_loaded().score_derivative(
+            update_row,
+            score_rows,
+            row_limit,
+            exact)
+
+
 class ProtobufServer(object):
     def __init__(self, root, config=None, debug=False, profile=None):
         self.root = root
@@ -326,19 +1347,47 @@ class ProtobufServer(object):
             debug=debug,
             profile=profile,
             block=False)
+        self._pipe_in = self.proc.stdin
+        self._pipe_out = self.proc.stdout
+        self._responses = {}
 
     def send(self, request):
-        assert isinstance(request, Query.Request), request
+        '''
+        Send a Query.Request, either a python protobuf message or a
+        loom.cFormat.Request built in C++.
+        '''
+        assert isinstance(request, (Query.Request, loom.cFormat.Request)),\
+            request
         request_string = request.SerializeToString()
-        protobuf_stream_write(request_string, self.proc.stdin)
-        self.proc.stdin.flush()
+        protobuf_stream_write(request_string, self._pipe_in)
+        self._pipe_in.flush()
 
-    def receive(self):
-        response_string = protobuf_stream_read(self.proc.stdout)
-        response = Query.Response()
+    def _read(self, message_type=Query.Response):
+        response_string = protobuf_stream_read(self._pipe_out)
+        response = message_type()
         response.ParseFromString(response_string)
         return response
 
+    def receive(self, request_id=None, message_type=Query.Response):
+        '''
+        Receive the next response, or the response to a given request_id,
+        parsed as message_type, either Query.Response or the C++
+        loom.cFormat.Response. Responses to other requests that arrive in
+        the meantime are parsed the same way and buffered until they are
+        asked for.
+        '''
+        if request_id is None:
+            if self._responses:
+                return self._responses.popitem()[1]
+            return self._read(message_type)
+        response = self._responses.pop(request_id, None)
+        while response is None:
+            response = self._read(message_type)
+            if response.id != request_id:
+                self._responses[response.id] = response
+                response = None
+        return response
+
     def close(self):
         self.proc.stdin.close()
         self.proc.wait()
@@ -350,6 +1399,99 @@ class ProtobufServer(object):
         self.close()
 
 
-def get_server(root, config=None, debug=False, profile=None):
+def open_socket(address):
+    '''
+    Connect to a socket address unix:PATH, tcp:HOST:PORT, or a bare PATH.
+    '''
+    if address.startswith('tcp:'):
+        host, port = address[len('tcp:'):].rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        if address.startswith('unix:'):
+            address = address[len('unix:'):]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    return sock
+
+
+class SocketProtobufServer(ProtobufServer):
+    '''
+    A session on a query server listening on a socket,
+    either loom_query serving many clients or a forked loom_serve child.
+    '''
+    def __init__(self, root, address):
+        self.root = root
+        self._socket = open_socket(address)
+        self._pipe_in = self._socket.makefile('wb')
+        self._pipe_out = self._socket.makefile('rb')
+        self._responses = {}
+
+    def close(self):
+        self._pipe_in.close()
+        self._socket.shutdown(socket.SHUT_WR)
+        self._pipe_out.read()  # wait for the child to finish
+        self._pipe_out.close()
+        self._socket.close()
+
+
+class ForkServer(object):
+    '''
+    A loom_serve process that loads a model once and forks a
+    copy-on-write child for each connected session.
+
+    Usage:
+
+        with loom.query.ForkServer(root) as fork_server:
+            with fork_server.connect() as server:
+                server.entropy(...)
+    '''
+    def __init__(self, root, config=None, debug=False, profile=None):
+        self.root = root
+        self._tempdir = tempfile.mkdtemp()
+        self.address = os.path.join(self._tempdir, 'socket')
+        self.proc = loom.runner.serve(
+            root_in=root,
+            address=self.address,
+            config_in=config,
+            log_out=None,
+            debug=debug,
+            profile=profile,
+            block=False)
+        while not os.path.exists(self.address):
+            assert self.proc.poll() is None, 'loom_serve failed to start'
+            time.sleep(0.01)
+
+    def connect(self):
+        protobuf_server = SocketProtobufServer(self.root, self.address)
+        return QueryServer(protobuf_server)
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+        shutil.rmtree(self._tempdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+
+def get_server(root, config=None, debug=False, profile=None, cache=None):
     protobuf_server = ProtobufServer(root, config, debug, profile)
+    return QueryServer(protobuf_server, cache)
+
+
+def get_async_server(root, config=None, debug=False, profile=None):
+    protobuf_server = ProtobufServer(root, config, debug, profile)
+    return AsyncQueryServer(protobuf_server)
+
+
+def connect(address, root=None):
+    '''
+    Connect to a query server started with
+    loom.runner.query(root, requests_in=address, block=False).
+    '''
+    protobuf_server = SocketProtobufServer(root, address)
     return QueryServer(protobuf_server)
@@ -119,6 +119,10 @@ def optional_file(filename):
     return '--none' if filename is None else filename
 
 
+def is_socket_address(address):
+    return address.startswith('unix:') or address.startswith('tcp:')
+
+
 @parsable.command
 def profilers():
     '''
@@ -184,14 +188,19 @@ def shuffle(
         profile=None):
     '''
     Shuffle a dataset for inference.
+    If rows_out is a list of filenames, rows_in is read once and
+    rows_out[i] is shuffled with seed + i.
     '''
-    assert rows_in != rows_out, 'cannot shuffle rows in-place'
+    if isinstance(rows_out, basestring):
+        rows_out = [rows_out]
+    assert rows_in not in rows_out, 'cannot shuffle rows in-place'
     check_call_files(
-        command=['shuffle', rows_in, rows_out, seed, target_mem_bytes],
+        command=['shuffle', rows_in, ','.join(rows_out), seed,
+                 target_mem_bytes],
         debug=debug,
         profile=profile,
         infiles=[rows_in],
-        outfiles=[rows_out])
+        outfiles=rows_out)
 
 
 @parsable.command
@@ -355,6 +364,8 @@ def query(
         block=True):
     '''
     Run query server from a trained model.
+    requests_in may be a socket address unix:PATH or tcp:HOST:PORT,
+    in which case the server listens for many clients until killed.
     '''
     log_out = optional_file(log_out)
     if config_in is None:
@@ -368,15 +379,52 @@ def query(
         responses_out,
         log_out]
     infiles = [root_in, requests_in]
-    if block:
+    if block and is_socket_address(requests_in):
+        assert_found([root_in])
+        check_call(command, debug, profile)
+    elif block:
         check_call_files(
             command=command,
             debug=debug,
             profile=profile,
             infiles=infiles,
             outfiles=[responses_out, log_out])
+    elif is_socket_address(requests_in):
+        assert responses_out == '-', 'socket servers respond on the socket'
+        assert_found([root_in])
+        return popen_piped(command, debug, profile)
     else:
         assert requests_in == '-', 'cannot pipe requests'
         assert responses_out == '-', 'cannot pipe responses'
         assert_found(infiles)
         return popen_piped(command, debug, profile)
+
+
+@parsable.command
+def serve(
+        root_in,
+        address,
+        config_in=None,
+        log_out=None,
+        debug=False,
+        profile=None,
+        block=True):
+    '''
+    Run a forking query server listening on a unix socket at address.
+    '''
+    log_out = optional_file(log_out)
+    if config_in is None:
+        config_in = loom.store.get_paths(root_in)['query']['config']
+    assert os.path.exists(config_in)
+    command = ['serve', root_in, config_in, address, log_out]
+    infiles = [root_in, config_in]
+    if block:
+        check_call_files(
+            command=command,
+            debug=debug,
+            profile=profile,
+            infiles=infiles,
+            outfiles=[log_out])
+    else:
+        assert_found(infiles)
+        return popen_piped(command, debug, profile)
@@ -25,6 +25,7 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
 import os
 import sys
 
@@ -66,6 +67,8 @@ BASENAMES = {
     'query': {
         'config': 'config.pb.gz',
         'query_log': 'query_log.pbs',
+        'cache': 'cache',
+        'related': 'related.bin',
     },
 }
 
@@ -101,6 +104,63 @@ def get_sample_path(root, seed):
     return os.path.join(root, 'samples', 'sample.{:d}'.format(seed))
 
 
+def get_snapshot_path(root):
+    '''
+    This must match loom::store::get_snapshot_path(-) in src/store.hpp
+    '''
+    return os.path.join(root, 'query', 'snapshot')
+
+
+def link_shard(root, destin, seeds):
+    '''
+    Make destin look like a dataset root containing only the given samples
+    of root, renumbered from 0, by symlinking into root.
+    '''
+    root = os.path.abspath(root)
+    os.makedirs(os.path.join(destin, 'samples'))
+    os.symlink(os.path.join(root, 'ingest'), os.path.join(destin, 'ingest'))
+    snapshot = get_snapshot_path(root)
+    has_snapshot = os.path.exists(snapshot)
+    if has_snapshot:
+        os.makedirs(os.path.join(get_snapshot_path(destin), 'samples'))
+        if os.path.exists(os.path.join(snapshot, 'ingest')):
+            os.symlink(
+                os.path.join(snapshot, 'ingest'),
+                os.path.join(get_snapshot_path(destin), 'ingest'))
+    for destin_seed, seed in enumerate(seeds):
+        os.symlink(
+            get_sample_path(root, seed),
+            get_sample_path(destin, destin_seed))
+        if has_snapshot and os.path.exists(get_sample_path(snapshot, seed)):
+            os.symlink(
+                get_sample_path(snapshot, seed),
+                get_sample_path(get_snapshot_path(destin), destin_seed))
+
+
+def get_fingerprint(root):
+    '''
+    Return a hex digest that changes whenever the model files change,
+    based on the names, sizes and mtimes of the ingest and sample files.
+    '''
+    paths = get_paths(root)
+    root = paths['root']
+    stats = []
+    for filename in [paths['ingest']['tares'], paths['ingest']['schema_row']]:
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            name = os.path.relpath(filename, root)
+            stats.append((name, stat.st_size, stat.st_mtime))
+    samples = os.path.join(root, 'samples')
+    for dirname, dirnames, filenames in os.walk(samples, followlinks=True):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filename = os.path.join(dirname, filename)
+            stat = os.stat(filename)
+            name = os.path.relpath(filename, root)
+            stats.append((name, stat.st_size, stat.st_mtime))
+    return hashlib.sha1(repr(stats)).hexdigest()
+
+
 def join_paths(*args):
     args, paths = args[:-1], args[-1]
     return {
@@ -116,10 +176,10 @@ def in_dir(paths, directory, fname):
 
 def get_paths(root, sample_count=1):
     assert sample_count >= 0 or sample_count is None, sample_count
-    if sample_count is None:
-        sample_count = len(os.listdir(os.path.join(root, 'samples')))
     if not os.path.isabs(root):
         root = os.path.join(STORE, root)
+    if sample_count is None:
+        sample_count = len(os.listdir(os.path.join(root, 'samples')))
     paths = {'root': root}
     paths['ingest'] = join_paths(root, 'ingest', BASENAMES['ingest'])
     paths['consensus'] = join_paths(root, 'consensus', BASENAMES['consensus'])
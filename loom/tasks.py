@@ -27,15 +27,18 @@
 
 import os
 import copy
+import shutil
 from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
-from distributions.io.stream import protobuf_stream_load
 from loom.util import LOG
 from loom.util import LoomError
 from loom.util import parallel_map
+from loom.util import mkdir_p
+from loom.util import rm_rf
 import loom
 import loom.transforms
 import loom.format
+import loom.cFormat
 import loom.generate
 import loom.config
 import loom.consensus
@@ -158,7 +161,7 @@ def ingest(
         tares_out=paths['ingest']['tares'],
         debug=debug)
 
-    tare_count = sum(1 for _ in protobuf_stream_load(paths['ingest']['tares']))
+    tare_count = loom.cFormat.protobuf_stream_count(paths['ingest']['tares'])
     LOG('sparsifying rows WRT {} tare rows'.format(tare_count))
     loom.runner.sparsify(
         schema_row_in=paths['ingest']['schema_row'],
@@ -174,7 +177,8 @@ def infer(
         name,
         sample_count=DEFAULTS['sample_count'],
         config=None,
-        debug=False):
+        debug=False,
+        related=False):
     '''
     Infer samples in parallel.
     Arguments:
@@ -183,23 +187,39 @@ def infer(
         config          An optional json config file, e.g.,
                             {"schedule": {"extra_passes": 500.0}}
         debug           Whether to run debug versions of C++ code
+        related         Whether to materialize relatedness of all pairs of
+                            features afterwards, see materialize_related;
+                            this scores O(features^2) pairs
     Environment variables:
         LOOM_THREADS    Number of concurrent inference tasks
         LOOM_VERBOSITY  Verbosity level
     '''
     if not (sample_count >= 1):
         raise LoomError('Too few samples: {}'.format(sample_count))
+    paths = loom.store.get_paths(name, sample_count=sample_count)
+
+    LOG('shuffling rows')
+    loom.runner.shuffle(
+        rows_in=paths['ingest']['diffs'],
+        rows_out=[sample['shuffled'] for sample in paths['samples']],
+        seed=0,
+        debug=debug)
+
+    shuffle = False
     parallel_map(_infer_one, [
-        (name, seed, config, debug) for seed in xrange(sample_count)
+        (name, seed, config, debug, shuffle) for seed in xrange(sample_count)
     ])
 
+    if related:
+        materialize_related(name, debug=debug)
+
 
 def _infer_one(args):
     infer_one(*args)
 
 
 @parsable.command
-def infer_one(name, seed=0, config=None, debug=False):
+def infer_one(name, seed=0, config=None, debug=False, shuffle=True):
     '''
     Infer a single sample.
     Arguments:
@@ -208,6 +228,8 @@ def infer_one(name, seed=0, config=None, debug=False):
         config          An optional json config file, e.g.,
                             {"schedule": {"extra_passes": 500.0}}
         debug           Whether to run debug versions of C++ code
+        shuffle         Whether to shuffle rows, or reuse existing
+                            shuffled rows, e.g. as written by infer
     Environment variables:
         LOOM_VERBOSITY  Verbosity level
     '''
@@ -232,12 +254,13 @@ def infer_one(name, seed=0, config=None, debug=False):
         model_out=sample['init'],
         seed=seed)
 
-    LOG('shuffling rows')
-    loom.runner.shuffle(
-        rows_in=paths['ingest']['diffs'],
-        rows_out=sample['shuffled'],
-        seed=seed,
-        debug=debug)
+    if shuffle:
+        LOG('shuffling rows')
+        loom.runner.shuffle(
+            rows_in=paths['ingest']['diffs'],
+            rows_out=sample['shuffled'],
+            seed=seed,
+            debug=debug)
 
     LOG('inferring, watch {}'.format(sample['infer_log']))
     loom.runner.infer(
@@ -252,6 +275,31 @@ def infer_one(name, seed=0, config=None, debug=False):
         debug=debug)
 
 
+@parsable.command
+def materialize_related(
+        name,
+        sample_count=loom.preql.SAMPLE_COUNT,
+        debug=False):
+    '''
+    Materialize the unconditional relatedness of all pairs of features,
+    so that PreQL.relate can serve it without sampling.
+    Rerun this after re-inferring; stale results are ignored.
+    Arguments:
+        name            A unique identifier for ingest + inference
+        sample_count    The number of Monte Carlo samples per entropy
+        debug           Whether to run debug versions of C++ code
+    Environment variables:
+        LOOM_THREADS    Number of concurrent query servers
+        LOOM_VERBOSITY  Verbosity level
+    '''
+    paths = loom.store.get_paths(name)
+    LOG('materializing related')
+    loom.preql.materialize_related(
+        paths['root'],
+        sample_count=sample_count,
+        debug=debug)
+
+
 @parsable.command
 def make_consensus(name, config=None, debug=False):
     '''
@@ -281,6 +329,49 @@ def make_consensus(name, config=None, debug=False):
     loom.consensus.make_consensus(paths=paths, debug=debug)
 
 
+def _decompress(source, destin):
+    with open_compressed(source, 'rb') as f_in:
+        with open(destin, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+
+@parsable.command
+def snapshot(name):
+    '''
+    Write uncompressed copies of the files the query server loads,
+    so that later query servers start without gunzipping them.
+    Query servers use a snapshot only while it is newer than its sources,
+    so rerun this after re-inferring.
+    Arguments:
+        name            A unique identifier for ingest + inference
+    '''
+    root = loom.store.get_paths(name)['root']
+    paths = loom.store.get_paths(root, sample_count=None)
+    snapshot_root = loom.store.get_snapshot_path(paths['root'])
+
+    LOG('snapshotting tares')
+    tares = os.path.join(snapshot_root, 'ingest', 'tares.pbs')
+    if os.path.exists(paths['ingest']['tares']):
+        mkdir_p(os.path.dirname(tares))
+        _decompress(paths['ingest']['tares'], tares)
+
+    for seed, sample in enumerate(paths['samples']):
+        LOG('snapshotting sample {}'.format(seed))
+        destin = loom.store.get_sample_path(snapshot_root, seed)
+        temp = destin + '.temp'
+        rm_rf(temp)
+        mkdir_p(os.path.join(temp, 'groups'))
+        for filename in sorted(os.listdir(sample['groups'])):
+            if filename.endswith('.pbs.gz'):
+                _decompress(
+                    os.path.join(sample['groups'], filename),
+                    os.path.join(temp, 'groups', filename[:-len('.gz')]))
+        _decompress(sample['model'], os.path.join(temp, 'model.pb'))
+        _decompress(sample['config'], os.path.join(temp, 'config.pb'))
+        rm_rf(destin)
+        os.rename(temp, destin)
+
+
 @loom.documented.transform(
     inputs=[
         'ingest.encoding',
@@ -70,6 +70,10 @@ def test_related():
     loom.benchmark.related(DATASET, sample_count=10, profile=None)
 
 
+def test_predict():
+    loom.benchmark.predict(DATASET, count=2, profile=None)
+
+
 def test_test():
     raise SkipTest('FIXME(fobermeyer) test fails on travis')
     name = loom.benchmark.generate('bb', 4, 4, 1.0)
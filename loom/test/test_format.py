@@ -31,6 +31,7 @@ from distributions.fileutil import tempdir
 from distributions.io.stream import protobuf_stream_load
 from distributions.tests.util import assert_close
 import loom.format
+import loom.cFormat
 import loom.util
 from loom.test.util import for_each_dataset
 from loom.test.util import CLEANUP_ON_ERROR
@@ -104,6 +105,22 @@ def test_import_rows(encoding, rows, rows_csv, **unused):
         assert_equal(actual_count, expected_count)
 
 
+@for_each_dataset
+def test_protobuf_stream_count(rows, **unused):
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        rows_pbs = os.path.abspath('rows.pbs.gz')
+        expected_count = sum(1 for _ in protobuf_stream_load(rows))
+        loom.cFormat.row_stream_dump(
+            loom.cFormat.row_stream_load(rows),
+            rows_pbs)
+        assert_found(rows_pbs + '.index')
+        indexed_count = loom.cFormat.protobuf_stream_count(rows_pbs)
+        assert_equal(indexed_count, expected_count)
+        os.remove(rows_pbs + '.index')
+        scanned_count = loom.cFormat.protobuf_stream_count(rows_pbs)
+        assert_equal(scanned_count, expected_count)
+
+
 @for_each_dataset
 def test_export_rows(encoding, rows, **unused):
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
@@ -34,6 +34,7 @@ from StringIO import StringIO
 from nose import SkipTest
 from nose.tools import assert_almost_equal
 from nose.tools import assert_equal
+from nose.tools import assert_false
 from nose.tools import assert_raises
 from nose.tools import assert_true
 from distributions.fileutil import tempdir
@@ -42,7 +43,10 @@ from distributions.io.stream import open_compressed
 from distributions.io.stream import protobuf_stream_load
 from distributions.tests.util import assert_close
 import loom.preql
+import loom.query
+import loom.store
 from loom.format import load_encoder
+from loom.schema_pb2 import ProductValue
 from loom.test.util import CLEANUP_ON_ERROR
 from loom.test.util import for_each_dataset
 from loom.test.util import load_rows_csv
@@ -134,6 +138,57 @@ def test_predict_pandas(root, rows_csv, schema, **unused):
         assert_equal(result_df.shape[1], 1 + feature_count)
 
 
+@for_each_dataset
+def test_encode_rows(root, rows_csv, **unused):
+    rows = load_rows_csv(rows_csv)
+    header = rows.pop(0)
+    with loom.preql.get_server(root, debug=True) as preql:
+        encoded_rows = preql.encode_rows(rows, header)
+        assert_equal(encoded_rows.row_count, len(rows))
+        diffs = loom.query.encoded_rows_to_protobuf(encoded_rows)
+        data_rows = []
+        for row, diff in izip(rows, diffs):
+            expected = ProductValue.Diff()
+            loom.query.data_row_to_protobuf(
+                preql.encode_row(row, header),
+                expected)
+            expected = ProductValue.Diff.FromString(
+                expected.SerializeToString())
+            actual = ProductValue.Diff.FromString(diff)
+            data_row = loom.query.protobuf_to_data_row(actual)
+            assert_equal(data_row, loom.query.protobuf_to_data_row(expected))
+            data_rows.append(data_row or [None] * len(preql.feature_names))
+
+        decoded_rows = preql.decode_rows(encoded_rows, header)
+        assert_equal(list(decoded_rows.columns), header)
+        for actual, data_row in izip(decoded_rows.values.tolist(), data_rows):
+            assert_equal(actual, preql.decode_row(data_row, header))
+
+
+@for_each_dataset
+def test_batch_sample_encoded(root, rows_csv, **unused):
+    rows = load_rows_csv(rows_csv)
+    header = rows.pop(0)
+    count = 3
+    with loom.preql.get_server(root, debug=True) as preql:
+        conditioning_rows = preql.encode_rows(rows, header)
+        for chunk_size in [1, 7, len(rows)]:
+            samples = preql._query_server.batch_sample_encoded(
+                conditioning_rows,
+                count,
+                chunk_size=chunk_size)
+            assert_equal(samples.row_count, count * len(rows))
+            expected = conditioning_rows.repeat(count)
+            mask = expected.observed.astype(numpy.bool_)
+            assert_true((samples.observed[mask] == 1).all())
+            begin = 0
+            for block, expected_block in izip(samples[1:], expected[1:]):
+                end = begin + block.shape[1]
+                block_mask = mask[:, begin:end]
+                assert_close(block[block_mask], expected_block[block_mask])
+                begin = end
+
+
 @for_each_dataset
 def test_relate(root, **unused):
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
@@ -155,6 +210,96 @@ def test_relate(root, **unused):
                 assert_close(zmatrix, zmatrix.T)
 
 
+@for_each_dataset
+def test_relate_prunes_independent_kinds(root, **unused):
+    with loom.preql.get_server(root, debug=True) as preql:
+        comembership = preql.kind_comembership
+        feature_count = len(preql.feature_names)
+        assert_equal(comembership.shape, (feature_count, feature_count))
+        assert_close(comembership, comembership.T)
+        assert_close(comembership.diagonal(), numpy.ones(feature_count))
+        result_string = preql.relate(preql.feature_names, sample_count=10)
+        reader = csv.reader(StringIO(result_string))
+        reader.next()
+        for i, row in enumerate(reader):
+            for j, score in enumerate(row[1:]):
+                if comembership[i, j] == 0:
+                    assert_equal(float(score), 0.0)
+
+
+def count_sends(preql):
+    counter = {'sent': 0}
+    protobuf_server = preql._query_server.protobuf_server
+    send = protobuf_server.send
+
+    def counting_send(request):
+        counter['sent'] += 1
+        return send(request)
+
+    protobuf_server.send = counting_send
+    return counter
+
+
+@for_each_dataset
+def test_relate_request_count(root, rows_csv, **unused):
+    with loom.preql.get_server(root, debug=True) as preql:
+        features = preql.feature_names
+        feature_count = len(features)
+        counter = count_sends(preql)
+        chunk_size = loom.query.DEFAULTS['batch_entropy_chunk_size']
+        # all blocks share one batch_entropy request
+        preql.relate_frame(features, sample_count=10)
+        block_count = feature_count / 2
+        max_sent = (block_count + chunk_size - 1) / chunk_size
+        assert_true(counter['sent'] <= max_sent, counter)
+
+        # support forgets each pair from the conditioning row, but pairs
+        # with distinct conditioning rows still share batch requests
+        counter['sent'] = 0
+        conditioning_row = make_fully_observed_row(rows_csv)
+        observed = [
+            [f]
+            for f, c in izip(features, conditioning_row)
+            if c != ''
+        ]
+        result_df = preql.support_frame(
+            observed,
+            observed,
+            conditioning_row,
+            sample_count=10)
+        pair_count = len(observed) * (len(observed) - 1) / 2
+        max_sent = (pair_count + chunk_size - 1) / chunk_size
+        assert_true(counter['sent'] <= max_sent, counter)
+        assert_close(result_df.values, result_df.values.T)
+
+
+@for_each_dataset
+def test_materialized_related(root, **unused):
+    filename = loom.store.get_paths(root)['query']['related']
+    assert_false(os.path.exists(filename))
+    try:
+        loom.preql.materialize_related(root, sample_count=10, worker_count=2)
+        means, variances = loom.preql.load_related(root)
+        assert_close(means, means.T)
+        assert_true((variances >= 0).all())
+        with loom.preql.get_server(root, debug=True) as preql:
+            assert_true(preql.related is not None)
+            result = preql.relate(preql.feature_names)
+            reader = csv.reader(StringIO(result))
+            assert_equal(reader.next()[1:], preql.feature_names)
+            for i, row in enumerate(reader):
+                for j, score in enumerate(row[1:]):
+                    expected = 1.0 if i == j else \
+                        loom.preql.normalize_mutual_information(means[i, j])
+                    assert_almost_equal(float(score), expected)
+
+        loom.preql.dump_related('0' * 40, means, variances, filename)
+        assert_equal(loom.preql.load_related(root), None)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
 @for_each_dataset
 def test_relate_pandas(root, rows_csv, schema, **unused):
     feature_count = len(json_load(schema))
@@ -168,6 +313,24 @@ def test_relate_pandas(root, rows_csv, schema, **unused):
         assert_equal(result_df.shape[1], feature_count)
 
 
+@for_each_dataset
+def test_relate_frame(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    with loom.preql.get_server(root, debug=True) as preql:
+        features = preql.feature_names
+        result_df = preql.relate_frame(features, sample_count=10)
+        assert_equal(result_df.shape, (feature_count, feature_count))
+        assert_equal(list(result_df.index), features)
+        assert_equal(list(result_df.columns), features)
+        assert_close(result_df.values.diagonal(), numpy.ones(feature_count))
+        result_string = StringIO()
+        with loom.preql.csv_output(result_string) as writer:
+            loom.preql.write_frame(result_df, writer)
+        result_string.seek(0)
+        parsed_df = pandas.read_csv(result_string, index_col=0)
+        assert_close(parsed_df.values, result_df.values)
+
+
 @for_each_dataset
 def test_refine_with_conditions(root, rows_csv, **unused):
     with loom.preql.get_server(root, debug=True) as preql:
@@ -25,7 +25,11 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
+import time
 from itertools import izip
+from nose import SkipTest
+from nose.tools import assert_almost_equal
 from nose.tools import assert_equal
 from nose.tools import assert_set_equal
 from nose.tools import assert_not_equal
@@ -37,6 +41,7 @@ from distributions.fileutil import tempdir
 from loom.schema_pb2 import ProductValue, CrossCat, Query
 from loom.test.util import for_each_dataset
 import loom.query
+import loom.runner
 from loom.query import protobuf_to_data_row
 import loom.config
 from loom.test.util import load_rows
@@ -148,6 +153,17 @@ def _test_server(root, requests):
             check_response(request, response)
             if request.HasField('sample'):
                 assert_equal(len(response.sample.samples), 1)
+                assert_true(
+                    response.sample.pruned_kind_count <=
+                    response.sample.kind_count)
+                data = request.sample.data
+                is_observed = data.tares or any(data.pos.observed.dense)
+                is_requested = any(request.sample.to_sample.dense)
+                if data.pos.observed.sparsity == DENSE and not (
+                        is_observed or is_requested):
+                    assert_equal(
+                        response.sample.pruned_kind_count,
+                        response.sample.kind_count)
                 pod_request = protobuf_to_data_row(request.sample.data)
                 to_sample = request.sample.to_sample.dense[:]
                 server.sample(to_sample, pod_request)
@@ -163,6 +179,30 @@ def test_sample(root, model, rows, **unused):
     _test_server(root, requests)
 
 
+@for_each_dataset
+def test_batch_sample(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'sample')
+    entries = [
+        (
+            request.sample.to_sample.dense[:],
+            protobuf_to_data_row(request.sample.data),
+            i % 3 + 1,
+        )
+        for i, request in enumerate(requests)
+    ]
+    with loom.query.get_server(root, debug=True) as server:
+        for chunk_size in [1, 2, 7]:
+            results = list(server.batch_sample(entries, chunk_size=chunk_size))
+            assert_equal(len(results), len(entries))
+            for (to_sample, row, count), samples in izip(entries, results):
+                assert_equal(len(samples), count)
+                for sample in samples:
+                    assert_equal(len(sample), len(row))
+                    for sampled, given, value in izip(to_sample, row, sample):
+                        if not sampled:
+                            assert_equal(value, given)
+
+
 @for_each_dataset
 def test_score(root, model, rows, **unused):
     requests = get_example_requests(model, rows, 'score')
@@ -179,6 +219,12 @@ def test_batch_score(root, model, rows, **unused):
         ]
         scores = list(server.batch_score(rows))
         assert_equal(len(scores), len(rows))
+        for chunk_size in [1, 2, 7]:
+            chunked = list(server.batch_score(rows, chunk_size=chunk_size))
+            assert_equal(len(chunked), len(rows))
+        expected = map(server.score, rows)
+        for actual_score, expected_score in izip(scores, expected):
+            assert_almost_equal(actual_score, expected_score, places=3)
 
 
 @for_each_dataset
@@ -207,6 +253,43 @@ def test_score_derivative_against_existing_runs(root, rows, **unused):
         assert len(results) == 1
 
 
+@for_each_dataset
+def test_score_derivative_exact_runs(root, rows, **unused):
+    rows = load_rows(rows)
+    target_row = protobuf_to_data_row(rows[0].diff)
+    row_limit = max(1, len(rows) / 2)
+    results = {}
+    # each request samples the update row's assignment from the server's
+    # rng, so run each on a fresh server with the same seed
+    with tempdir():
+        loom.config.config_dump({'seed': 0}, 'config.pb.gz')
+        for exact in [True, False]:
+            with loom.query.get_server(root, 'config.pb.gz') as server:
+                results[exact] = server.score_derivative(
+                    target_row,
+                    row_limit=row_limit,
+                    exact=exact)
+    exact = results[True]
+    approx = results[False]
+    assert_equal(len(exact), row_limit)
+    assert_equal(len(approx), row_limit)
+    all_ids = set(row.id for row in rows)
+    assert set(id for id, _ in approx) <= all_ids
+
+    # candidates are scored exactly, so shared rows must agree,
+    # and the best candidate must be among the exact top rows
+    exact_scores = dict(exact)
+    approx_scores = dict(approx)
+    assert_equal(len(approx_scores), row_limit)
+    shared_ids = set(exact_scores) & set(approx_scores)
+    assert_true(shared_ids, 'approximate top rows miss all exact rows')
+    for id in shared_ids:
+        assert_almost_equal(exact_scores[id], approx_scores[id], places=3)
+    best_id, best_score = max(approx, key=lambda (_, score): score)
+    assert_true(best_id in exact_scores, best_id)
+    assert_almost_equal(best_score, max(exact_scores.values()), places=3)
+
+
 @for_each_dataset
 def test_seed(root, model, rows, **unused):
     requests = get_example_requests(model, rows, 'mixed')
@@ -244,3 +327,424 @@ def test_tiled_entropy(root, schema, **unused):
             print 'tile_size = {}'.format(tile_size)
             actual = set(server.entropy(tile_size=tile_size, **kwargs))
             assert_set_equal(expected, actual)
+
+
+@for_each_dataset
+def test_concurrent_server(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'mixed')
+    with tempdir():
+        loom.config.config_dump({'seed': 0}, 'config.pb.gz')
+        with loom.query.ProtobufServer(root, config='config.pb.gz') as server:
+            expected = [get_response(server, req) for req in requests]
+
+    with tempdir():
+        config = {'seed': 0, 'query': {'threads': 4}}
+        loom.config.config_dump(config, 'config.pb.gz')
+        with loom.query.ProtobufServer(root, config='config.pb.gz') as server:
+            for request in requests:
+                server.send(request)
+            actual = [server.receive(req.id) for req in reversed(requests)]
+            actual.reverse()
+
+    for request, response in izip(requests, actual):
+        check_response(request, response)
+    assert_equal(actual, expected)
+
+
+@for_each_dataset
+def test_fork_server(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'score')
+    with loom.query.ProtobufServer(root) as server:
+        expected = [get_response(server, req) for req in requests]
+
+    with loom.query.ForkServer(root) as fork_server:
+        address = fork_server.address
+        with loom.query.SocketProtobufServer(root, address) as server1:
+            with loom.query.SocketProtobufServer(root, address) as server2:
+                actual1 = [get_response(server1, r) for r in requests]
+                actual2 = [get_response(server2, r) for r in requests]
+
+    assert_equal(actual1, expected)
+    assert_equal(actual2, expected)
+
+
+@for_each_dataset
+def test_socket_server(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'score')
+    with loom.query.ProtobufServer(root) as server:
+        expected = [get_response(server, req) for req in requests]
+
+    with tempdir() as dirname:
+        address = 'unix:{}'.format(os.path.join(dirname, 'socket'))
+        proc = loom.runner.query(root, requests_in=address, block=False)
+        try:
+            while not os.path.exists(os.path.join(dirname, 'socket')):
+                assert proc.poll() is None, 'loom_query failed to start'
+                time.sleep(0.01)
+            with loom.query.SocketProtobufServer(root, address) as server1:
+                with loom.query.SocketProtobufServer(root, address) as server2:
+                    for request in requests:
+                        server1.send(request)
+                        server2.send(request)
+                    actual1 = [server1.receive(r.id) for r in requests]
+                    actual2 = [server2.receive(r.id) for r in requests]
+            with loom.query.connect(address, root) as server:
+                assert_equal(server.root, root)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    assert_equal(actual1, expected)
+    assert_equal(actual2, expected)
+
+
+@for_each_dataset
+def test_async_server(root, model, rows, schema, **unused):
+    requests = get_example_requests(model, rows, 'score')
+    data_rows = [protobuf_to_data_row(r.score.data) for r in requests]
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    kwargs = {'sample_count': 10}
+    with tempdir():
+        loom.config.config_dump({'seed': 0}, 'config.pb.gz')
+        with loom.query.get_server(root, 'config.pb.gz') as server:
+            expected_scores = map(server.score, data_rows)
+            expected_entropys = server.entropy(
+                feature_sets,
+                feature_sets,
+                **kwargs)
+            expected_mi = server.mutual_information(
+                feature_sets[0],
+                feature_sets[-1],
+                **kwargs)
+        with loom.query.get_async_server(root, 'config.pb.gz') as server:
+            scores = map(server.score, data_rows)
+            entropys = server.entropy(feature_sets, feature_sets, **kwargs)
+            mi = server.mutual_information(
+                feature_sets[0],
+                feature_sets[-1],
+                **kwargs)
+            assert_equal([f.result() for f in scores], expected_scores)
+            assert_equal(entropys.result(), expected_entropys)
+            assert_equal(mi.result(), expected_mi)
+
+
+@for_each_dataset
+def test_query_server_pool(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'score')
+    data_rows = [protobuf_to_data_row(r.score.data) for r in requests]
+    with loom.query.get_server(root) as server:
+        expected = map(server.score, data_rows)
+        feature_count = len(data_rows[0])
+
+    for shard in [False, True]:
+        with loom.query.QueryServerPool(root, 2, shard=shard) as pool:
+            futures = map(pool.score, data_rows)
+            assert_equal(len(pool.queue_depths()), 2)
+            for future, score in izip(futures, expected):
+                assert_almost_equal(future.result(), score, places=3)
+
+            to_sample = [True] * feature_count
+            samples = pool.sample(to_sample, sample_count=5).result()
+            assert_equal(len(samples), 5)
+
+            feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+            entropys = pool.entropy(
+                feature_sets,
+                feature_sets,
+                sample_count=10).result()
+            for feature_set in feature_sets:
+                assert_true(feature_set in entropys)
+
+
+@for_each_dataset
+def test_sharded_conditional_entropy(root, model, rows, **unused):
+    requests = get_example_requests(model, rows, 'score')
+    conditioning_row = protobuf_to_data_row(requests[0].score.data)
+    observed = [
+        i for i, value in enumerate(conditioning_row) if value is not None
+    ]
+    if len(observed) < 2:
+        raise SkipTest('too few observed features to condition on')
+    # condition on half of the observed features, query the rest
+    feature_sets = [frozenset([i]) for i in observed[::2]]
+    for feature_set in feature_sets:
+        for i in feature_set:
+            conditioning_row[i] = None
+    kwargs = {'conditioning_row': conditioning_row, 'sample_count': 200}
+    results = []
+    for shard in [False, True]:
+        with loom.query.QueryServerPool(root, 2, shard=shard) as pool:
+            results.append(
+                pool.entropy(feature_sets, feature_sets, **kwargs).result())
+    unsharded, sharded = results
+    for feature_set in feature_sets:
+        expected = unsharded[feature_set]
+        actual = sharded[feature_set]
+        stderr = (expected.variance + actual.variance) ** 0.5
+        assert_true(
+            abs(actual.mean - expected.mean) < 5 * stderr + 0.1,
+            (feature_set, actual, expected))
+
+
+def test_query_cache_lru():
+    cache = loom.query.QueryCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert_equal(cache.get('a'), 1)
+    cache.put('c', 3)
+    assert_equal(cache.get('b'), None)
+    assert_equal(cache.get('a'), 1)
+    assert_equal(cache.get('c'), 3)
+    assert_equal(len(cache), 2)
+    assert_equal((cache.hits, cache.misses), (3, 1))
+
+
+def test_query_cache_disk_eviction():
+    with tempdir() as dirname:
+        cache = loom.query.QueryCache(1, dirname, 10, fingerprint='old')
+        for i in xrange(10):
+            cache.put(('old', i), i)
+        assert_equal(len(os.listdir(dirname)), 10)
+        old_time = time.time() - 100
+        for i in xrange(10):
+            os.utime(cache._filename(('old', i)), (old_time, old_time))
+        assert_equal(cache.get(('old', 0)), 0)  # refreshes its mtime
+        cache.put(('old', 10), 10)
+        assert_true(len(os.listdir(dirname)) <= 10)
+        assert_equal(cache.get(('old', 0)), 0)
+        assert_equal(cache.get(('old', 10)), 10)
+
+        cache = loom.query.QueryCache(1, dirname, 10, fingerprint='new')
+        assert_equal(os.listdir(dirname), [])
+        assert_equal(cache.get(('old', 0)), None)
+
+
+@for_each_dataset
+def test_cached_entropy(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    kwargs = {'sample_count': 10}
+    with tempdir() as dirname:
+        cache = loom.query.QueryCache(dirname=dirname)
+        with loom.query.get_server(root, cache=cache) as server:
+            expected = server.entropy(feature_sets, feature_sets, **kwargs)
+            assert_equal(cache.hits, 0)
+            reversed_sets = list(reversed(feature_sets))
+            actual = server.entropy(reversed_sets, reversed_sets, **kwargs)
+            assert_equal(actual, expected)
+            assert_true(cache.hits > 0)
+
+        restarted = loom.query.QueryCache(dirname=dirname)
+        with loom.query.get_server(root, cache=restarted) as server:
+            actual = server.entropy(feature_sets, feature_sets, **kwargs)
+            assert_equal(actual, expected)
+            assert_equal(restarted.misses, 0)
+
+
+@for_each_dataset
+def test_entropy_many(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    conditioning_rows = [None, [None] * feature_count]
+    queries = [
+        (feature_sets[:i + 1], feature_sets[i:], conditioning_row)
+        for i in xrange(feature_count)
+        for conditioning_row in conditioning_rows
+    ]
+    cache = loom.query.QueryCache()
+    with loom.query.get_server(root, cache=cache) as server:
+        results = server.entropy_many(queries, sample_count=10)
+        assert_equal(len(results), len(queries))
+        for (row_sets, col_sets, conditioning_row), actual in izip(
+                queries,
+                results):
+            expected = server.entropy(
+                row_sets,
+                col_sets,
+                conditioning_row,
+                sample_count=10)
+            assert_equal(actual, expected)
+        assert_equal(cache.hits, len(queries))
+
+
+def count_sends(server):
+    counter = {'sent': 0}
+    send = server.protobuf_server.send
+
+    def counting_send(request):
+        counter['sent'] += 1
+        return send(request)
+
+    server.protobuf_server.send = counting_send
+    return counter
+
+
+@for_each_dataset
+def test_entropy_many_dedupes(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    queries = [
+        (feature_sets, feature_sets[:1], None),
+        (list(reversed(feature_sets)), feature_sets[:1], None),
+        (feature_sets, feature_sets[:1], None),
+        (feature_sets[:1], feature_sets, None),
+    ]
+    with loom.query.get_server(root) as server:
+        counter = count_sends(server)
+        results = server.entropy_many(queries, sample_count=10)
+        assert_equal(counter['sent'], 1)
+        counter['sent'] = 0
+        server.entropy_many(queries, sample_count=10, chunk_size=1)
+        assert_equal(counter['sent'], 2)
+    assert_true(results[0] is results[1])
+    assert_true(results[0] is results[2])
+    assert_set_equal(set(results[3]), set(results[0]))
+
+
+@for_each_dataset
+def test_adaptive_entropy(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    sample_count = 10
+    max_sample_count = 4 * sample_count
+    with loom.query.get_server(root, debug=True) as server:
+        fixed = server.entropy(
+            feature_sets,
+            feature_sets,
+            sample_count=sample_count)
+        for estimate in fixed.itervalues():
+            if estimate.sample_count:  # exact estimates have no samples
+                assert_equal(estimate.sample_count, sample_count)
+
+        loose = server.entropy(
+            feature_sets,
+            feature_sets,
+            sample_count=sample_count,
+            target_stderr=1e6)
+        for estimate in loose.itervalues():
+            if estimate.sample_count:
+                assert_equal(estimate.sample_count, sample_count)
+
+        tight = server.entropy(
+            feature_sets,
+            feature_sets,
+            sample_count=sample_count,
+            target_stderr=1e-6,
+            max_sample_count=max_sample_count)
+        assert_set_equal(set(tight), set(fixed))
+        for estimate in tight.itervalues():
+            if estimate.sample_count == 0:
+                assert_equal(estimate.variance, 0)
+                continue
+            assert_true(sample_count <= estimate.sample_count)
+            assert_true(estimate.sample_count <= max_sample_count)
+            assert_equal(estimate.sample_count % sample_count, 0)
+            if estimate.variance > 1e-12:
+                assert_equal(estimate.sample_count, max_sample_count)
+
+
+@for_each_dataset
+def test_adaptive_entropy_errors(root, schema, **unused):
+    feature_sets = [frozenset([0])]
+    with loom.query.get_server(root, debug=True) as server:
+        for field in ['target_stderr', 'time_budget']:
+            try:
+                server.entropy(feature_sets, feature_sets, **{field: -1.0})
+            except Exception as e:
+                assert_true(
+                    'invalid request.entropy.{}'.format(field) in str(e),
+                    e)
+            else:
+                raise AssertionError('accepted negative {}'.format(field))
+
+
+@for_each_dataset
+def test_adaptive_mutual_information_pool(root, schema, **unused):
+    feature_set1 = frozenset([0])
+    feature_set2 = frozenset([len(json_load(schema)) - 1])
+    kwargs = {
+        'sample_count': 10,
+        'target_stderr': 1e-6,
+        'max_sample_count': 20,
+    }
+    with loom.query.get_server(root, debug=True) as server:
+        estimate = server.mutual_information(
+            feature_set1,
+            feature_set2,
+            **kwargs)
+        assert_true(estimate.sample_count <= kwargs['max_sample_count'])
+    with loom.query.QueryServerPool(root, 2) as pool:
+        estimate = pool.mutual_information(
+            feature_set1,
+            feature_set2,
+            **kwargs).result()
+        assert_true(estimate.sample_count <= kwargs['max_sample_count'])
+    with loom.query.QueryServerPool(root, 2, shard=True) as pool:
+        try:
+            pool.mutual_information(feature_set1, feature_set2, **kwargs)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('sharded pool accepted target_stderr')
+
+
+@for_each_dataset
+def test_exact_entropy(root, schema, **unused):
+    feature_count = len(json_load(schema))
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    feature_sets += [frozenset([i, i + 1]) for i in xrange(feature_count - 1)]
+    kwargs = {'sample_count': 2000}
+    with tempdir():
+        loom.config.config_dump({}, 'exact.pb.gz')
+        with loom.query.get_server(root, 'exact.pb.gz') as server:
+            exact = server.entropy(feature_sets, [frozenset()], **kwargs)
+        config = {'query': {'exact_entropy_max_support': 0}}
+        loom.config.config_dump(config, 'sampled.pb.gz')
+        with loom.query.get_server(root, 'sampled.pb.gz') as server:
+            sampled = server.entropy(feature_sets, [frozenset()], **kwargs)
+
+    for feature_set in feature_sets:
+        actual = exact[feature_set]
+        expected = sampled[feature_set]
+        if actual.sample_count == 0:
+            assert_equal(actual.variance, 0)
+            sigma = expected.variance ** 0.5
+            assert_true(abs(actual.mean - expected.mean) <= 4 * sigma + 1e-3)
+
+
+def test_mutual_information_sample_count():
+    Estimate = loom.query.Estimate
+    a = frozenset([0])
+    b = frozenset([1])
+    entropys = {a: Estimate(1.0, 0, 0), b: Estimate(1.0, 0, 0)}
+    entropys[a | b] = Estimate(1.5, 0, 0)
+    assert_equal(
+        loom.query.get_mutual_information(a, b, entropys).sample_count,
+        0)
+    entropys[a | b] = Estimate(1.5, 0.01, 100)
+    assert_equal(
+        loom.query.get_mutual_information(a, b, entropys).sample_count,
+        100)
+    entropys[a | b] = Estimate(1.5, 0.01, None)
+    assert_equal(
+        loom.query.get_mutual_information(a, b, entropys).sample_count,
+        None)
+
+
+@for_each_dataset
+def test_exact_entropy_triggers(root, schema, **unused):
+    models = json_load(schema).values()
+    feature_count = len(models)
+    feature_sets = [frozenset([i]) for i in xrange(feature_count)]
+    with loom.query.get_server(root, debug=True) as server:
+        entropys = server.entropy(feature_sets, feature_sets, sample_count=10)
+    empty = entropys[frozenset()]
+    assert_equal((empty.mean, empty.variance, empty.sample_count), (0, 0, 0))
+    if any(model in ['bb', 'dd'] for model in models):
+        exact = [
+            feature_set
+            for feature_set in feature_sets
+            if entropys[feature_set].sample_count == 0
+        ]
+        assert_true(exact, 'no bb or dd feature was computed exactly')
@@ -138,12 +138,43 @@ CONFIGS = [
             },
         },
     },
+    {
+        'schedule': {'extra_passes': 1.5},
+        'row_cache_mem_bytes': 1e9,
+        'kernels': {
+            'cat': {
+                'empty_group_count': 1,
+                'row_queue_capacity': 8,
+            },
+            'kind': {'iterations': 0},
+        },
+    },
+    {
+        'schedule': {'extra_passes': 1.5, 'max_reject_iters': 100},
+        'row_cache_mem_bytes': 1e9,
+        'kernels': {
+            'cat': {
+                'empty_group_count': 1,
+                'row_queue_capacity': 0,
+            },
+            'kind': {
+                'iterations': 1,
+                'empty_kind_count': 1,
+                'row_queue_capacity': 8,
+                'score_parallel': True,
+            },
+        },
+    },
 ]
 
 
+def list_groups(groups_out):
+    return [f for f in os.listdir(groups_out) if not f.endswith('.index')]
+
+
 def get_group_counts(groups_out):
     group_counts = []
-    for f in os.listdir(groups_out):
+    for f in list_groups(groups_out):
         group_count = 0
         groups = os.path.join(groups_out, f)
         for string in protobuf_stream_load(groups):
@@ -235,7 +266,7 @@ def test_infer(name, tares, shuffled, init, **unused):
                     debug=True,)
 
                 if kind_structure_is_fixed:
-                    assert_equal(len(os.listdir(groups_out)), kind_count)
+                    assert_equal(len(list_groups(groups_out)), kind_count)
 
                 group_counts = get_group_counts(groups_out)
 
@@ -80,3 +80,31 @@ def test_chunking(rows, **unused):
         for i, actual in enumerate(results):
             for expected in results[:i]:
                 assert_list_equal(actual, expected)
+
+
+@for_each_dataset
+def test_multiple_outputs(rows, **unused):
+    with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
+        seed = 12345
+        count = 3
+        rows_out = [
+            os.path.abspath('rows.out.{}.pbs.gz'.format(i))
+            for i in xrange(count)
+        ]
+        # a budget smaller than the index must not change the outputs
+        for target_mem_bytes in [1e9, 1.0]:
+            loom.runner.shuffle(
+                rows_in=rows,
+                rows_out=rows_out,
+                seed=seed,
+                target_mem_bytes=target_mem_bytes)
+            for i, filename in enumerate(rows_out):
+                assert_found(filename)
+                expected_out = os.path.abspath('rows.expected.pbs.gz')
+                loom.runner.shuffle(
+                    rows_in=rows,
+                    rows_out=expected_out,
+                    seed=seed + i)
+                assert_list_equal(
+                    load_rows_raw(filename),
+                    load_rows_raw(expected_out))
@@ -61,3 +61,16 @@ def test_all(name, schema, rows_csv, **unused):
             pbserver.send(request)
             response = pbserver.receive()
             check_response(request, response)
+
+    LOG('querying from snapshot')
+    loom.tasks.snapshot(name)
+    snapshot = loom.store.get_snapshot_path(paths['root'])
+    for seed in xrange(SAMPLE_COUNT):
+        sample = loom.store.get_sample_path(snapshot, seed)
+        assert os.path.exists(os.path.join(sample, 'model.pb'))
+    with loom.tasks.query(paths['root'], debug=True) as server:
+        pbserver = server._query_server.protobuf_server
+        for request in requests:
+            pbserver.send(request)
+            response = pbserver.receive()
+            check_response(request, response)
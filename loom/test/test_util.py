@@ -39,6 +39,8 @@ def _test_cat(name, paths):
     for key, filename in loom.store.iter_paths(name, paths):
         if os.path.isdir(filename) and not filename.startswith('test'):
             for f in os.listdir(filename):
+                if f.endswith('.index'):
+                    continue
                 _test_cat('{}.{}'.format(name, key), os.path.join(filename, f))
         else:
             print '==== {} ===='.format(key)
@@ -162,6 +162,21 @@ def parallel_map(fun, args):
         return pool.map(print_trace, fun_args, chunksize=1)
 
 
+def iter_chunks(items, chunk_size):
+    '''
+    Split an iterable into lists of at most chunk_size items.
+    '''
+    assert chunk_size > 0, chunk_size
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 @contextlib.contextmanager
 def csv_reader(filename):
     with open_compressed(filename, 'rb') as f:
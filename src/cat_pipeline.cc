@@ -59,17 +59,27 @@ inline void CatPipeline::add_thread (
 
 void CatPipeline::start_threads (size_t parser_threads)
 {
-    // unzip
+    // unzip, or fetch cached rows
     add_thread(0, [this](Task & task, const ThreadState &){
         if (task.add) {
             task.parsed.clear();
-            rows_.read_unassigned(task.raw);
+            if (rows_.is_cached()) {
+                task.cached_row = & rows_.read_unassigned_cached();
+            } else {
+                task.cached_row = nullptr;
+                rows_.read_unassigned(task.raw);
+            }
         }
     });
     add_thread(0, [this](Task & task, const ThreadState &){
         if (not task.add) {
             task.parsed.clear();
-            rows_.read_assigned(task.raw);
+            if (rows_.is_cached()) {
+                task.cached_row = & rows_.read_assigned_cached();
+            } else {
+                task.cached_row = nullptr;
+                rows_.read_assigned(task.raw);
+            }
         }
     });
 
@@ -79,8 +89,14 @@ void CatPipeline::start_threads (size_t parser_threads)
         add_thread(1,
             [i, this, parser_threads](Task & task, ThreadState &){
             if (not task.parsed.test_and_set()) {
-                task.row.ParseFromArray(task.raw.data(), task.raw.size());
-                cross_cat_.splitter.split(task.row.diff(), task.partial_diffs);
+                if (not task.cached_row) {
+                    task.parsed_row.ParseFromArray(
+                        task.raw.data(),
+                        task.raw.size());
+                }
+                cross_cat_.splitter.split(
+                    task.row().diff(),
+                    task.partial_diffs);
                 cross_cat_.simplify(task.partial_diffs);
             }
         });
@@ -90,12 +106,12 @@ void CatPipeline::start_threads (size_t parser_threads)
     auto & rowids = assignments_.rowids();
     add_thread(2, [&rowids](const Task & task, ThreadState &){
         if (task.add) {
-            bool ok = rowids.try_push(task.row.id());
-            LOOM_ASSERT1(ok, "duplicate row: " << task.row.id());
+            bool ok = rowids.try_push(task.row().id());
+            LOOM_ASSERT1(ok, "duplicate row: " << task.row().id());
         } else {
             const auto rowid = rowids.pop();
             if (LOOM_DEBUG_LEVEL >= 1) {
-                LOOM_ASSERT_EQ(rowid, task.row.id());
+                LOOM_ASSERT_EQ(rowid, task.row().id());
             }
         }
     });
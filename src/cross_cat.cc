@@ -158,7 +158,7 @@ void CrossCat::mixture_load (
     for (size_t kindid = 0; kindid < kind_count; ++kindid) {
         rng_t rng(seed + kindid);
         Kind & kind = kinds[kindid];
-        std::string filename = store::get_mixture_path(dirname, kindid);
+        std::string filename = store::find_mixture_path(dirname, kindid);
         kind.mixture.maintaining_cache = true;
         kind.mixture.load_step_1_of_3(
             kind.model,
@@ -94,10 +94,16 @@ private:
         std::atomic_flag parsed;
         bool add;
         std::vector<char> raw;
-        protobuf::Row row;
+        protobuf::Row parsed_row;
+        const protobuf::Row * cached_row;
         std::vector<ProductValue::Diff> partial_diffs;
 
-        Task () : parsed(ATOMIC_FLAG_INIT) {}
+        Task () : parsed(ATOMIC_FLAG_INIT), cached_row(nullptr) {}
+
+        const protobuf::Row & row () const
+        {
+            return cached_row ? * cached_row : parsed_row;
+        }
     };
 
     struct ThreadState
@@ -51,7 +51,10 @@ Loom::Loom (
     cross_cat_(),
     assignments_()
 {
-    cross_cat_.model_load(model_in);
+    {
+        Timer::Scope timer(load_timers_.model);
+        cross_cat_.model_load(model_in);
+    }
     const size_t kind_count = cross_cat_.kinds.size();
     LOOM_ASSERT(kind_count, "no kinds, loom is empty");
     assignments_.init(kind_count);
@@ -59,17 +62,22 @@ Loom::Loom (
     const size_t empty_group_count =
         config_.kernels().cat().empty_group_count();
     LOOM_ASSERT_LT(0, empty_group_count);
-    if (groups_in) {
-        cross_cat_.mixture_load(groups_in, empty_group_count, rng);
-    } else {
-        cross_cat_.mixture_init_unobserved(empty_group_count, rng);
+    {
+        Timer::Scope timer(load_timers_.groups);
+        if (groups_in) {
+            cross_cat_.mixture_load(groups_in, empty_group_count, rng);
+        } else {
+            cross_cat_.mixture_init_unobserved(empty_group_count, rng);
+        }
     }
 
     if (tares_in) {
+        Timer::Scope timer(load_timers_.tares);
         cross_cat_.tares_load(tares_in, rng);
     }
 
     if (assign_in) {
+        Timer::Scope timer(load_timers_.assign);
         assignments_.load(assign_in);
         for (const auto & kind : cross_cat_.kinds) {
             LOOM_ASSERT_LE(
@@ -83,6 +91,22 @@ Loom::Loom (
     assignments_.validate();
 }
 
+void Loom::log_load_metrics (Logger::Message & message) const
+{
+    auto & status = * message.mutable_load_status();
+    const usec_t model_time = load_timers_.model.total();
+    const usec_t groups_time = load_timers_.groups.total();
+    const usec_t tares_time = load_timers_.tares.total();
+    const usec_t assign_time = load_timers_.assign.total();
+    status.set_model_time(status.model_time() + model_time);
+    status.set_groups_time(status.groups_time() + groups_time);
+    status.set_tares_time(status.tares_time() + tares_time);
+    status.set_assign_time(status.assign_time() + assign_time);
+    status.set_total_time(
+        status.total_time() +
+        model_time + groups_time + tares_time + assign_time);
+}
+
 //----------------------------------------------------------------------------
 // High level operations
 
@@ -170,7 +194,7 @@ void Loom::infer_multi_pass (
         const char * checkpoint_in,
         const char * checkpoint_out)
 {
-    StreamInterval rows(rows_in);
+    StreamInterval rows(rows_in, config_.row_cache_mem_bytes());
     CombinedSchedule schedule(config_.schedule());
     schedule.annealing.set_extra_passes(
         schedule.accelerating.extra_passes(assignments_.row_count()));
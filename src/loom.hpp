@@ -85,6 +85,8 @@ public:
 
     const CrossCat & cross_cat () const { return cross_cat_; }
 
+    void log_load_metrics (Logger::Message & message) const;
+
 private:
 
     bool infer_kind_structure_sequential (
@@ -132,6 +134,14 @@ private:
     const protobuf::Config & config_;
     CrossCat cross_cat_;
     Assignments assignments_;
+
+    struct
+    {
+        Timer model;
+        Timer groups;
+        Timer tares;
+        Timer assign;
+    } load_timers_;
 };
 
 inline bool Loom::infer_kind_structure (
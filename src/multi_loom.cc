@@ -25,7 +25,9 @@
 // TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 // USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+#include <atomic>
 #include <fstream>
+#include <thread>
 #include <loom/store.hpp>
 #include <loom/multi_loom.hpp>
 
@@ -59,18 +61,55 @@ MultiLoom::MultiLoom (
         const char * root_in,
         bool load_groups,
         bool load_assign,
-        bool load_tares)
+        bool load_tares,
+        size_t thread_count)
 {
     const auto paths = store::get_paths(root_in);
     const char * tares_in = paths.ingest.tares.c_str();
     if (not (load_tares and std::ifstream(tares_in))) {
         tares_in = nullptr;
     }
-    for (const auto & sample_paths : paths.samples) {
-        samples_.push_back(
-            new Sample(sample_paths, load_groups, load_assign, tares_in));
+    const size_t sample_count = paths.samples.size();
+    LOOM_ASSERT(sample_count, "no samples were found at " << root_in);
+
+    // samples are loaded by a bounded pool of threads;
+    // each sample additionally parallelizes its own groups load with openmp
+    Timer timer;
+    timer.start();
+    samples_.resize(sample_count, nullptr);
+    thread_count = std::max(size_t(1), std::min(thread_count, sample_count));
+    std::atomic<size_t> next_sample(0);
+    auto load_samples = [&](){
+        for (size_t i = next_sample++; i < sample_count; i = next_sample++) {
+            samples_[i] = new Sample(
+                paths.samples[i],
+                load_groups,
+                load_assign,
+                tares_in);
+        }
+    };
+    if (thread_count == 1) {
+        load_samples();
+    } else {
+        std::vector<std::thread> threads;
+        for (size_t t = 0; t < thread_count; ++t) {
+            threads.push_back(std::thread(load_samples));
+        }
+        for (auto & thread : threads) {
+            thread.join();
+        }
     }
-    LOOM_ASSERT(not samples_.empty(), "no samples were found at " << root_in);
+    timer.stop();
+
+    logger([&](Logger::Message & message){
+        for (const auto * sample : samples_) {
+            sample->loom.log_load_metrics(message);
+        }
+        auto & status = * message.mutable_load_status();
+        status.set_wall_time(timer.total());
+        status.set_sample_count(sample_count);
+        status.set_thread_count(thread_count);
+    });
 }
 
 MultiLoom::~MultiLoom ()
@@ -40,7 +40,8 @@ public:
             const char * root_in,
             bool load_groups = false,
             bool load_assign = false,
-            bool load_tares = false);
+            bool load_tares = false,
+            size_t thread_count = 1);
     ~MultiLoom ();
 
     const std::vector<const CrossCat *> cross_cats () const;
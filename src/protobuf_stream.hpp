@@ -30,7 +30,9 @@
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <fcntl.h>
+#include <unistd.h>
 #include <vector>
+#include <string>
 #include <google/protobuf/io/coded_stream.h>
 #include <google/protobuf/io/zero_copy_stream_impl.h>
 #include <google/protobuf/io/gzip_stream.h>
@@ -47,6 +49,127 @@ inline bool endswith (const char * filename, const char * suffix)
         strcmp(filename + strlen(filename) - strlen(suffix), suffix) == 0;
 }
 
+// A StreamIndex is a sidecar file FILENAME.index written alongside a
+// message stream FILENAME by OutFile. It records the message count, the
+// max message size, and a checkpoint every StreamIndex::STRIDE messages,
+// where a checkpoint is the byte offset at which a reader can resume.
+// Gzipped streams restart a gzip member at each checkpoint; the resulting
+// multi-member file is still a valid gzip file.
+// Readers must treat the index as optional and fall back to scanning.
+struct StreamIndex
+{
+    enum { STRIDE = 4096, VERSION = 1 };
+
+    struct Checkpoint
+    {
+        uint64_t position;
+        uint64_t offset;
+    };
+
+    uint64_t file_size;
+    uint64_t message_count;
+    uint32_t max_message_size;
+    std::vector<Checkpoint> checkpoints;
+
+    StreamIndex () :
+        file_size(0),
+        message_count(0),
+        max_message_size(0),
+        checkpoints()
+    {
+    }
+
+    static std::string filename_for (const std::string & filename)
+    {
+        return filename + ".index";
+    }
+
+    static bool try_load (const std::string & filename, StreamIndex & index)
+    {
+        if (filename.empty() or filename == "-" or filename == "-.gz") {
+            return false;
+        }
+        const std::string index_filename = filename_for(filename);
+        struct stat data_stat;
+        struct stat index_stat;
+        if (stat(filename.c_str(), & data_stat) or
+            stat(index_filename.c_str(), & index_stat))
+        {
+            return false;
+        }
+        if (_newer(data_stat.st_mtim, index_stat.st_mtim)) {
+            return false;
+        }
+
+        int fid = open(index_filename.c_str(), O_RDONLY);
+        if (fid == -1) {
+            return false;
+        }
+        bool success;
+        {
+            google::protobuf::io::FileInputStream file(fid);
+            google::protobuf::io::CodedInputStream coded(& file);
+            uint32_t version = 0;
+            uint64_t checkpoint_count = 0;
+            success =
+                coded.ReadVarint32(& version) and
+                version == VERSION and
+                coded.ReadVarint64(& index.file_size) and
+                coded.ReadVarint64(& index.message_count) and
+                coded.ReadVarint32(& index.max_message_size) and
+                coded.ReadVarint64(& checkpoint_count);
+            index.checkpoints.clear();
+            for (uint64_t i = 0; success and i < checkpoint_count; ++i) {
+                Checkpoint checkpoint;
+                success =
+                    coded.ReadVarint64(& checkpoint.position) and
+                    coded.ReadVarint64(& checkpoint.offset);
+                index.checkpoints.push_back(checkpoint);
+            }
+        }
+        close(fid);
+
+        return success and
+            index.file_size == static_cast<uint64_t>(data_stat.st_size);
+    }
+
+    void dump (const std::string & filename) const
+    {
+        const std::string index_filename = filename_for(filename);
+        int fid = open(
+            index_filename.c_str(),
+            O_WRONLY | O_CREAT | O_TRUNC, 0664);
+        LOOM_ASSERT(fid != -1, "failed to open index file " << index_filename);
+        {
+            google::protobuf::io::FileOutputStream file(fid);
+            google::protobuf::io::CodedOutputStream coded(& file);
+            coded.WriteVarint32(VERSION);
+            coded.WriteVarint64(file_size);
+            coded.WriteVarint64(message_count);
+            coded.WriteVarint32(max_message_size);
+            coded.WriteVarint64(checkpoints.size());
+            for (const auto & checkpoint : checkpoints) {
+                coded.WriteVarint64(checkpoint.position);
+                coded.WriteVarint64(checkpoint.offset);
+            }
+        }
+        close(fid);
+    }
+
+    static void remove (const std::string & filename)
+    {
+        unlink(filename_for(filename).c_str());
+    }
+
+private:
+
+    static bool _newer (const timespec & x, const timespec & y)
+    {
+        return x.tv_sec > y.tv_sec or
+            (x.tv_sec == y.tv_sec and x.tv_nsec > y.tv_nsec);
+    }
+};
+
 class InFile : noncopyable
 {
 public:
@@ -74,6 +197,13 @@ public:
 
     void set_position (uint64_t target)
     {
+        if (is_file_) {
+            StreamIndex index;
+            if (StreamIndex::try_load(filename_, index)) {
+                _seek_checkpoint(index, target);
+            }
+        }
+
         if (target < position_) {
             _close();
             _open();
@@ -152,6 +282,15 @@ public:
 
     static StreamStats stream_stats (const char * filename)
     {
+        StreamIndex index;
+        if (StreamIndex::try_load(filename, index)) {
+            StreamStats stats;
+            stats.is_file = true;
+            stats.message_count = index.message_count;
+            stats.max_message_size = index.max_message_size;
+            return stats;
+        }
+
         InFile file(filename);
 
         StreamStats stats;
@@ -177,7 +316,25 @@ public:
 
 private:
 
-    void _open ()
+    // jump to the last checkpoint at or before target,
+    // unless the current position is already closer
+    void _seek_checkpoint (const StreamIndex & index, uint64_t target)
+    {
+        const StreamIndex::Checkpoint * best = nullptr;
+        for (const auto & checkpoint : index.checkpoints) {
+            if (checkpoint.position > target) {
+                break;
+            }
+            best = & checkpoint;
+        }
+        if (best and (target < position_ or position_ < best->position)) {
+            _close();
+            _open(best->offset);
+            position_ = best->position;
+        }
+    }
+
+    void _open (uint64_t offset = 0)
     {
         if (filename_.empty()) {
             is_file_ = false;
@@ -188,6 +345,10 @@ private:
             is_file_ = true;
             fid_ = open(filename_.c_str(), O_RDONLY | O_NOATIME);
             LOOM_ASSERT(fid_ != -1, "failed to open input file " << filename_);
+            if (offset) {
+                off_t pos = lseek(fid_, offset, SEEK_SET);
+                LOOM_ASSERT(pos != -1, "failed to seek in " << filename_);
+            }
         }
 
         file_ = new google::protobuf::io::FileInputStream(fid_);
@@ -245,6 +406,13 @@ public:
         delete file_;
         if (is_file()) {
             close(fid_);
+            if (indexed_) {
+                struct stat data_stat;
+                if (stat(filename_.c_str(), & data_stat) == 0) {
+                    index_.file_size = data_stat.st_size;
+                    index_.dump(filename_);
+                }
+            }
         }
     }
 
@@ -254,6 +422,7 @@ public:
     template<class Message>
     void write (Message & message)
     {
+        indexed_ = false;
         LOOM_ASSERT1(message.IsInitialized(), "message not initialized");
         bool success = message.SerializeToZeroCopyStream(stream_);
         LOOM_ASSERT(success, "failed to serialize message to " << filename_);
@@ -262,15 +431,17 @@ public:
     template<class Message>
     void write_stream (Message & message)
     {
-        google::protobuf::io::CodedOutputStream coded(stream_);
         LOOM_ASSERT1(message.IsInitialized(), "message not initialized");
         uint32_t message_size = message.ByteSize();
+        _index_message(message_size);
+        google::protobuf::io::CodedOutputStream coded(stream_);
         coded.WriteLittleEndian32(message_size);
         message.SerializeWithCachedSizes(& coded);
     }
 
     void write_stream (const std::vector<char> & raw)
     {
+        _index_message(raw.size());
         google::protobuf::io::CodedOutputStream coded(stream_);
         coded.WriteLittleEndian32(raw.size());
         coded.WriteRaw(raw.data(), raw.size());
@@ -286,6 +457,31 @@ public:
 
 private:
 
+    void _index_message (uint32_t message_size)
+    {
+        if (not indexed_) {
+            return;
+        }
+        if (index_.message_count % StreamIndex::STRIDE == 0 and
+            index_.message_count)
+        {
+            if (gzip_) {
+                bool success = gzip_->Close();
+                LOOM_ASSERT(success, "failed to write " << filename_);
+                delete gzip_;
+                gzip_ = new google::protobuf::io::GzipOutputStream(file_);
+                stream_ = gzip_;
+            }
+            StreamIndex::Checkpoint checkpoint;
+            checkpoint.position = index_.message_count;
+            checkpoint.offset = file_->ByteCount();
+            index_.checkpoints.push_back(checkpoint);
+        }
+        ++index_.message_count;
+        index_.max_message_size =
+            std::max(index_.max_message_size, message_size);
+    }
+
     void _open (int flags = 0)
     {
         if (filename_.empty()) {
@@ -299,8 +495,12 @@ private:
                 filename_.c_str(),
                 O_WRONLY | O_CREAT | O_TRUNC | flags, 0664);
             LOOM_ASSERT(fid_ != -1, "failed to open output file " << filename_);
+            StreamIndex::remove(filename_);
         }
 
+        // appended streams are not indexed
+        indexed_ = is_file_ and not (flags & APPEND);
+
         file_ = new google::protobuf::io::FileOutputStream(fid_);
 
         if (endswith(filename_.c_str(), ".gz")) {
@@ -318,6 +518,8 @@ private:
     google::protobuf::io::FileOutputStream * file_;
     google::protobuf::io::GzipOutputStream * gzip_;
     google::protobuf::io::ZeroCopyOutputStream * stream_;
+    bool indexed_;
+    StreamIndex index_;
 };
 
 } // namespace protobuf
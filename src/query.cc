@@ -30,6 +30,7 @@
 #include <loom/logger.hpp>
 #include <loom/multi_loom.hpp>
 #include <loom/query_server.hpp>
+#include <loom/socket_server.hpp>
 #include <loom/store.hpp>
 
 const char * help_message =
@@ -37,6 +38,7 @@ const char * help_message =
 "\nArguments:"
 "\n  ROOT_IN         root dirname of dataset in loom store"
 "\n  REQUESTS_IN     filename of requests stream (e.g. requests.pbs.gz)"
+"\n                  or socket address unix:PATH or tcp:HOST:PORT to listen on"
 "\n  CONFIG_IN       filename of query config (e.g. config.pb.gz)"
 "\n  RESPONSES_OUT   filename of responses stream (e.g. responses.pbs.gz)"
 "\n  LOG_OUT         filename of log (e.g. log.pbs.gz)"
@@ -44,6 +46,9 @@ const char * help_message =
 "\nNotes:"
 "\n  Any filename can end with .gz to indicate gzip compression."
 "\n  Any filename can be '-' or '-.gz' to indicate stdin/stdout."
+"\n  When listening on a socket, RESPONSES_OUT must be '-';"
+"\n  each client connection is a stream of requests and responses,"
+"\n  and all clients share one pool of config.query.threads workers."
 ;
 
 int main (int argc, char ** argv)
@@ -65,15 +70,35 @@ int main (int argc, char ** argv)
     const auto paths = loom::store::get_paths(root_in);
     const char * rows_in = paths.ingest.diffs.c_str();
 
+    const auto config = loom::protobuf_load<loom::protobuf::Config>(config_in);
     const bool load_groups = true;
     const bool load_assign = false;
     const bool load_tares = true;
-    loom::MultiLoom engine(root_in, load_groups, load_assign, load_tares);
-    const auto config = loom::protobuf_load<loom::protobuf::Config>(config_in);
-    loom::QueryServer server(engine.cross_cats(), config, rows_in);
+    loom::MultiLoom engine(
+        root_in,
+        load_groups,
+        load_assign,
+        load_tares,
+        config.query().load_threads());
+    std::vector<std::string> assigns_in;
+    for (const auto & sample : paths.samples) {
+        assigns_in.push_back(sample.assign);
+    }
+    loom::QueryServer server(
+        engine.cross_cats(),
+        config,
+        rows_in,
+        assigns_in);
     loom::rng_t rng(config.seed());
 
-    server.serve(rng, requests_in, responses_out);
+    if (loom::is_socket_address(requests_in)) {
+        LOOM_ASSERT(
+            std::string(responses_out) == "-",
+            "RESPONSES_OUT must be '-' when listening on a socket");
+        server.serve_socket(rng, loom::listen_address(requests_in));
+    } else {
+        server.serve(rng, requests_in, responses_out);
+    }
 
     return 0;
 }
@@ -25,7 +25,13 @@
 // TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 // USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+#include <deque>
+#include <memory>
+#include <thread>
+#include <fstream>
+#include <unordered_map>
 #include <loom/query_server.hpp>
+#include <loom/socket_server.hpp>
 #include <loom/compressed_vector.hpp>
 #include <loom/scorer.hpp>
 #include <loom/cat_kernel.hpp>
@@ -33,35 +39,297 @@
 namespace loom
 {
 
+namespace
+{
+// A socket connection is closed once its reader has hit end of stream
+// and every response to its requests has been written.
+class Connection : noncopyable
+{
+public:
+
+    Connection (int fid) :
+        fid_(fid),
+        responses_(new protobuf::OutFile(fid))
+    {
+    }
+
+    ~Connection ()
+    {
+        responses_->flush();
+        responses_.reset();
+        close(fid_);
+    }
+
+    int fid () const { return fid_; }
+
+    void write (const protobuf::Query::Response & response)
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        responses_->write_stream(response);
+        responses_->flush();
+    }
+
+private:
+
+    const int fid_;
+    std::unique_ptr<protobuf::OutFile> responses_;
+    std::mutex mutex_;
+};
+
+class RequestQueue : noncopyable
+{
+public:
+
+    struct Task
+    {
+        uint64_t seed;
+        protobuf::Query::Request request;
+        std::shared_ptr<Connection> connection;
+    };
+
+    RequestQueue (size_t capacity) :
+        capacity_(capacity),
+        closed_(false)
+    {
+        LOOM_ASSERT_LT(0, capacity_);
+    }
+
+    void push (
+            uint64_t seed,
+            protobuf::Query::Request & request,
+            std::shared_ptr<Connection> connection = nullptr)
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        not_full_.wait(lock, [&](){ return queue_.size() < capacity_; });
+        queue_.resize(queue_.size() + 1);
+        queue_.back().seed = seed;
+        queue_.back().request.Swap(& request);
+        queue_.back().connection = std::move(connection);
+        not_empty_.notify_one();
+    }
+
+    bool try_pop (Task & task)
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        not_empty_.wait(lock, [&](){ return closed_ or not queue_.empty(); });
+        if (queue_.empty()) {
+            return false;
+        }
+        task.seed = queue_.front().seed;
+        task.request.Swap(& queue_.front().request);
+        task.connection = std::move(queue_.front().connection);
+        queue_.pop_front();
+        not_full_.notify_one();
+        return true;
+    }
+
+    void close ()
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        closed_ = true;
+        not_empty_.notify_all();
+    }
+
+private:
+
+    const size_t capacity_;
+    bool closed_;
+    std::deque<Task> queue_;
+    std::mutex mutex_;
+    std::condition_variable not_empty_;
+    std::condition_variable not_full_;
+};
+} // anonymous namespace
+
+void QueryServer::init_feature_supports ()
+{
+    const CrossCat & cross_cat = * cross_cats_[0];
+    feature_supports_.resize(cross_cat.schema.total_size(), 0);
+    for (const auto & kind : cross_cat.kinds) {
+        const auto & features = kind.model.features;
+        for (size_t i = 0; i < features.bb.size(); ++i) {
+            feature_supports_[features.bb.index(i)] = 2;
+        }
+        for (size_t i = 0; i < features.dd16.size(); ++i) {
+            feature_supports_[features.dd16.index(i)] = features.dd16[i].dim;
+        }
+        for (size_t i = 0; i < features.dd256.size(); ++i) {
+            feature_supports_[features.dd256.index(i)] = features.dd256[i].dim;
+        }
+    }
+}
+
 void QueryServer::serve (
         rng_t & rng,
         const char * requests_in,
         const char * responses_out)
 {
-    protobuf::InFile query_stream(requests_in);
-    protobuf::OutFile response_stream(responses_out);
-    protobuf::Query::Request request;
-    protobuf::Query::Response response;
+    protobuf::InFile requests(requests_in);
+    protobuf::OutFile responses(responses_out);
+    serve(rng, requests, responses);
+}
+
+void QueryServer::serve (
+        rng_t & rng,
+        int requests_fid,
+        int responses_fid)
+{
+    protobuf::InFile requests(requests_fid);
+    protobuf::OutFile responses(responses_fid);
+    serve(rng, requests, responses);
+}
+
+void QueryServer::serve (
+        rng_t & rng,
+        protobuf::InFile & requests,
+        protobuf::OutFile & responses)
+{
+    const size_t thread_count = config_.query().threads();
+    if (thread_count > 1) {
+        serve_parallel(rng, requests, responses, thread_count);
+    } else {
+        serve_serial(rng, requests, responses);
+    }
+}
+
+void QueryServer::serve_serial (
+        rng_t & rng,
+        protobuf::InFile & requests,
+        protobuf::OutFile & responses)
+{
+    Query::Request request;
+    Query::Response response;
 
-    while (query_stream.try_read_stream(request)) {
+    while (requests.try_read_stream(request)) {
         Timer::Scope timer(timer_);
-        response.Clear();
-        response.set_id(request.id());
-        Errors & errors = * response.mutable_error();
-        if (request.has_sample() and validate(request.sample(), errors)) {
-            call(rng, request.sample(), * response.mutable_sample());
-        }
-        if (request.has_score() and validate(request.score(), errors)) {
-            call(rng, request.score(), * response.mutable_score());
-        }
-        if (request.has_entropy() and validate(request.entropy(), errors)) {
-            call(rng, request.entropy(), * response.mutable_entropy());
-        }
-        if (request.has_score_derivative() and validate(request.score_derivative(), errors)) {
-            call(rng, request.score_derivative(), * response.mutable_score_derivative());
-        }
-        response_stream.write_stream(response);
-        response_stream.flush();
+        rng_t request_rng(rng());
+        process(request_rng, request, response);
+        responses.write_stream(response);
+        responses.flush();
+    }
+}
+
+// Requests are read ahead and processed by a pool of workers.
+// Responses are written as soon as they are ready, possibly out of order,
+// and are matched to requests by id. Each request is seeded in read order,
+// so results do not depend on thread_count or scheduling.
+void QueryServer::serve_parallel (
+        rng_t & rng,
+        protobuf::InFile & requests,
+        protobuf::OutFile & responses,
+        size_t thread_count)
+{
+    RequestQueue queue(2 * thread_count);
+    std::mutex responses_mutex;
+
+    std::vector<std::thread> workers;
+    for (size_t i = 0; i < thread_count; ++i) {
+        workers.push_back(std::thread([&](){
+            RequestQueue::Task task;
+            Query::Response response;
+            while (queue.try_pop(task)) {
+                rng_t request_rng(task.seed);
+                process(request_rng, task.request, response);
+                std::unique_lock<std::mutex> lock(responses_mutex);
+                responses.write_stream(response);
+                responses.flush();
+            }
+        }));
+    }
+
+    Query::Request request;
+    while (requests.try_read_stream(request)) {
+        queue.push(rng(), request);
+    }
+    queue.close();
+
+    for (auto & worker : workers) {
+        worker.join();
+    }
+}
+
+// Each connection gets a reader thread that feeds a single request queue
+// shared by all connections, so thread_count workers serve every client.
+// Requests are seeded per connection in read order.
+void QueryServer::serve_socket (rng_t & rng, int listen_fid)
+{
+    signal(SIGPIPE, SIG_IGN);  // clients may hang up early
+
+    const size_t thread_count = std::max(1U, config_.query().threads());
+    RequestQueue queue(2 * thread_count);
+
+    std::vector<std::thread> workers;
+    for (size_t i = 0; i < thread_count; ++i) {
+        workers.push_back(std::thread([&](){
+            RequestQueue::Task task;
+            Query::Response response;
+            while (queue.try_pop(task)) {
+                rng_t request_rng(task.seed);
+                process(request_rng, task.request, response);
+                task.connection->write(response);
+                task.connection.reset();
+            }
+        }));
+    }
+
+    while (true) {
+        auto connection = std::make_shared<Connection>(accept_retry(listen_fid));
+        const auto seed = rng();
+        std::thread([&queue, connection, seed](){
+            rng_t connection_rng(seed);
+            protobuf::InFile requests(connection->fid());
+            Query::Request request;
+            while (requests.try_read_stream(request)) {
+                queue.push(connection_rng(), request, connection);
+            }
+        }).detach();
+    }
+}
+
+void QueryServer::process (
+        rng_t & rng,
+        const Query::Request & request,
+        Query::Response & response)
+{
+    // score_derivative temporarily modifies cross_cats_
+    const bool exclusive = request.has_score_derivative();
+    if (exclusive) {
+        mutex_.lock();
+    } else {
+        mutex_.lock_shared();
+    }
+
+    response.Clear();
+    response.set_id(request.id());
+    Errors & errors = * response.mutable_error();
+    if (request.has_sample() and validate(request.sample(), errors)) {
+        call(rng, request.sample(), * response.mutable_sample());
+    }
+    if (request.has_batch_sample() and validate(request.batch_sample(), errors)) {
+        call(rng, request.batch_sample(), * response.mutable_batch_sample());
+    }
+    if (request.has_score() and validate(request.score(), errors)) {
+        call(rng, request.score(), * response.mutable_score());
+    }
+    if (request.has_batch_score() and validate(request.batch_score(), errors)) {
+        call(rng, request.batch_score(), * response.mutable_batch_score());
+    }
+    if (request.has_entropy() and validate(request.entropy(), errors)) {
+        call(rng, request.entropy(), * response.mutable_entropy());
+    }
+    if (request.has_batch_entropy() and
+        validate(request.batch_entropy(), errors))
+    {
+        call(rng, request.batch_entropy(), * response.mutable_batch_entropy());
+    }
+    if (request.has_score_derivative() and validate(request.score_derivative(), errors)) {
+        call(rng, request.score_derivative(), * response.mutable_score_derivative());
+    }
+
+    if (exclusive) {
+        mutex_.unlock();
+    } else {
+        mutex_.unlock_shared();
     }
 }
 
@@ -95,17 +363,38 @@ void QueryServer::call (
     const size_t latent_count = cross_cats_.size();
     std::vector<std::vector<VectorFloat>> latent_kind_scores(latent_count);
     VectorFloat latent_scores(latent_count, 0.f);
+    size_t total_kind_count = 0;
+    size_t pruned_kind_count = 0;
     {
         std::vector<ProductValue::Diff> conditional_diffs;
+        std::vector<bool> kind_is_requested;
         for (size_t l = 0; l < latent_count; ++l) {
             const auto & cross_cat = * cross_cats_[l];
             auto & kind_scores = latent_kind_scores[l];
             cross_cat.splitter.split(request.data(), conditional_diffs);
 
             const size_t kind_count = cross_cat.kinds.size();
+            kind_is_requested.clear();
+            kind_is_requested.resize(kind_count, false);
+            schema().for_each(request.to_sample(), [&](size_t f){
+                kind_is_requested[cross_cat.featureid_to_kindid[f]] = true;
+            });
+
             kind_scores.resize(kind_count);
+            total_kind_count += kind_count;
             for (size_t k = 0; k < kind_count; ++k) {
                 const ProductValue::Diff & diff = conditional_diffs[k];
+                const bool kind_is_observed =
+                    diff.tares_size() or
+                    cross_cat.schema.observed_count(diff.pos().observed());
+
+                // unobserved kinds contribute nothing to latent_scores
+                // and unrequested kinds are not sampled
+                if (not (kind_is_observed or kind_is_requested[k])) {
+                    ++pruned_kind_count;
+                    continue;
+                }
+
                 auto & kind = cross_cat.kinds[k];
                 const ProductModel & model = kind.model;
                 auto & mixture = kind.mixture;
@@ -118,12 +407,16 @@ void QueryServer::call (
                 }
 
                 latent_scores[l] += distributions::log_sum_exp(scores);
-                distributions::scores_to_probs(scores);
+                if (kind_is_requested[k]) {
+                    distributions::scores_to_probs(scores);
+                }
             }
         }
 
         distributions::scores_to_probs(latent_scores);
     }
+    response.set_kind_count(total_kind_count);
+    response.set_pruned_kind_count(pruned_kind_count);
 
     const size_t sample_count = request.sample_count();
     std::vector<size_t> latent_counts(latent_count, 0);
@@ -169,6 +462,38 @@ void QueryServer::call (
     }
 }
 
+bool QueryServer::validate (
+        const Query::BatchSample::Request & request,
+        Errors & errors) const
+{
+    for (const auto & entry : request.entries()) {
+        if (not validate(entry, errors)) {
+            * errors.Add() = "invalid request.batch_sample.entries";
+            return false;
+        }
+    }
+
+    return true;
+}
+
+void QueryServer::call (
+        rng_t & rng,
+        const Query::BatchSample::Request & request,
+        Query::BatchSample::Response & response) const
+{
+    const size_t entry_count = request.entries_size();
+    for (size_t i = 0; i < entry_count; ++i) {
+        response.add_entries();
+    }
+    const auto seed = rng();
+
+    #pragma omp parallel for if(config_.query().parallel()) schedule(dynamic, 1)
+    for (size_t i = 0; i < entry_count; ++i) {
+        rng_t rng(seed + i);
+        call(rng, request.entries(i), * response.mutable_entries(i));
+    }
+}
+
 bool QueryServer::validate (
         const Query::Score::Request & request,
         Errors & errors) const
@@ -191,6 +516,13 @@ void QueryServer::call (
         rng_t & rng,
         const Query::Score::Request & request,
         Query::Score::Response & response) const
+{
+    response.set_score(score(rng, request.data()));
+}
+
+float QueryServer::score (
+        rng_t & rng,
+        const ProductValue::Diff & data) const
 {
     // not freed
     static thread_local std::vector<ProductValue::Diff> *
@@ -206,7 +538,7 @@ void QueryServer::call (
         const auto & cross_cat = * cross_cats_[l];
         float & score = latent_scores[l];
 
-        cross_cat.splitter.split(request.data(), *partial_diffs);
+        cross_cat.splitter.split(data, *partial_diffs);
 
         const size_t kind_count = cross_cat.kinds.size();
         for (size_t k = 0; k < kind_count; ++k) {
@@ -225,9 +557,49 @@ void QueryServer::call (
             }
         }
     }
-    float score = distributions::log_sum_exp(latent_scores)
-                - distributions::fast_log(latent_count);
-    response.set_score(score);
+    return distributions::log_sum_exp(latent_scores)
+         - distributions::fast_log(latent_count);
+}
+
+bool QueryServer::validate (
+        const Query::BatchScore::Request & request,
+        Errors & errors) const
+{
+    for (const ProductValue::Diff & data : request.data()) {
+        if (not schema().is_valid(data)) {
+            * errors.Add() = "invalid request.batch_score.data";
+            return false;
+        }
+        for (auto id : data.tares()) {
+            if (id >= tares().size()) {
+                * errors.Add() = "invalid request.batch_score.data.tares";
+                return false;
+            }
+        }
+    }
+
+    return true;
+}
+
+void QueryServer::call (
+        rng_t & rng,
+        const Query::BatchScore::Request & request,
+        Query::BatchScore::Response & response) const
+{
+    const size_t row_count = request.data_size();
+    std::vector<float> scores(row_count);
+    const auto seed = rng();
+
+    #pragma omp parallel for if(config_.query().parallel()) schedule(dynamic, 16)
+    for (size_t i = 0; i < row_count; ++i) {
+        rng_t rng(seed + i);
+        scores[i] = score(rng, request.data(i));
+    }
+
+    response.mutable_scores()->Reserve(row_count);
+    for (float row_score : scores) {
+        response.add_scores(row_score);
+    }
 }
 
 bool QueryServer::validate (
@@ -260,6 +632,34 @@ bool QueryServer::validate (
         * errors.Add() = "invalid request.entropy.sample_count";
         return false;
     }
+    if (request.max_sample_count() and
+        request.max_sample_count() < request.sample_count())
+    {
+        * errors.Add() = "invalid request.entropy.max_sample_count";
+        return false;
+    }
+    if (request.target_stderr() < 0) {
+        * errors.Add() = "invalid request.entropy.target_stderr";
+        return false;
+    }
+    if (request.time_budget() < 0) {
+        * errors.Add() = "invalid request.entropy.time_budget";
+        return false;
+    }
+
+    return true;
+}
+
+bool QueryServer::validate (
+        const Query::BatchEntropy::Request & request,
+        Errors & errors) const
+{
+    for (const auto & entry : request.entries()) {
+        if (not validate(entry, errors)) {
+            * errors.Add() = "invalid request.batch_entropy.entries";
+            return false;
+        }
+    }
 
     return true;
 }
@@ -298,6 +698,16 @@ public:
     {
         return group_.count_times_variance / (group_.count - 1);
     }
+
+    float variance_of_mean () const
+    {
+        return variance() / group_.count;
+    }
+
+    size_t count () const
+    {
+        return group_.count;
+    }
 };
 } // anonymous namespace
 
@@ -306,50 +716,11 @@ void QueryServer::call (
         const Query::Entropy::Request & request,
         Query::Entropy::Response & response) const
 {
-    Query::Sample::Request sample_request;
-    Query::Sample::Response sample_response;
-    Errors errors;
-
-    * sample_request.mutable_data() = request.conditional();
-    sample_request.set_sample_count(request.sample_count());
-    auto & to_sample = * sample_request.mutable_to_sample();
-    schema().clear(to_sample);
-    schema().normalize_dense(to_sample);
-    for (const auto & feature_set : request.row_sets()) {
-        schema().for_each(feature_set, [&](int i){
-            to_sample.set_dense(i, true);
-        });
-    }
-    for (const auto & feature_set : request.col_sets()) {
-        schema().for_each(feature_set, [&](int i){
-            to_sample.set_dense(i, true);
-        });
-    }
-    LOOM_ASSERT1(validate(sample_request, errors), errors);
-    call(rng, sample_request, sample_response);
-
-    Query::Score::Request score_request;
-    Query::Score::Response score_response;
-    * score_request.mutable_data() = request.conditional();
-    LOOM_ASSERT1(validate(score_request, errors), errors);
-    call(rng, score_request, score_response);
-    const float base_score = score_response.score();
-
     const size_t row_count = request.row_sets_size();
     const size_t col_count = request.col_sets_size();
     const size_t cell_count = row_count * col_count;
     const size_t latent_count = cross_cats_.size();
 
-    std::vector<RestrictionScorer *> scorers(latent_count, nullptr);
-    for (size_t l = 0; l < latent_count; ++l) {
-        scorers[l] = new RestrictionScorer(
-            *cross_cats_[l],
-            request.conditional(),
-            rng);
-    }
-    const float score_shift =
-        distributions::fast_log(latent_count) + base_score;
-
     CompressedVector<ProductValue::Observed> tasks;
     ProductValue::Observed union_set;
     for (size_t i = 0; i < row_count; ++i) {
@@ -365,49 +736,305 @@ void QueryServer::call (
         }
     }
     tasks.init_index();
-
     const size_t task_count = tasks.unique_count();
+
+    // Samples are drawn in rounds of sample_count. Without a target_stderr
+    // or time_budget there is exactly one round. Otherwise rounds continue
+    // until every task meets the target, the budget runs out, or
+    // max_sample_count samples are drawn; each round samples and scores
+    // only the tasks still short of the target.
+    const bool adaptive =
+        request.target_stderr() > 0 or request.time_budget() > 0;
+    const size_t round_size = request.sample_count();
+    const size_t max_sample_count =
+        not adaptive ? round_size :
+        request.max_sample_count() ? request.max_sample_count() :
+        16 * round_size;
+    const usec_t deadline = request.time_budget() > 0
+        ? current_time_usec() + usec_t(1e6 * request.time_budget())
+        : 0;
+    Errors errors;
+    Query::Score::Request score_request;
+    Query::Score::Response score_response;
+    * score_request.mutable_data() = request.conditional();
+    LOOM_ASSERT1(validate(score_request, errors), errors);
+    call(rng, score_request, score_response);
+    const float base_score = score_response.score();
+    const float score_shift =
+        distributions::fast_log(latent_count) + base_score;
+
+    // Feature sets with small discrete support are computed exactly. This
+    // depends only on support sizes, so it is decided up front and the
+    // enumerations run in parallel. A mutual information may then mix
+    // exact and sampled terms, whose errors no longer cancel; see using.md.
+    ProductValue::Observed observed = request.conditional().pos().observed();
+    schema().normalize_dense(observed);
+    std::vector<ProductValue::Observed> task_sets(task_count);
+    std::vector<float> exact_entropies(task_count, 0);
+    std::vector<bool> is_exact(task_count, false);
+    std::vector<size_t> exact_tasks;
+    std::vector<size_t> active;
     for (size_t t = 0; t < task_count; ++t) {
-        tasks.unique_value(t, union_set);
-        for (size_t l = 0; l < latent_count; ++l) {
-            scorers[l]->add_restriction(union_set);
+        tasks.unique_value(t, task_sets[t]);
+        is_exact[t] = has_exact_entropy(observed, task_sets[t]);
+        if (is_exact[t]) {
+            exact_tasks.push_back(t);
+        } else {
+            active.push_back(t);
         }
     }
+    const auto exact_seed = rng();
+    const size_t exact_count = exact_tasks.size();
+    #pragma omp parallel for if(config_.query().parallel()) schedule(dynamic, 1)
+    for (size_t i = 0; i < exact_count; ++i) {
+        const size_t t = exact_tasks[i];
+        rng_t task_rng(exact_seed + t);
+        exact_entropies[t] = exact_entropy(
+            task_rng,
+            request.conditional(),
+            task_sets[t],
+            base_score);
+    }
 
+    Query::Sample::Request sample_request;
+    Query::Sample::Response sample_response;
+    * sample_request.mutable_data() = request.conditional();
+    auto & to_sample = * sample_request.mutable_to_sample();
+    auto draw_samples = [&](size_t sample_count){
+        schema().clear(to_sample);
+        schema().normalize_dense(to_sample);
+        for (size_t t : active) {
+            tasks.unique_value(t, union_set);
+            schema().for_each(union_set, [&](size_t f){
+                to_sample.set_dense(f, true);
+            });
+        }
+        sample_request.set_sample_count(sample_count);
+        LOOM_ASSERT1(validate(sample_request, errors), errors);
+        sample_response.Clear();
+        call(rng, sample_request, sample_response);
+    };
+
+    // Restrictions are scored in tiles of at most tile_size^2 feature sets
+    // to bound memory, but every tile reuses the same samples.
+    const size_t tile_size = request.tile_size();
     std::vector<Accum> accums(task_count);
-    #pragma omp parallel if(config_.query().parallel())
-    {
-        VectorFloat scores(latent_count);
-        for (const auto & sample : sample_response.samples()) {
+    std::vector<RestrictionScorer *> scorers(latent_count, nullptr);
+    size_t sample_count = 0;
+    while (not active.empty()) {
+        const size_t round =
+            std::min(round_size, max_sample_count - sample_count);
+        draw_samples(round);
+        sample_count += round;
+
+        const size_t active_count = active.size();
+        const size_t tile_task_count = tile_size
+            ? std::max<size_t>(1, tile_size * tile_size)
+            : active_count;
+        for (size_t begin = 0; begin < active_count; begin += tile_task_count) {
+            const size_t end = std::min(active_count, begin + tile_task_count);
 
-            #pragma omp barrier
-            #pragma omp for
             for (size_t l = 0; l < latent_count; ++l) {
-                scorers[l]->set_value(sample.pos(), rng);
+                scorers[l] = new RestrictionScorer(
+                    *cross_cats_[l],
+                    request.conditional(),
+                    rng);
             }
-
-            #pragma omp barrier
-            #pragma omp for
-            for (size_t t = 0; t < task_count; ++t) {
+            for (size_t i = begin; i < end; ++i) {
+                tasks.unique_value(active[i], union_set);
                 for (size_t l = 0; l < latent_count; ++l) {
-                    scores[l] = scorers[l]->get_score(t);
+                    scorers[l]->add_restriction(union_set);
                 }
-                float score = score_shift - distributions::log_sum_exp(scores);
+            }
+
+            #pragma omp parallel if(config_.query().parallel())
+            {
+                VectorFloat scores(latent_count);
+                for (const auto & sample : sample_response.samples()) {
+
+                    #pragma omp barrier
+                    #pragma omp for
+                    for (size_t l = 0; l < latent_count; ++l) {
+                        scorers[l]->set_value(sample.pos(), rng);
+                    }
+
+                    #pragma omp barrier
+                    #pragma omp for
+                    for (size_t i = begin; i < end; ++i) {
+                        for (size_t l = 0; l < latent_count; ++l) {
+                            scores[l] = scorers[l]->get_score(i - begin);
+                        }
+                        float score =
+                            score_shift - distributions::log_sum_exp(scores);
 
-                // FIXME this should be atomic
-                accums[t].add(score);
+                        // FIXME this should be atomic
+                        accums[active[i]].add(score);
+                    }
+                }
+            }
+
+            for (auto & scorer : scorers) {
+                delete scorer;
+                scorer = nullptr;
             }
         }
-    }
 
-    for (auto scorer : scorers) {
-        delete scorer;
+        if (not adaptive or sample_count >= max_sample_count) {
+            break;
+        }
+        if (deadline and current_time_usec() >= deadline) {
+            break;
+        }
+        if (request.target_stderr() > 0) {
+            const float target_variance =
+                request.target_stderr() * request.target_stderr();
+            active.erase(
+                std::remove_if(active.begin(), active.end(), [&](size_t t){
+                    return accums[t].variance_of_mean() <= target_variance;
+                }),
+                active.end());
+        }
     }
+
     for (size_t i = 0; i < cell_count; ++i) {
-        const Accum & accum = accums[tasks.unique_id(i)];
-        response.add_means(accum.mean());
-        response.add_variances(accum.variance() / request.sample_count());
+        const size_t t = tasks.unique_id(i);
+        if (is_exact[t]) {
+            response.add_means(exact_entropies[t]);
+            response.add_variances(0);
+            response.add_sample_counts(0);
+        } else {
+            const Accum & accum = accums[t];
+            response.add_means(accum.mean());
+            response.add_variances(accum.variance_of_mean());
+            response.add_sample_counts(accum.count());
+        }
+    }
+}
+
+// Entries run one after another, since each entropy is parallel inside.
+void QueryServer::call (
+        rng_t & rng,
+        const Query::BatchEntropy::Request & request,
+        Query::BatchEntropy::Response & response) const
+{
+    for (const auto & entry : request.entries()) {
+        call(rng, entry, * response.add_entries());
+    }
+}
+
+// The entropy of feature_set given conditional can be computed by
+// enumerating the joint support if every feature is bb or dd, none is
+// already observed in conditional, and the support size is at most
+// config.query.exact_entropy_max_support. The empty set always qualifies.
+bool QueryServer::has_exact_entropy (
+        const ProductValue::Observed & conditional_observed,
+        const ProductValue::Observed & feature_set) const
+{
+    const size_t max_support = config_.query().exact_entropy_max_support();
+    size_t support = 1;
+    bool exact = true;
+    schema().for_each(feature_set, [&](size_t f){
+        const size_t dim = feature_supports_[f];
+        if (dim == 0 or conditional_observed.dense(f) or
+                support * dim > max_support) {
+            exact = false;
+        } else {
+            support *= dim;
+        }
+    });
+    return exact;
+}
+
+// Computes the entropy of feature_set given conditional by enumerating
+// its joint support; see has_exact_entropy.
+float QueryServer::exact_entropy (
+        rng_t & rng,
+        const ProductValue::Diff & conditional,
+        const ProductValue::Observed & feature_set,
+        float base_score) const
+{
+    ProductValue::Observed observed = conditional.pos().observed();
+    schema().normalize_dense(observed);
+    std::vector<size_t> featureids;
+    size_t support = 1;
+    schema().for_each(feature_set, [&](size_t f){
+        support *= feature_supports_[f];
+        featureids.push_back(f);
+    });
+    if (featureids.empty()) {
+        return 0;
+    }
+
+    // lay out the conditional's values plus placeholders for feature_set
+    const size_t size = schema().total_size();
+    const size_t booleans_end = schema().booleans_size;
+    const size_t counts_end = booleans_end + schema().counts_size;
+    std::vector<int> feature_pos(size, -1);
+    for (size_t i = 0; i < featureids.size(); ++i) {
+        feature_pos[featureids[i]] = i;
+        observed.set_dense(featureids[i], true);
+    }
+    ProductValue::Diff diff = conditional;
+    const ProductValue & given = conditional.pos();
+    ProductValue & value = * diff.mutable_pos();
+    value.Clear();
+    * value.mutable_observed() = observed;
+    std::vector<int> slots(featureids.size());
+    size_t b = 0;
+    size_t c = 0;
+    size_t r = 0;
+    for (size_t f = 0; f < size; ++f) {
+        if (not observed.dense(f)) {
+            continue;
+        }
+        const int i = feature_pos[f];
+        if (f < booleans_end) {
+            if (i >= 0) {
+                slots[i] = value.booleans_size();
+                value.add_booleans(false);
+            } else {
+                value.add_booleans(given.booleans(b++));
+            }
+        } else if (f < counts_end) {
+            if (i >= 0) {
+                slots[i] = value.counts_size();
+                value.add_counts(0);
+            } else {
+                value.add_counts(given.counts(c++));
+            }
+        } else {
+            value.add_reals(given.reals(r++));
+        }
     }
+
+    VectorFloat scores(support);
+    std::vector<uint32_t> point(featureids.size(), 0);
+    for (size_t s = 0; s < support; ++s) {
+        for (size_t i = 0; i < featureids.size(); ++i) {
+            if (featureids[i] < booleans_end) {
+                value.set_booleans(slots[i], point[i]);
+            } else {
+                value.set_counts(slots[i], point[i]);
+            }
+        }
+        scores[s] = score(rng, diff) - base_score;
+
+        for (size_t i = 0; i < point.size(); ++i) {
+            if (++point[i] < feature_supports_[featureids[i]]) {
+                break;
+            }
+            point[i] = 0;
+        }
+    }
+
+    // renormalize, to absorb rounding error
+    const float log_total = distributions::log_sum_exp(scores);
+    float entropy = 0;
+    for (float log_prob : scores) {
+        log_prob -= log_total;
+        entropy -= expf(log_prob) * log_prob;
+    }
+    return entropy;
 }
 
 bool QueryServer::validate (
@@ -441,108 +1068,280 @@ bool QueryServer::validate (
 }
 
 // not threadsafe
-void QueryServer::call (
+bool QueryServer::load_group_index () const
+{
+    if (group_index_loaded_) {
+        return not group_index_.empty();
+    }
+    group_index_loaded_ = true;
+
+    const size_t latent_count = cross_cats_.size();
+    if (assigns_in_.size() != latent_count) {
+        return false;
+    }
+    for (const auto & assign_in : assigns_in_) {
+        if (not std::ifstream(assign_in.c_str())) {
+            return false;
+        }
+    }
+
+    group_index_.resize(latent_count);
+    #pragma omp parallel for if(config_.query().parallel()) schedule(dynamic, 1)
+    for (size_t l = 0; l < latent_count; ++l) {
+        const size_t kind_count = cross_cats_[l]->kinds.size();
+        auto & kind_index = group_index_[l];
+        kind_index.resize(kind_count);
+
+        protobuf::InFile assignments(assigns_in_[l].c_str());
+        protobuf::Assignment assignment;
+        while (assignments.try_read_stream(assignment)) {
+            LOOM_ASSERT_EQ(assignment.groupids_size(), kind_count);
+            for (size_t k = 0; k < kind_count; ++k) {
+                const size_t groupid = assignment.groupids(k);
+                auto & group_rowids = kind_index[k];
+                if (group_rowids.size() <= groupid) {
+                    group_rowids.resize(groupid + 1);
+                }
+                group_rowids[groupid].push_back(assignment.rowid());
+            }
+        }
+    }
+
+    group_index_row_count_ = 0;
+    for (const auto & group_rowids : group_index_[0][0]) {
+        group_index_row_count_ += group_rowids.size();
+    }
+
+    return true;
+}
+
+// Candidates are the rows that most often share the update row's most
+// likely group, voting over all kinds where the update row is observed
+// and over all latent samples.
+// not threadsafe
+bool QueryServer::find_candidates (
         rng_t & rng,
-        const Query::ScoreDerivative::Request & request,
-        Query::ScoreDerivative::Response & response) const
+        const ProductValue::Diff & data,
+        size_t min_count,
+        size_t max_count,
+        std::unordered_set<uint64_t> & candidates) const
 {
+    candidates.clear();
+    if (not load_group_index()) {
+        return false;
+    }
+
+    std::unordered_map<uint64_t, uint32_t> votes;
+    std::vector<ProductValue::Diff> partial_diffs;
+    VectorFloat scores;
     const size_t latent_count = cross_cats_.size();
+    for (size_t l = 0; l < latent_count; ++l) {
+        const auto & cross_cat = * cross_cats_[l];
+        cross_cat.splitter.split(data, partial_diffs);
 
-    Query::Score::Request score_request;
-    Query::Score::Response score_response;
+        const size_t kind_count = cross_cat.kinds.size();
+        for (size_t k = 0; k < kind_count; ++k) {
+            const ProductValue::Diff & diff = partial_diffs[k];
+            auto & kind = cross_cat.kinds[k];
+            const ProductModel & model = kind.model;
+            auto & mixture = kind.mixture;
 
-    protobuf::Assignment assignment;
-    protobuf::Row row;
+            if (diff.tares_size()) {
+                mixture.score_diff(model, diff, scores, rng);
+            } else if (cross_cat.schema.observed_count(diff.pos().observed())) {
+                mixture.score_value(model, diff.pos(), scores, rng);
+            } else {
+                continue;
+            }
 
-    std::vector<protobuf::Assignment> assignments;
-    std::vector<CatKernel *> cat_kernels;
+            const size_t packed = std::max_element(scores.begin(), scores.end())
+                                - scores.begin();
+            const size_t groupid = mixture.id_tracker.packed_to_global(packed);
+            const auto & group_rowids = group_index_[l][k];
+            if (groupid < group_rowids.size()) {
+                for (uint64_t rowid : group_rowids[groupid]) {
+                    ++votes[rowid];
+                }
+            }
+        }
+    }
+
+    if (votes.size() < min_count) {
+        return false;
+    }
+
+    typedef std::pair<uint64_t, uint32_t> Vote;
+    std::vector<Vote> ranked(votes.begin(), votes.end());
+    if (ranked.size() > max_count) {
+        std::nth_element(
+            ranked.begin(),
+            ranked.begin() + max_count,
+            ranked.end(),
+            [](const Vote & x, const Vote & y) { return x.second > y.second; });
+        ranked.resize(max_count);
+    }
+    for (const auto & vote : ranked) {
+        candidates.insert(vote.first);
+    }
+
+    return true;
+}
+
+namespace
+{
+
+typedef std::pair<uint64_t, float> ScoreDiff;
+
+inline bool score_diff_greater (const ScoreDiff & x, const ScoreDiff & y)
+{
+    return x.second > y.second;
+}
+
+// a min-heap of the best row_limit score diffs seen so far
+inline void push_bounded (
+        std::vector<ScoreDiff> & heap,
+        const ScoreDiff & score_diff,
+        size_t row_limit)
+{
+    if (heap.size() < row_limit) {
+        heap.push_back(score_diff);
+        std::push_heap(heap.begin(), heap.end(), score_diff_greater);
+    } else if (row_limit and score_diff_greater(score_diff, heap.front())) {
+        std::pop_heap(heap.begin(), heap.end(), score_diff_greater);
+        heap.back() = score_diff;
+        std::push_heap(heap.begin(), heap.end(), score_diff_greater);
+    }
+}
+
+} // anonymous namespace
+
+// Rows are scored in chunks, so memory is bounded by the chunk size plus
+// one bounded heap per thread, regardless of the number of rows.
+// The update row is added with the same seed for every chunk, so that all
+// rows are scored against the same updated model.
+// not threadsafe
+void QueryServer::call (
+        rng_t & rng,
+        const Query::ScoreDerivative::Request & request,
+        Query::ScoreDerivative::Response & response) const
+{
+    const size_t latent_count = cross_cats_.size();
+    const size_t row_limit = request.row_limit();
+    const size_t chunk_size = config_.query().score_derivative_chunk_size();
+    const bool parallel = config_.query().parallel();
 
     protobuf::Row update_row;
     update_row.set_id(0);
     * update_row.mutable_diff() = request.update_data();
-    
-    
-    //FIXME is there a better way to get the row count?
-    size_t row_count = 0;
-    protobuf::InFile all_rows(rows_in_);
-    while (all_rows.try_read_stream(row)) {
-        row_count++;
-    }
-            
+
+    std::vector<protobuf::Assignment> assignments(latent_count);
+    std::vector<CatKernel *> cat_kernels;
     for (const auto * cross_cat : cross_cats_) {
         cat_kernels.push_back(
             new CatKernel(
                 config_.kernels().cat(),
                 * const_cast<CrossCat*>(cross_cat)));
-        assignments.push_back(assignment);
     }
+    const auto update_seed = rng();
 
-    typedef std::pair<int, float> ScoreDiff;
-    std::vector<ScoreDiff> score_diffs;
+    std::vector<ScoreDiff> heap;
+    std::vector<float> before;
+    auto score_chunk = [&](const std::vector<protobuf::Row> & chunk) {
+        const size_t size = chunk.size();
+        const auto seed = rng();
+        before.resize(size);
 
-    {
-        if (request.score_data_size() == 0) {
-            protobuf::InFile all_rows(rows_in_);
-            while (all_rows.try_read_stream(row)) {
-                * score_request.mutable_data() = row.diff();
-                call(rng, score_request, score_response);
-                score_diffs.push_back(
-                    std::make_pair(row.id(), -score_response.score()));
-            }
+        #pragma omp parallel for if(parallel) schedule(dynamic, 16)
+        for (size_t i = 0; i < size; ++i) {
+            rng_t rng(seed + i);
+            before[i] = score(rng, chunk[i].diff());
+        }
+
+        rng_t update_rng(update_seed);
+        for (size_t l = 0; l < latent_count; ++l) {
+            cat_kernels[l]->add_row(update_rng, update_row, assignments[l]);
         }
-        else {
-            for (size_t i = 0; i < request.score_data_size(); i++) {
-                * score_request.mutable_data() = request.score_data(i);
-                call(rng, score_request, score_response);
-                score_diffs.push_back(
-                    std::make_pair(i, -score_response.score()));
+
+        #pragma omp parallel if(parallel)
+        {
+            std::vector<ScoreDiff> thread_heap;
+
+            #pragma omp for schedule(dynamic, 16)
+            for (size_t i = 0; i < size; ++i) {
+                rng_t rng(seed + size + i);
+                const float after = score(rng, chunk[i].diff());
+                push_bounded(
+                    thread_heap,
+                    ScoreDiff(chunk[i].id(), after - before[i]),
+                    row_limit);
+            }
+
+            #pragma omp critical
+            for (const auto & score_diff : thread_heap) {
+                push_bounded(heap, score_diff, row_limit);
             }
         }
-    }
 
-    for (size_t i = 0; i < latent_count; ++i){
-        cat_kernels[i]->add_row(rng, update_row, assignments[i]);
-    }
+        for (size_t l = 0; l < latent_count; ++l) {
+            cat_kernels[l]->remove_row(update_rng, update_row, assignments[l]);
+        }
+    };
 
-    {
-        int i = 0;
-        if (request.score_data_size() == 0) {
-            protobuf::InFile all_rows(rows_in_);
-            while (all_rows.try_read_stream(row)) {
-                * score_request.mutable_data() = row.diff();
-                call(rng, score_request, score_response);
-                score_diffs[i].second += score_response.score();
-                score_diffs[i].second *= row_count;
-                i++;
+    size_t row_count = group_index_row_count_;
+    std::vector<protobuf::Row> chunk;
+    chunk.reserve(chunk_size);
+    if (request.score_data_size()) {
+        const size_t score_count = request.score_data_size();
+        for (size_t i = 0; i < score_count; ++i) {
+            chunk.resize(chunk.size() + 1);
+            chunk.back().set_id(i);
+            * chunk.back().mutable_diff() = request.score_data(i);
+            if (chunk.size() == chunk_size) {
+                score_chunk(chunk);
+                chunk.clear();
             }
         }
-        else {
-            for (size_t i = 0; i < request.score_data_size(); i++) {
-                * score_request.mutable_data() = request.score_data(i);
-                call(rng, score_request, score_response);
-                score_diffs[i].second += score_response.score();
-                score_diffs[i].second *= row_count;
-                i++;
+        if (not row_count) {
+            row_count = protobuf::InFile::stream_stats(rows_in_).message_count;
+        }
+    } else {
+        const size_t candidate_count =
+            row_limit * config_.query().search_candidate_factor();
+        std::unordered_set<uint64_t> candidates;
+        const bool use_candidates = not request.exact() and find_candidates(
+            rng,
+            request.update_data(),
+            row_limit,
+            candidate_count,
+            candidates);
+
+        row_count = 0;
+        protobuf::InFile all_rows(rows_in_);
+        protobuf::Row row;
+        while (all_rows.try_read_stream(row)) {
+            row_count++;
+            if (use_candidates and candidates.find(row.id()) == candidates.end()) {
+                continue;
+            }
+            chunk.push_back(row);
+            if (chunk.size() == chunk_size) {
+                score_chunk(chunk);
+                chunk.clear();
             }
         }
     }
-
-    for (size_t i = 0; i < latent_count; ++i) {
-        cat_kernels[i]->remove_row(rng, update_row, assignments[i]);
-        delete cat_kernels[i];
+    if (not chunk.empty()) {
+        score_chunk(chunk);
     }
 
-    std::sort(score_diffs.begin(), score_diffs.end(),
-            [](const ScoreDiff & a, const ScoreDiff & b) {
-                return a.second > b.second;
-            });
-    if (score_diffs.size() > request.row_limit()) {
-        score_diffs.resize(request.row_limit());
+    for (size_t l = 0; l < latent_count; ++l) {
+        delete cat_kernels[l];
     }
 
-    for (const auto & score_diff : score_diffs) {
+    std::sort_heap(heap.begin(), heap.end(), score_diff_greater);
+    for (const auto & score_diff : heap) {
         response.add_ids(score_diff.first);
-        response.add_score_diffs(score_diff.second);
+        response.add_score_diffs(score_diff.second * row_count);
     }
 }
 
@@ -26,6 +26,8 @@
 
 #pragma once
 
+#include <mutex>
+#include <condition_variable>
 #include <loom/timer.hpp>
 #include <loom/cross_cat.hpp>
 
@@ -42,12 +44,17 @@ public:
     QueryServer (
             const std::vector<const CrossCat *> & cross_cats,
             const protobuf::Config & config,
-            const char * rows_in) :
+            const char * rows_in,
+            const std::vector<std::string> & assigns_in = {}) :
         config_(config),
         cross_cats_(cross_cats),
-        rows_in_(rows_in)
+        rows_in_(rows_in),
+        assigns_in_(assigns_in),
+        group_index_row_count_(0),
+        group_index_loaded_(false)
     {
         LOOM_ASSERT(not cross_cats_.empty(), "no cross cats found");
+        init_feature_supports();
     }
 
     void serve (
@@ -55,8 +62,90 @@ public:
             const char * requests_in,
             const char * responses_out);
 
+    void serve (
+            rng_t & rng,
+            int requests_fid,
+            int responses_fid);
+
+    // serve clients connecting to a listening socket; never returns
+    void serve_socket (rng_t & rng, int listen_fid);
+
 private:
 
+    void serve (
+            rng_t & rng,
+            protobuf::InFile & requests,
+            protobuf::OutFile & responses);
+
+    // Requests may run concurrently, except those that temporarily
+    // modify cross_cats_, which must run alone. Writers take priority.
+    class ReadWriteMutex
+    {
+        std::mutex mutex_;
+        std::condition_variable cond_variable_;
+        size_t reader_count_;
+        size_t writer_count_;
+        bool writing_;
+
+    public:
+
+        ReadWriteMutex () :
+            reader_count_(0),
+            writer_count_(0),
+            writing_(false)
+        {
+        }
+
+        void lock_shared ()
+        {
+            std::unique_lock<std::mutex> lock(mutex_);
+            cond_variable_.wait(lock, [&](){ return writer_count_ == 0; });
+            ++reader_count_;
+        }
+
+        void unlock_shared ()
+        {
+            std::unique_lock<std::mutex> lock(mutex_);
+            if (--reader_count_ == 0) {
+                cond_variable_.notify_all();
+            }
+        }
+
+        void lock ()
+        {
+            std::unique_lock<std::mutex> lock(mutex_);
+            ++writer_count_;
+            cond_variable_.wait(lock, [&](){
+                return reader_count_ == 0 and not writing_;
+            });
+            writing_ = true;
+        }
+
+        void unlock ()
+        {
+            std::unique_lock<std::mutex> lock(mutex_);
+            writing_ = false;
+            --writer_count_;
+            cond_variable_.notify_all();
+        }
+    };
+
+    void serve_serial (
+            rng_t & rng,
+            protobuf::InFile & requests,
+            protobuf::OutFile & responses);
+
+    void serve_parallel (
+            rng_t & rng,
+            protobuf::InFile & requests,
+            protobuf::OutFile & responses,
+            size_t thread_count);
+
+    void process (
+            rng_t & rng,
+            const Query::Request & request,
+            Query::Response & response);
+
     const ValueSchema schema () const { return cross_cats_[0]->schema; }
     const std::vector<ProductValue> tares () const
     {
@@ -67,14 +156,26 @@ private:
             const Query::Sample::Request & request,
             Errors & errors) const;
 
+    bool validate (
+            const Query::BatchSample::Request & request,
+            Errors & errors) const;
+
     bool validate (
             const Query::Score::Request & request,
             Errors & errors) const;
 
+    bool validate (
+            const Query::BatchScore::Request & request,
+            Errors & errors) const;
+
     bool validate (
             const Query::Entropy::Request & request,
             Errors & errors) const;
 
+    bool validate (
+            const Query::BatchEntropy::Request & request,
+            Errors & errors) const;
+
     bool validate (
             const Query::ScoreDerivative::Request & request,
             Errors & errors) const;
@@ -84,16 +185,56 @@ private:
             const Query::Sample::Request & request,
             Query::Sample::Response & response) const;
 
+    void call (
+            rng_t & rng,
+            const Query::BatchSample::Request & request,
+            Query::BatchSample::Response & response) const;
+
     void call (
             rng_t & rng,
             const Query::Score::Request & request,
             Query::Score::Response & response) const;
 
+    void call (
+            rng_t & rng,
+            const Query::BatchScore::Request & request,
+            Query::BatchScore::Response & response) const;
+
     void call (
             rng_t & rng,
             const Query::Entropy::Request & request,
             Query::Entropy::Response & response) const;
 
+    void call (
+            rng_t & rng,
+            const Query::BatchEntropy::Request & request,
+            Query::BatchEntropy::Response & response) const;
+
+    float score (rng_t & rng, const ProductValue::Diff & data) const;
+
+    void init_feature_supports ();
+
+    bool has_exact_entropy (
+            const ProductValue::Observed & conditional_observed,
+            const ProductValue::Observed & feature_set) const;
+
+    float exact_entropy (
+            rng_t & rng,
+            const ProductValue::Diff & conditional,
+            const ProductValue::Observed & feature_set,
+            float base_score) const;
+
+    // not threadsafe
+    bool load_group_index () const;
+
+    // not threadsafe
+    bool find_candidates (
+            rng_t & rng,
+            const ProductValue::Diff & data,
+            size_t min_count,
+            size_t max_count,
+            std::unordered_set<uint64_t> & candidates) const;
+
     // not threadsafe
     void call (
             rng_t & rng,
@@ -103,7 +244,19 @@ private:
     const protobuf::Config config_;
     const std::vector<const CrossCat *> cross_cats_;
     const char * rows_in_;
+    const std::vector<std::string> assigns_in_;
+
+    // number of values of each discrete feature, or 0 if not enumerable
+    std::vector<size_t> feature_supports_;
+
+    // group_index_[l][k][groupid] = rowids of rows assigned to that group
+    typedef std::vector<std::vector<uint64_t>> GroupRowids;
+    mutable std::vector<std::vector<GroupRowids>> group_index_;
+    mutable size_t group_index_row_count_;
+    mutable bool group_index_loaded_;
+
     Timer timer_;
+    ReadWriteMutex mutex_;
 };
 
 } // namespace loom
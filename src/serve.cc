@@ -0,0 +1,93 @@
+// Copyright (c) 2014, Salesforce.com, Inc.  All rights reserved.
+//
+// Redistribution and use in source and binary forms, with or without
+// modification, are permitted provided that the following conditions
+// are met:
+//
+// - Redistributions of source code must retain the above copyright
+//   notice, this list of conditions and the following disclaimer.
+// - Redistributions in binary form must reproduce the above copyright
+//   notice, this list of conditions and the following disclaimer in the
+//   documentation and/or other materials provided with the distribution.
+// - Neither the name of Salesforce.com nor the names of its contributors
+//   may be used to endorse or promote products derived from this
+//   software without specific prior written permission.
+//
+// THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+// "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+// LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+// FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+// COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+// INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+// BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+// OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+// ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+// TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+// USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#include <loom/args.hpp>
+#include <loom/logger.hpp>
+#include <loom/multi_loom.hpp>
+#include <loom/query_server.hpp>
+#include <loom/socket_server.hpp>
+#include <loom/store.hpp>
+
+const char * help_message =
+"Usage: serve ROOT_IN CONFIG_IN ADDRESS LOG_OUT"
+"\nArguments:"
+"\n  ROOT_IN         root dirname of dataset in loom store"
+"\n  CONFIG_IN       filename of query config (e.g. config.pb.gz)"
+"\n  ADDRESS         filename of unix socket to listen on"
+"\n  LOG_OUT         filename of log (e.g. log.pbs.gz)"
+"\n                  or --none to not log"
+"\nNotes:"
+"\n  Each connection is a stream of requests and responses,"
+"\n  as with stdin/stdout of loom_query."
+"\n  Connections are served by forked children that share the loaded model;"
+"\n  config.query.fork_pool_size children are kept waiting for connections."
+;
+
+int main (int argc, char ** argv)
+{
+    GOOGLE_PROTOBUF_VERIFY_VERSION;
+
+    Args args(argc, argv, help_message);
+    const char * root_in = args.pop();
+    const char * config_in = args.pop();
+    const char * address = args.pop();
+    const char * log_out = args.pop_optional_file();
+    args.done();
+
+    if (log_out) {
+        loom::logger.append(log_out);
+    }
+
+    const auto paths = loom::store::get_paths(root_in);
+    const char * rows_in = paths.ingest.diffs.c_str();
+
+    const auto config = loom::protobuf_load<loom::protobuf::Config>(config_in);
+    const bool load_groups = true;
+    const bool load_assign = false;
+    const bool load_tares = true;
+    loom::MultiLoom engine(
+        root_in,
+        load_groups,
+        load_assign,
+        load_tares,
+        config.query().load_threads());
+    std::vector<std::string> assigns_in;
+    for (const auto & sample : paths.samples) {
+        assigns_in.push_back(sample.assign);
+    }
+    loom::QueryServer server(
+        engine.cross_cats(),
+        config,
+        rows_in,
+        assigns_in);
+    loom::rng_t rng(config.seed());
+
+    const int listen_fid = loom::listen_unix(address);
+    loom::serve_forked(server, rng, listen_fid, config.query().fork_pool_size());
+
+    return 0;
+}
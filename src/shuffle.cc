@@ -25,6 +25,7 @@
 // TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 // USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+#include <sstream>
 #include <loom/args.hpp>
 #include <loom/shuffle.hpp>
 
@@ -33,11 +34,14 @@ const char * help_message =
 "\nArguments:"
 "\n  ROWS_IN           filename of input dataset stream (e.g. rows.pbs.gz)"
 "\n  ROWS_OUT          filename of output dataset stream (e.g. rows_out.pbs.gz)"
+"\n                    or a comma-separated list of filenames"
 "\n  SEED              random seed"
 "\n  TARGET_MEM_BYTES  target memory usage in bytes"
 "\nNotes:"
 "\n  Any filename can end with .gz to indicate gzip compression."
 "\n  Any filename can be '-' or '-.gz' to indicate stdin/stdout."
+"\n  Given multiple ROWS_OUT, the input is read once and the i-th output"
+"\n  is shuffled with seed SEED+i, as if shuffled separately."
 ;
 
 int main (int argc, char ** argv)
@@ -53,7 +57,16 @@ int main (int argc, char ** argv)
 
     LOOM_ASSERT_LT(0, target_mem_bytes);
 
-    loom::shuffle_stream(rows_in, rows_out, seed, target_mem_bytes);
+    std::vector<std::string> shuffled_out;
+    std::vector<long> seeds;
+    std::istringstream rows_out_list(rows_out);
+    std::string filename;
+    while (std::getline(rows_out_list, filename, ',')) {
+        seeds.push_back(seed + shuffled_out.size());
+        shuffled_out.push_back(filename);
+    }
+
+    loom::shuffle_streams(rows_in, shuffled_out, seeds, target_mem_bytes);
 
     return 0;
 }
@@ -27,7 +27,12 @@
 
 #pragma once
 
+#include <stdlib.h>
+#include <unistd.h>
+#include <string.h>
 #include <limits>
+#include <memory>
+#include <string>
 #include <algorithm>
 #include <loom/common.hpp>
 #include <loom/protobuf_stream.hpp>
@@ -35,52 +40,212 @@
 namespace loom
 {
 
-inline void shuffle_stream (
+namespace detail
+{
+
+inline std::string shuffle_temp_dir (const char * shuffled_out)
+{
+    std::string parent;
+    const std::string out = shuffled_out;
+    if (out != "-" and out != "-.gz") {
+        const size_t slash = out.find_last_of('/');
+        parent = slash == std::string::npos ? "." : out.substr(0, slash);
+    } else if (const char * tmpdir = getenv("TMPDIR")) {
+        parent = tmpdir;
+    } else {
+        parent = "/tmp";
+    }
+    std::string pattern = parent + "/loom_shuffle.XXXXXX";
+    std::vector<char> buffer(pattern.begin(), pattern.end());
+    buffer.push_back('\0');
+    LOOM_ASSERT(mkdtemp(buffer.data()), "failed to create temp dir in " << parent);
+    return buffer.data();
+}
+
+inline void remove_stream_file (const std::string & filename)
+{
+    unlink(filename.c_str());
+    protobuf::StreamIndex::remove(filename);
+}
+
+} // namespace detail
+
+// This shuffles a stream into one or more outputs, each with its own
+// seed, reading the input at most once per batch of buckets.
+// Small streams are read once into memory. Larger streams are shuffled in
+// two passes: the first pass scatters each message to a temporary bucket
+// file per output, tagged with its target position; the second pass reads
+// one bucket at a time into memory and writes it out in order. Buckets
+// hold consecutive ranges of output positions, so each output depends only
+// on its seed, not on target_mem_bytes or on the other outputs. If there
+// are more buckets than can be open at once, the scatter pass is repeated
+// for each batch of buckets.
+inline void shuffle_streams (
         const char * messages_in,
-        const char * shuffled_out,
-        long seed,
-        double target_mem_bytes)
+        const std::vector<std::string> & shuffled_out,
+        const std::vector<long> & seeds,
+        double target_mem_bytes,
+        size_t max_open_buckets = 256)
 {
     typedef std::vector<char> Message;
     typedef uint32_t pos_t;
 
-    LOOM_ASSERT(
-        std::string(messages_in) != std::string(shuffled_out),
-        "cannot shuffle file in-place: " << messages_in);
+    const size_t output_count = shuffled_out.size();
+    LOOM_ASSERT_EQ(seeds.size(), output_count);
+    LOOM_ASSERT(output_count, "no shuffle outputs");
+    for (const auto & out : shuffled_out) {
+        LOOM_ASSERT(
+            std::string(messages_in) != out,
+            "cannot shuffle file in-place: " << messages_in);
+    }
     const auto stats = protobuf::InFile::stream_stats(messages_in);
     LOOM_ASSERT(stats.is_file, "shuffle input is not a file: " << messages_in);
     const uint64_t max_message_count = std::numeric_limits<pos_t>::max();
     LOOM_ASSERT(stats.message_count, max_message_count);
     const size_t message_count = stats.message_count;
 
-    double index_bytes = sizeof(pos_t) * message_count;
-    double target_chunk_size = std::max(1.0, std::min(double(message_count),
-        (target_mem_bytes - index_bytes) / stats.max_message_size));
+    // The index grows with output_count and may alone exceed the budget.
+    // Rather than degrade to one message per bucket and one scatter pass
+    // per batch of messages, buckets keep at least enough messages that
+    // each output needs at most max_open_buckets of them.
+    LOOM_ASSERT(max_open_buckets, "max_open_buckets must be positive");
+    const double index_bytes = sizeof(pos_t) * message_count * output_count;
+    if (index_bytes >= target_mem_bytes) {
+        std::cerr << "WARNING shuffle index needs " << index_bytes
+            << " bytes, exceeding target_mem_bytes = " << target_mem_bytes
+            << "; shuffling " << output_count << " outputs of "
+            << message_count << " messages anyway" << std::endl;
+    }
+    const double min_chunk_size =
+        (message_count + max_open_buckets - 1) / max_open_buckets;
+    double target_chunk_size = std::max(min_chunk_size,
+        std::min(double(message_count),
+            (target_mem_bytes - index_bytes) / stats.max_message_size));
     size_t chunk_size = static_cast<size_t>(std::round(target_chunk_size));
 
-    std::vector<pos_t> index(message_count);
-    for (size_t i = 0; i < message_count; ++i) {
-        index[i] = i;
+    std::vector<std::vector<pos_t>> indices(output_count);
+    for (size_t k = 0; k < output_count; ++k) {
+        auto & index = indices[k];
+        index.resize(message_count);
+        for (size_t i = 0; i < message_count; ++i) {
+            index[i] = i;
+        }
+        std::shuffle(index.begin(), index.end(), loom::rng_t(seeds[k]));
     }
-    std::shuffle(index.begin(), index.end(), loom::rng_t(seed));
 
     Message message;
     std::vector<Message> chunk;
-    protobuf::OutFile shuffled(shuffled_out);
-    for (size_t begin = 0; begin < message_count; begin += chunk_size) {
-        size_t end = std::min(begin + chunk_size, message_count);
-        chunk.resize(end - begin);
-        protobuf::InFile messages(messages_in);
-        for (size_t i : index) {
-            messages.try_read_stream(message);
-            if (begin <= i and i < end) {
-                std::swap(message, chunk[i - begin]);
+
+    // small streams are shuffled entirely in memory
+    if (chunk_size >= message_count) {
+        chunk.resize(message_count);
+        {
+            protobuf::InFile messages(messages_in);
+            for (auto & message : chunk) {
+                messages.try_read_stream(message);
+            }
+        }
+        std::vector<const Message *> shuffled_chunk(message_count);
+        for (size_t k = 0; k < output_count; ++k) {
+            const auto & index = indices[k];
+            for (size_t j = 0; j < message_count; ++j) {
+                shuffled_chunk[index[j]] = & chunk[j];
+            }
+            protobuf::OutFile shuffled(shuffled_out[k].c_str());
+            for (const auto * message : shuffled_chunk) {
+                shuffled.write_stream(* message);
             }
         }
-        for (const auto & message : chunk) {
-            shuffled.write_stream(message);
+        return;
+    }
+
+    std::vector<std::unique_ptr<protobuf::OutFile>> shuffled;
+    for (const auto & out : shuffled_out) {
+        shuffled.emplace_back(new protobuf::OutFile(out.c_str()));
+    }
+
+    // buckets are numbered b + k * bucket_count for output k
+    const size_t bucket_count = (message_count + chunk_size - 1) / chunk_size;
+    const size_t total_bucket_count = bucket_count * output_count;
+    const std::string temp_dir = detail::shuffle_temp_dir(
+        shuffled_out[0].c_str());
+    auto bucket_filename = [&](size_t b) {
+        return temp_dir + "/bucket." + std::to_string(b) + ".pbs";
+    };
+
+    Message record;
+    for (size_t batch_begin = 0;
+        batch_begin < total_bucket_count;
+        batch_begin += max_open_buckets)
+    {
+        const size_t batch_end =
+            std::min(batch_begin + max_open_buckets, total_bucket_count);
+
+        // scatter pass
+        {
+            std::vector<std::unique_ptr<protobuf::OutFile>> buckets;
+            for (size_t b = batch_begin; b < batch_end; ++b) {
+                buckets.emplace_back(
+                    new protobuf::OutFile(bucket_filename(b).c_str()));
+            }
+            const size_t k_begin = batch_begin / bucket_count;
+            const size_t k_end = (batch_end - 1) / bucket_count + 1;
+            protobuf::InFile messages(messages_in);
+            for (size_t j = 0; j < message_count; ++j) {
+                messages.try_read_stream(message);
+                for (size_t k = k_begin; k < k_end; ++k) {
+                    const pos_t i = indices[k][j];
+                    const size_t b = i / chunk_size + k * bucket_count;
+                    if (batch_begin <= b and b < batch_end) {
+                        const pos_t slot = i % chunk_size;
+                        record.resize(sizeof(pos_t) + message.size());
+                        memcpy(record.data(), & slot, sizeof(pos_t));
+                        std::copy(
+                            message.begin(),
+                            message.end(),
+                            record.begin() + sizeof(pos_t));
+                        const Message & const_record = record;
+                        buckets[b - batch_begin]->write_stream(const_record);
+                    }
+                }
+            }
+        }
+
+        // gather pass
+        for (size_t b = batch_begin; b < batch_end; ++b) {
+            const size_t k = b / bucket_count;
+            const size_t begin = (b % bucket_count) * chunk_size;
+            const size_t end = std::min(begin + chunk_size, message_count);
+            chunk.resize(end - begin);
+            const std::string filename = bucket_filename(b);
+            {
+                protobuf::InFile bucket(filename.c_str());
+                while (bucket.try_read_stream(record)) {
+                    pos_t slot;
+                    memcpy(& slot, record.data(), sizeof(pos_t));
+                    LOOM_ASSERT1(slot < chunk.size(), "bad slot: " << slot);
+                    chunk[slot].assign(
+                        record.begin() + sizeof(pos_t),
+                        record.end());
+                }
+            }
+            detail::remove_stream_file(filename);
+            for (const auto & message : chunk) {
+                shuffled[k]->write_stream(message);
+            }
         }
     }
+
+    rmdir(temp_dir.c_str());
+}
+
+inline void shuffle_stream (
+        const char * messages_in,
+        const char * shuffled_out,
+        long seed,
+        double target_mem_bytes)
+{
+    shuffle_streams(messages_in, {shuffled_out}, {seed}, target_mem_bytes);
 }
 
 } // namespace loom
@@ -0,0 +1,199 @@
+// Copyright (c) 2014, Salesforce.com, Inc.  All rights reserved.
+//
+// Redistribution and use in source and binary forms, with or without
+// modification, are permitted provided that the following conditions
+// are met:
+//
+// - Redistributions of source code must retain the above copyright
+//   notice, this list of conditions and the following disclaimer.
+// - Redistributions in binary form must reproduce the above copyright
+//   notice, this list of conditions and the following disclaimer in the
+//   documentation and/or other materials provided with the distribution.
+// - Neither the name of Salesforce.com nor the names of its contributors
+//   may be used to endorse or promote products derived from this
+//   software without specific prior written permission.
+//
+// THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+// "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+// LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+// FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+// COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+// INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+// BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+// OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+// ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+// TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+// USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#pragma once
+
+#include <errno.h>
+#include <stdio.h>
+#include <string.h>
+#include <signal.h>
+#include <unistd.h>
+#include <sys/prctl.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <netdb.h>
+#include <string>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+#include <loom/common.hpp>
+#include <loom/query_server.hpp>
+
+namespace loom
+{
+
+inline int listen_unix (const char * path, int backlog = 64)
+{
+    // bind to a temp name, so clients never see a socket not yet listening
+    const std::string temp_path = std::string(path) + ".temp";
+    sockaddr_un address;
+    LOOM_ASSERT_LT(temp_path.size(), sizeof(address.sun_path));
+    memset(& address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    strcpy(address.sun_path, temp_path.c_str());
+
+    int fid = socket(AF_UNIX, SOCK_STREAM, 0);
+    LOOM_ASSERT(fid != -1, "failed to create socket");
+    unlink(temp_path.c_str());
+    int status = bind(fid, (sockaddr *) & address, sizeof(address));
+    LOOM_ASSERT(status == 0, "failed to bind socket " << path);
+    status = listen(fid, backlog);
+    LOOM_ASSERT(status == 0, "failed to listen on socket " << path);
+    status = rename(temp_path.c_str(), path);
+    LOOM_ASSERT(status == 0, "failed to rename socket " << path);
+    return fid;
+}
+
+inline int listen_tcp (
+        const std::string & host,
+        const std::string & port,
+        int backlog = 64)
+{
+    addrinfo hints;
+    memset(& hints, 0, sizeof(hints));
+    hints.ai_family = AF_UNSPEC;
+    hints.ai_socktype = SOCK_STREAM;
+    hints.ai_flags = AI_PASSIVE;
+    addrinfo * info = nullptr;
+    const char * node = host.empty() ? nullptr : host.c_str();
+    int status = getaddrinfo(node, port.c_str(), & hints, & info);
+    LOOM_ASSERT(status == 0, "failed to resolve " << host << ":" << port);
+
+    int fid = socket(info->ai_family, info->ai_socktype, info->ai_protocol);
+    LOOM_ASSERT(fid != -1, "failed to create socket");
+    const int reuse = 1;
+    setsockopt(fid, SOL_SOCKET, SO_REUSEADDR, & reuse, sizeof(reuse));
+    status = bind(fid, info->ai_addr, info->ai_addrlen);
+    freeaddrinfo(info);
+    LOOM_ASSERT(status == 0, "failed to bind " << host << ":" << port);
+    status = listen(fid, backlog);
+    LOOM_ASSERT(status == 0, "failed to listen on " << host << ":" << port);
+    return fid;
+}
+
+// Socket addresses are either unix:PATH or tcp:HOST:PORT
+inline bool startswith (const char * string, const char * prefix)
+{
+    return strncmp(string, prefix, strlen(prefix)) == 0;
+}
+
+inline bool is_socket_address (const char * address)
+{
+    return startswith(address, "unix:") or startswith(address, "tcp:");
+}
+
+inline int listen_address (const char * address)
+{
+    const std::string name(address);
+    if (startswith(address, "unix:")) {
+        return listen_unix(name.substr(strlen("unix:")).c_str());
+    } else if (startswith(address, "tcp:")) {
+        const std::string host_port = name.substr(strlen("tcp:"));
+        const size_t colon = host_port.rfind(':');
+        LOOM_ASSERT(colon != std::string::npos, "missing port: " << address);
+        return listen_tcp(
+            host_port.substr(0, colon),
+            host_port.substr(colon + 1));
+    } else {
+        LOOM_ERROR("unsupported socket address: " << address);
+    }
+}
+
+inline int accept_retry (int listen_fid)
+{
+    while (true) {
+        int fid = accept(listen_fid, nullptr, nullptr);
+        if (fid != -1) {
+            return fid;
+        }
+        LOOM_ASSERT(errno == EINTR, "failed to accept connection");
+    }
+}
+
+// A fork server keeps pool_size idle children blocked in accept().
+// Each child inherits the fully loaded server copy-on-write, serves one
+// connection as a request/response stream, and exits. When a child accepts
+// a connection it notifies the parent, which forks a replacement, so that
+// new sessions cost a connect() rather than a model load.
+// This never returns.
+inline void serve_forked (
+        QueryServer & server,
+        rng_t & rng,
+        int listen_fid,
+        size_t pool_size)
+{
+    LOOM_ASSERT_LT(0, pool_size);
+    signal(SIGCHLD, SIG_IGN);  // children are reaped automatically
+
+    int notify[2];
+    LOOM_ASSERT(pipe(notify) == 0, "failed to create pipe");
+
+    auto spawn = [&](){
+        const auto seed = rng();
+        pid_t pid = fork();
+        LOOM_ASSERT(pid != -1, "failed to fork");
+        if (pid) {
+            return;
+        }
+
+        // idle children die with the parent; busy children finish
+        prctl(PR_SET_PDEATHSIG, SIGTERM);
+        close(notify[0]);
+        const int fid = accept_retry(listen_fid);
+        prctl(PR_SET_PDEATHSIG, 0);
+        close(listen_fid);
+        const char byte = 0;
+        LOOM_ASSERT(write(notify[1], & byte, 1) == 1, "failed to notify");
+        close(notify[1]);
+
+        // libgomp's thread pool does not survive fork
+        #ifdef _OPENMP
+        omp_set_num_threads(1);
+        #endif
+
+        rng_t child_rng(seed);
+        server.serve(child_rng, fid, fid);
+        close(fid);
+        _exit(0);
+    };
+
+    for (size_t i = 0; i < pool_size; ++i) {
+        spawn();
+    }
+
+    while (true) {
+        char byte;
+        ssize_t count = read(notify[0], & byte, 1);
+        if (count == 1) {
+            spawn();
+        } else {
+            LOOM_ASSERT(count == -1 and errno == EINTR, "failed to read pipe");
+        }
+    }
+}
+
+} // namespace loom
@@ -27,6 +27,7 @@
 
 # pragma once
 
+#include <sys/stat.h>
 #include <sstream>
 #include <fstream>
 #include <loom/common.hpp>
@@ -65,6 +66,21 @@ inline std::string get_mixture_path (
     return filename.str();
 }
 
+// this prefers an uncompressed snapshot mixture, as written by
+// loom.tasks.snapshot, over the original gzipped mixture
+inline std::string find_mixture_path (
+        const std::string & groups_path,
+        size_t kindid)
+{
+    std::ostringstream filename;
+    filename << groups_path << "/mixture." << kindid << ".pbs";
+    if (std::ifstream(filename.str())) {
+        return filename.str();
+    } else {
+        return get_mixture_path(groups_path, kindid);
+    }
+}
+
 inline std::string get_sample_path (
         const std::string & root,
         size_t seed)
@@ -74,6 +90,29 @@ inline std::string get_sample_path (
     return filename.str();
 }
 
+inline std::string get_snapshot_path (const std::string & root)
+{
+    return root + "/query/snapshot";
+}
+
+// a snapshot file is fresh if it exists and is no older than its source
+inline bool is_fresh (
+        const std::string & snapshot,
+        const std::string & source)
+{
+    struct stat snapshot_stat;
+    struct stat source_stat;
+    if (stat(snapshot.c_str(), & snapshot_stat) or
+        stat(source.c_str(), & source_stat))
+    {
+        return false;
+    }
+    const timespec & x = snapshot_stat.st_mtim;
+    const timespec & y = source_stat.st_mtim;
+    return x.tv_sec > y.tv_sec or
+        (x.tv_sec == y.tv_sec and x.tv_nsec >= y.tv_nsec);
+}
+
 inline Paths get_paths (const std::string & root)
 {
     Paths paths;
@@ -92,6 +131,27 @@ inline Paths get_paths (const std::string & root)
             break;
         }
     }
+
+    // use uncompressed snapshots where they are up to date
+    const std::string snapshot_root = get_snapshot_path(root);
+    if (is_fresh(snapshot_root + "/ingest/tares.pbs", paths.ingest.tares)) {
+        paths.ingest.tares = snapshot_root + "/ingest/tares.pbs";
+    }
+    for (size_t seed = 0; seed < paths.samples.size(); ++seed) {
+        auto & sample = paths.samples[seed];
+        const std::string snapshot = get_sample_path(snapshot_root, seed);
+        if (is_fresh(snapshot + "/config.pb", sample.config) and
+            is_fresh(snapshot + "/model.pb", sample.model) and
+            is_fresh(
+                snapshot + "/groups/mixture.0.pbs",
+                get_mixture_path(sample.groups, 0)))
+        {
+            sample.config = snapshot + "/config.pb";
+            sample.model = snapshot + "/model.pb";
+            sample.groups = snapshot + "/groups";
+        }
+    }
+
     return paths;
 }
 
@@ -34,18 +34,37 @@
 namespace loom
 {
 
+// A StreamInterval reads rows cyclically through two cursors: one for rows
+// being added (unassigned) and one for rows being removed (assigned).
+// If cache_mem_bytes is positive and the parsed rows fit within it, rows are
+// parsed once into memory and served from there on every pass; otherwise
+// they are decompressed and parsed from rows_in on each pass.
 class StreamInterval : noncopyable
 {
 public:
 
-    StreamInterval (const char * rows_in) :
+    StreamInterval (const char * rows_in, double cache_mem_bytes = 0) :
         unassigned_(rows_in),
-        assigned_(rows_in)
+        assigned_(rows_in),
+        cache_(),
+        unassigned_pos_(0),
+        assigned_pos_(0)
     {
+        if (cache_mem_bytes > 0 and unassigned_.is_file()) {
+            try_load_cache(rows_in, cache_mem_bytes);
+        }
     }
 
+    bool is_cached () const { return not cache_.empty(); }
+
     void load (const protobuf::Checkpoint::StreamInterval & rows)
     {
+        if (is_cached()) {
+            unassigned_pos_ = rows.unassigned_pos() % cache_.size();
+            assigned_pos_ = rows.assigned_pos() % cache_.size();
+            return;
+        }
+
         #pragma omp parallel sections
         {
             #pragma omp section
@@ -58,6 +77,12 @@ public:
 
     void dump (protobuf::Checkpoint::StreamInterval & rows)
     {
+        if (is_cached()) {
+            rows.set_unassigned_pos(unassigned_pos_);
+            rows.set_assigned_pos(assigned_pos_);
+            return;
+        }
+
         rows.set_unassigned_pos(unassigned_.position());
         rows.set_assigned_pos(assigned_.position());
     }
@@ -67,6 +92,15 @@ public:
         LOOM_ASSERT(assignments.row_count(), "nothing to initialize");
         LOOM_ASSERT(assigned_.is_file(), "only files support StreamInterval");
 
+        if (is_cached()) {
+            const auto last_assigned_rowid = assignments.rowids().back();
+            const auto first_assigned_rowid = assignments.rowids().front();
+            unassigned_pos_ = find_cached(last_assigned_rowid) + 1;
+            unassigned_pos_ %= cache_.size();
+            assigned_pos_ = find_cached(first_assigned_rowid);
+            return;
+        }
+
         #pragma omp parallel sections
         {
             #pragma omp section
@@ -77,20 +111,105 @@ public:
         }
     }
 
-    template<class Message>
-    void read_unassigned (Message & message)
+    // these are zero-copy, and require is_cached()
+    const protobuf::Row & read_unassigned_cached ()
+    {
+        return cyclic_read_cached(unassigned_pos_);
+    }
+
+    const protobuf::Row & read_assigned_cached ()
+    {
+        return cyclic_read_cached(assigned_pos_);
+    }
+
+    void read_unassigned (protobuf::Row & row)
+    {
+        if (is_cached()) {
+            row = read_unassigned_cached();
+        } else {
+            unassigned_.cyclic_read_stream(row);
+        }
+    }
+
+    void read_assigned (protobuf::Row & row)
     {
-        unassigned_.cyclic_read_stream(message);
+        if (is_cached()) {
+            row = read_assigned_cached();
+        } else {
+            assigned_.cyclic_read_stream(row);
+        }
     }
 
-    template<class Message>
-    void read_assigned (Message & message)
+    void read_unassigned (std::vector<char> & raw)
     {
-        assigned_.cyclic_read_stream(message);
+        if (is_cached()) {
+            serialize(read_unassigned_cached(), raw);
+        } else {
+            unassigned_.cyclic_read_stream(raw);
+        }
+    }
+
+    void read_assigned (std::vector<char> & raw)
+    {
+        if (is_cached()) {
+            serialize(read_assigned_cached(), raw);
+        } else {
+            assigned_.cyclic_read_stream(raw);
+        }
     }
 
 private:
 
+    void try_load_cache (const char * rows_in, double cache_mem_bytes)
+    {
+        const auto stats = protobuf::InFile::stream_stats(rows_in);
+        if (sizeof(protobuf::Row) * stats.message_count > cache_mem_bytes) {
+            return;
+        }
+
+        cache_.resize(stats.message_count);
+        double cache_bytes = 0;
+        protobuf::InFile rows(rows_in);
+        for (auto & row : cache_) {
+            bool success = rows.try_read_stream(row);
+            LOOM_ASSERT(success, "failed to cache " << rows_in);
+            cache_bytes += row.SpaceUsed();
+            if (cache_bytes > cache_mem_bytes) {
+                std::vector<protobuf::Row>().swap(cache_);
+                return;
+            }
+        }
+    }
+
+    const protobuf::Row & cyclic_read_cached (size_t & pos)
+    {
+        LOOM_ASSERT1(is_cached(), "rows are not cached");
+        const protobuf::Row & row = cache_[pos];
+        if (LOOM_UNLIKELY(++pos == cache_.size())) {
+            pos = 0;
+        }
+        return row;
+    }
+
+    size_t find_cached (uint64_t rowid) const
+    {
+        for (size_t pos = 0; pos < cache_.size(); ++pos) {
+            if (cache_[pos].id() == rowid) {
+                return pos;
+            }
+        }
+        LOOM_ERROR("row.id not found: " << rowid);
+    }
+
+    static void serialize (
+            const protobuf::Row & row,
+            std::vector<char> & raw)
+    {
+        raw.resize(row.ByteSize());
+        row.SerializeWithCachedSizesToArray(
+            reinterpret_cast<uint8_t *>(raw.data()));
+    }
+
     void seek_first_unassigned_row (const Assignments & assignments)
     {
         const auto last_assigned_rowid = assignments.rowids().back();
@@ -124,6 +243,9 @@ private:
 
     protobuf::InFile unassigned_;
     protobuf::InFile assigned_;
+    std::vector<protobuf::Row> cache_;
+    size_t unassigned_pos_;
+    size_t assigned_pos_;
 };
 
 } // namespace loom